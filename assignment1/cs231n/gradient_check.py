@@ -1,12 +1,22 @@
 import numpy as np
+import multiprocessing
 from random import randrange
+from scipy.stats import chi2
 
-def eval_numerical_gradient(f, x, verbose=True, h=0.00001):
+def eval_numerical_gradient(f, x, verbose=True, h=0.00001, batch_size=None,
+                            num_workers=None):
   """ 
   a naive implementation of numerical gradient of f at x 
   - f should be a function that takes a single argument
   - x is the point (numpy array) to evaluate the gradient at
+  - batch_size: if not None, f must accept a stack of inputs of shape
+    (B,) + x.shape and return B values; up to batch_size perturbed copies of
+    x are then evaluated in a single call (see eval_numerical_gradient_batched)
+  - num_workers: in batched mode, number of processes to spread batches over
   """ 
+  if batch_size is not None:
+    return eval_numerical_gradient_batched(f, x, h=h, batch_size=batch_size,
+                                           num_workers=num_workers)
 
   fx = f(x) # evaluate function value at original point
   grad = np.zeros_like(x)
@@ -32,11 +42,21 @@ def eval_numerical_gradient(f, x, verbose=True, h=0.00001):
   return grad
 
 
-def eval_numerical_gradient_array(f, x, df, h=1e-5):
+def eval_numerical_gradient_array(f, x, df, h=1e-5, batch_size=None,
+                                  independent=False, num_workers=None):
   """
   Evaluate a numeric gradient for a function that accepts a numpy
   array and returns a numpy array.
+
+  If batch_size is not None then f must accept a stack of inputs of shape
+  (B,) + x.shape and return a stack of B outputs; see
+  eval_numerical_gradient_batched and fold_batch.
   """
+  if batch_size is not None:
+    return eval_numerical_gradient_batched(f, x, df=df, h=h,
+                                           batch_size=batch_size,
+                                           independent=independent,
+                                           num_workers=num_workers)
   grad = np.zeros_like(x)
   it = np.nditer(x, flags=['multi_index'], op_flags=['readwrite'])
   while not it.finished:
@@ -54,6 +74,101 @@ def eval_numerical_gradient_array(f, x, df, h=1e-5):
   return grad
 
 
+def fold_batch(f):
+  """
+  Adapt a function of x with shape (N, d_1, ..., d_k) whose outputs for the N
+  examples are computed independently (affine, relu, conv, pooling, ...) to
+  the batched API: a stack of B inputs is folded into a single input with
+  B * N examples, and the result is split back into B outputs.
+  """
+  def batched_f(xs):
+    out = f(xs.reshape((-1,) + xs.shape[2:]))
+    return out.reshape((xs.shape[0], -1))
+  return batched_f
+
+
+def _eval_gradient_chunk(f, x, df, idx, h, independent):
+  """
+  Centered differences along the flat coordinates idx of x, evaluated with a
+  single call to f on a stack of 2 * len(idx) perturbed copies of x. If
+  independent is True then idx indexes the coordinates of a single example
+  and each copy perturbs that coordinate in every example at once.
+  """
+  k = len(idx)
+  rows = x.shape[0] if independent else 1
+  xs = np.repeat(x.reshape(1, rows, -1), 2 * k, axis=0)
+  xs[np.arange(k), :, idx] += h
+  xs[k + np.arange(k), :, idx] -= h
+  out = np.asarray(f(xs.reshape((2 * k,) + x.shape)), dtype=np.float64)
+  out = out.reshape(2 * k, rows, -1)
+  diff = out[:k] - out[k:]
+  if df is None:
+    diff = diff.sum(axis=2)
+  else:
+    diff = np.einsum('krm,rm->kr', diff, df.reshape(rows, -1))
+  return diff / (2 * h)
+
+
+# Arguments of the current batched gradient check, set before the worker pool
+# forks so that f does not have to be picklable.
+_pool_args = None
+
+
+def _eval_gradient_chunk_worker(idx):
+  f, x, df, h, independent = _pool_args
+  return _eval_gradient_chunk(f, x, df, idx, h, independent)
+
+
+def eval_numerical_gradient_batched(f, x, df=None, h=1e-5, batch_size=64,
+                                    independent=False, num_workers=None):
+  """
+  Evaluate a numeric gradient by perturbing many coordinates of x at once.
+
+  Rather than calling f twice for every coordinate of x, we stack the +h and
+  -h perturbed copies of x for batch_size coordinates along a new leading axis
+  and evaluate them with one vectorized call to f.
+
+  Inputs:
+  - f: Function that accepts an array of shape (B,) + x.shape and returns an
+    array whose first axis has size B, holding f evaluated on each of the B
+    inputs; use fold_batch to adapt layer functions.
+  - x: Point at which to evaluate the gradient.
+  - df: Upstream derivative of the same shape as a single output of f; if
+    None, the outputs for each input are summed (so scalar functions work
+    directly).
+  - h: Step size.
+  - batch_size: Number of coordinates perturbed in each call to f; each call
+    evaluates 2 * batch_size copies of x.
+  - independent: Set to True if row i of the output of f only depends on row
+    i of its input, as is the case for the input x of most layers. Then every
+    copy perturbs the same coordinate of all N rows at once, which needs N
+    times fewer evaluations.
+  - num_workers: If greater than 1, spread the batches over a pool of this
+    many processes.
+
+  Returns:
+  - grad: Numeric gradient of the same shape as x.
+  """
+  global _pool_args
+  size = x[0].size if independent else x.size
+  chunks = np.array_split(np.arange(size),
+                          max(1, int(np.ceil(size / float(batch_size)))))
+  if num_workers is not None and num_workers > 1:
+    _pool_args = (f, x, df, h, independent)
+    pool = multiprocessing.Pool(num_workers)
+    try:
+      parts = pool.map(_eval_gradient_chunk_worker, chunks)
+    finally:
+      pool.close()
+      pool.join()
+      _pool_args = None
+  else:
+    parts = [_eval_gradient_chunk(f, x, df, idx, h, independent)
+             for idx in chunks]
+  grad = np.concatenate(parts).T.reshape(x.shape)
+  return grad.astype(x.dtype, copy=False)
+
+
 def eval_numerical_gradient_blobs(f, inputs, output, h=1e-5):
   """
   Compute numeric gradients for a function that operates on input
@@ -122,3 +237,95 @@ def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-5):
     rel_error = abs(grad_numerical - grad_analytic) / (abs(grad_numerical) + abs(grad_analytic))
     print 'numerical: %f analytic: %f, relative error: %e' % (grad_numerical, grad_analytic, rel_error)
 
+
+def grad_check_directional(model, loss_args, num_probes=20, h=1e-5,
+                           confidence=0.95, seed=None, verbose=True):
+  """
+  Check the gradients of a whole model along random directions.
+
+  Checking every parameter with eval_numerical_gradient costs two forward
+  passes per parameter. Instead we draw random unit directions u over all of
+  model.params at once and compare the centered difference
+  (L(p + h u) - L(p - h u)) / 2h, which costs two forward passes, against the
+  analytic directional derivative sum_k grads[k] . u[k].
+
+  For Gaussian directions the squared error of each probe has expectation
+  |e|^2 / P, where e is the error of the analytic gradient and P the number of
+  parameters, and likewise the squared analytic derivative has expectation
+  |g|^2 / P. The ratio of their sums therefore estimates the relative error
+  |e| / |g| of the full gradient, and a chi-square upper bound on |e| gives a
+  bound that holds with the requested confidence.
+
+  Inputs:
+  - model: Object with a params dictionary whose loss(*loss_args) method
+    returns a tuple (loss, grads) where grads has the same keys as params.
+    The model should use float64 so that the finite differences are accurate.
+  - loss_args: Tuple of arguments passed to model.loss, such as (X, y) or
+    (features, captions).
+  - num_probes: Number of random directions to check.
+  - h: Step size along each direction.
+  - confidence: Confidence level of the reported upper bound.
+  - seed: Seed for drawing the directions.
+  - verbose: Whether to print the result of each probe and a summary.
+
+  Returns a dictionary with the following keys:
+  - numeric: Array of numeric directional derivatives, one per probe.
+  - analytic: Array of analytic directional derivatives, one per probe.
+  - rel_errors: Relative error of each probe.
+  - grad_rel_error: Estimate of |e| / |g| for the full gradient.
+  - grad_rel_error_bound: Upper bound on |e| / |g| at the given confidence.
+  """
+  rng = np.random.RandomState(seed)
+  params = model.params
+  names = sorted(params.keys())
+  orig = dict((k, params[k]) for k in names)
+
+  _, grads = model.loss(*loss_args)
+
+  numeric = np.zeros(num_probes)
+  analytic = np.zeros(num_probes)
+  try:
+    for i in xrange(num_probes):
+      u = dict((k, rng.randn(*orig[k].shape)) for k in names)
+      norm = np.sqrt(sum(np.sum(v ** 2) for v in u.itervalues()))
+      for k in names:
+        u[k] /= norm
+
+      for k in names:
+        params[k] = (orig[k] + h * u[k]).astype(orig[k].dtype)
+      fxph, _ = model.loss(*loss_args)
+      for k in names:
+        params[k] = (orig[k] - h * u[k]).astype(orig[k].dtype)
+      fxmh, _ = model.loss(*loss_args)
+
+      numeric[i] = (fxph - fxmh) / (2 * h)
+      analytic[i] = sum(np.sum(grads[k] * u[k]) for k in names)
+      if verbose:
+        rel_error = abs(numeric[i] - analytic[i]) / (abs(numeric[i]) + abs(analytic[i]))
+        print 'numerical: %e analytic: %e, relative error: %e' % (numeric[i], analytic[i], rel_error)
+  finally:
+    for k in names:
+      params[k] = orig[k]
+
+  denom = np.maximum(np.abs(numeric) + np.abs(analytic), 1e-300)
+  rel_errors = np.abs(numeric - analytic) / denom
+  err_sq = np.sum((numeric - analytic) ** 2)
+  grad_sq = max(np.sum(analytic ** 2), 1e-300)
+  grad_rel_error = np.sqrt(err_sq / grad_sq)
+  # sum of squared errors ~ (|e|^2 / P) chi2(num_probes); the analytic term is
+  # estimated the same way, so we bound it from below by its own quantile
+  err_bound = err_sq / chi2.ppf(1 - confidence, num_probes)
+  grad_bound = grad_sq / chi2.ppf(confidence, num_probes)
+  grad_rel_error_bound = np.sqrt(err_bound / grad_bound)
+
+  if verbose:
+    print 'max relative error: %e, gradient relative error: %e (< %e with %.0f%% confidence)' % (
+          rel_errors.max(), grad_rel_error, grad_rel_error_bound, 100 * confidence)
+
+  return {
+    'numeric': numeric,
+    'analytic': analytic,
+    'rel_errors': rel_errors,
+    'grad_rel_error': grad_rel_error,
+    'grad_rel_error_bound': grad_rel_error_bound,
+  }
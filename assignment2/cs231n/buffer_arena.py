@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class BufferArena(object):
+  """
+  A workspace of preallocated arrays for the out= arguments of the layer
+  functions.
+
+  Buffers are keyed by (layer, role), where layer identifies the layer that
+  uses the buffer (for example its index in the network) and role names the
+  value that is stored in it (for example 'out' or 'dx'). The first request for
+  a key allocates the buffer and every later request with the same shape and
+  dtype returns the same array, so once every key has been seen a training
+  iteration with fixed batch size performs no large allocations for the values
+  that are served from the arena. A request with a different shape or dtype
+  replaces the buffer of its key, so the arena only holds one buffer per
+  (layer, role) and does not grow when the batch size changes.
+
+  Since buffers are reused, an array obtained from the arena is only valid
+  until the next request for the same key; copy it to keep it longer.
+
+  Example usage:
+
+  arena = BufferArena()
+  out, cache = affine_forward(x, w, b,
+                              out=arena.get(1, 'out', (N, M), x.dtype))
+  """
+
+  def __init__(self):
+    self.buffers = {}
+    self.num_allocs = 0
+
+
+  def get(self, layer, role, shape, dtype=np.float64):
+    """
+    Return the buffer for a key, allocating it on first use or when the
+    shape or dtype differs from the one of the buffer held for the key.
+
+    Inputs:
+    - layer: Hashable identifier of the layer that owns the buffer.
+    - role: String naming the value stored in the buffer.
+    - shape: Shape of the buffer.
+    - dtype: Numpy datatype of the buffer.
+
+    Returns:
+    - buf: An uninitialized C-contiguous array of the given shape and dtype.
+    """
+    shape = tuple(shape)
+    dtype = np.dtype(dtype)
+    key = (layer, role)
+    buf = self.buffers.get(key)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+      buf = np.empty(shape, dtype=dtype)
+      self.buffers[key] = buf
+      self.num_allocs += 1
+    return buf
+
+
+  def nbytes(self):
+    """ Total size in bytes of all buffers held by the arena. """
+    return sum(buf.nbytes for buf in self.buffers.itervalues())
+
+
+  def clear(self):
+    """ Drop all buffers, for example when the network is no longer trained. """
+    self.buffers = {}
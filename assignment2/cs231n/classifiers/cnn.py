@@ -3,6 +3,7 @@ import numpy as np
 from cs231n.layers import *
 from cs231n.fast_layers import *
 from cs231n.layer_utils import *
+from cs231n.classifiers.sequential import SequentialNet
 
 
 class ThreeLayerConvNet(object):
@@ -10,6 +11,11 @@ class ThreeLayerConvNet(object):
   A three-layer convolutional network with the following architecture:
   
   conv - relu - 2x2 max pool - affine - relu - affine - softmax
+
+  or, with global_pool=True,
+
+  conv - relu - 2x2 max pool - global average pool - affine - relu - affine -
+  softmax
   
   The network operates on minibatches of data that have shape (N, C, H, W)
   consisting of N images, each with height H and width W and with C input
@@ -18,7 +24,7 @@ class ThreeLayerConvNet(object):
   
   def __init__(self, input_dim=(3, 32, 32), num_filters=32, filter_size=7,
                hidden_dim=100, num_classes=10, weight_scale=1e-3, reg=0.0,
-               dtype=np.float32):
+               dtype=np.float32, global_pool=False, layout='NCHW'):
     """
     Initialize a new network.
     
@@ -32,10 +38,21 @@ class ThreeLayerConvNet(object):
       of weights.
     - reg: Scalar giving L2 regularization strength
     - dtype: numpy datatype to use for computation.
+    - global_pool: If True, average the pooled feature map over all spatial
+      positions before the hidden affine layer, so that W2 has shape
+      (num_filters, hidden_dim) instead of (num_filters * H * W / 4,
+      hidden_dim).
+    - layout: 'NCHW' or 'NHWC'. With 'NHWC' the convolutional layers run on
+      channels-last activations; X still has shape (N, C, H, W) and the
+      parameters are the same in both layouts.
     """
+    if layout not in ('NCHW', 'NHWC'):
+      raise ValueError('Invalid layout "%s"' % layout)
     self.params = {}
     self.reg = reg
     self.dtype = dtype
+    self.global_pool = global_pool
+    self.layout = layout
     
     ############################################################################
     # TODO: Initialize weights and biases for the three-layer convolutional    #
@@ -55,7 +72,8 @@ class ThreeLayerConvNet(object):
 
     self.params["W1"] = weight_scale * np.random.randn(num_filters, C, filter_size, filter_size)
     self.params["b1"] = np.zeros(num_filters)
-    self.params["W2"] = weight_scale * np.random.randn(num_filters * H * W / 4, hidden_dim)
+    head_dim = num_filters if global_pool else num_filters * H * W / 4
+    self.params["W2"] = weight_scale * np.random.randn(head_dim, hidden_dim)
     self.params["b2"] = np.zeros(hidden_dim)
     self.params["W3"] = weight_scale * np.random.randn(hidden_dim, num_classes)
     self.params["b3"] = np.zeros(num_classes)
@@ -74,6 +92,7 @@ class ThreeLayerConvNet(object):
     
     Input / output: Same API as TwoLayerNet in fc_net.py.
     """
+    X = X.astype(self.dtype)
     W1, b1 = self.params['W1'], self.params['b1']
     W2, b2 = self.params['W2'], self.params['b2']
     W3, b3 = self.params['W3'], self.params['b3']
@@ -91,7 +110,18 @@ class ThreeLayerConvNet(object):
     # computing the class scores for X and storing them in the scores          #
     # variable.                                                                #
     ############################################################################
-    (x1, cache1) = conv_relu_pool_forward(X, W1, b1, conv_param, pool_param)
+    if self.layout == 'NHWC':
+      (x1, cache1) = conv_relu_pool_nhwc_forward(X.transpose(0, 2, 3, 1), W1, b1,
+                                                 conv_param, pool_param)
+      if self.global_pool:
+        (x1, gap_cache) = global_avg_pool_nhwc_forward(x1)
+      else:
+        # W2 takes the pooled features in (C, H, W) order
+        x1 = x1.transpose(0, 3, 1, 2)
+    else:
+      (x1, cache1) = conv_relu_pool_forward(X, W1, b1, conv_param, pool_param)
+      if self.global_pool:
+        (x1, gap_cache) = global_avg_pool_forward(x1)
     (x2, cache2) = affine_relu_forward(x1, W2, b2)
     (x3, cache3) = affine_forward(x2, W3, b3)
     scores = x3
@@ -118,7 +148,16 @@ class ThreeLayerConvNet(object):
 
     (dx3, dw3, db3) = affine_backward(loss_dx, cache3)
     (dx2, dw2, db2) = affine_relu_backward(dx3, cache2)
-    (dx1, dw1, db1) = conv_relu_pool_backward(dx2, cache1)
+    if self.layout == 'NHWC':
+      if self.global_pool:
+        dx2 = global_avg_pool_nhwc_backward(dx2, gap_cache)
+      else:
+        dx2 = dx2.transpose(0, 2, 3, 1)
+      (dx1, dw1, db1) = conv_relu_pool_nhwc_backward(dx2, cache1)
+    else:
+      if self.global_pool:
+        dx2 = global_avg_pool_backward(dx2, gap_cache)
+      (dx1, dw1, db1) = conv_relu_pool_backward(dx2, cache1)
 
     grads["W1"] = dw1 + self.reg * W1
     grads["W2"] = dw2 + self.reg * W2
@@ -134,6 +173,17 @@ class ThreeLayerConvNet(object):
     return loss, grads
 
 
+  def as_sequential(self):
+    """
+    Return a SequentialNet that computes the same loss as this network and
+    shares its params.
+    """
+    layers = _conv_head(self.params, self.layout, self.global_pool)
+    layers += [('affine_relu', ('W2', 'b2'), ()),
+               ('affine', ('W3', 'b3'), ())]
+    return SequentialNet(layers, self.params, reg=self.reg, dtype=self.dtype)
+
+
 class UberConvNet(object):
   """
   The network operates on minibatches of data that have shape (N, C, H, W)
@@ -143,7 +193,7 @@ class UberConvNet(object):
 
   def __init__(self, input_dim=(3, 32, 32), num_filters=32, filter_size=7,
                hidden_dim=100, num_classes=10, weight_scale=1e-3, reg=0.0,
-               dtype=np.float32):
+               dtype=np.float32, global_pool=False, layout='NCHW'):
     """
     Initialize a new network.
 
@@ -157,10 +207,21 @@ class UberConvNet(object):
       of weights.
     - reg: Scalar giving L2 regularization strength
     - dtype: numpy datatype to use for computation.
+    - global_pool: If True, average the pooled feature map over all spatial
+      positions before the hidden affine layer, so that W2 has shape
+      (num_filters, hidden_dim) instead of (num_filters * H * W / 4,
+      hidden_dim).
+    - layout: 'NCHW' or 'NHWC'. With 'NHWC' the convolutional layers run on
+      channels-last activations; X still has shape (N, C, H, W) and the
+      parameters are the same in both layouts.
     """
+    if layout not in ('NCHW', 'NHWC'):
+      raise ValueError('Invalid layout "%s"' % layout)
     self.params = {}
     self.reg = reg
     self.dtype = dtype
+    self.global_pool = global_pool
+    self.layout = layout
 
     (C, H, W) = input_dim
 
@@ -170,7 +231,8 @@ class UberConvNet(object):
 
     self.params["W1"] = weight_scale * np.random.randn(num_filters, C, filter_size, filter_size)
     self.params["b1"] = np.zeros(num_filters)
-    self.params["W2"] = weight_scale * np.random.randn(num_filters * H * W / 4, hidden_dim)
+    head_dim = num_filters if global_pool else num_filters * H * W / 4
+    self.params["W2"] = weight_scale * np.random.randn(head_dim, hidden_dim)
     self.params["b2"] = np.zeros(hidden_dim)
     self.params["gamma2"] = np.zeros(hidden_dim)
     self.params["beta2"] = np.zeros(hidden_dim)
@@ -188,6 +250,7 @@ class UberConvNet(object):
 
     Input / output: Same API as TwoLayerNet in fc_net.py.
     """
+    X = X.astype(self.dtype)
     W1, b1 = self.params['W1'], self.params['b1']
     W2, b2 = self.params['W2'], self.params['b2']
     gamma2, beta2 = self.params['gamma2'], self.params['beta2']
@@ -202,7 +265,18 @@ class UberConvNet(object):
 
     scores = None
 
-    (x1, cache1) = conv_relu_pool_forward(X, W1, b1, conv_param, pool_param)
+    if self.layout == 'NHWC':
+      (x1, cache1) = conv_relu_pool_nhwc_forward(X.transpose(0, 2, 3, 1), W1, b1,
+                                                 conv_param, pool_param)
+      if self.global_pool:
+        (x1, gap_cache) = global_avg_pool_nhwc_forward(x1)
+      else:
+        # W2 takes the pooled features in (C, H, W) order
+        x1 = x1.transpose(0, 3, 1, 2)
+    else:
+      (x1, cache1) = conv_relu_pool_forward(X, W1, b1, conv_param, pool_param)
+      if self.global_pool:
+        (x1, gap_cache) = global_avg_pool_forward(x1)
     (x2, cache2) = affine_batchnorm_relu_forward(x1, W2, b2, gamma2, beta2, self.bn_params2)
     (x3, cache3) = affine_forward(x2, W3, b3)
     scores = x3
@@ -218,7 +292,16 @@ class UberConvNet(object):
 
     (dx2, dw3, db3) = affine_backward(loss_dx, cache3)
     (dx1, dw2, db2, dgamma2, dbeta2) = affine_batchnorm_relu_backward(dx2, cache2)
-    (dx, dw1, db1) = conv_relu_pool_backward(dx1, cache1)
+    if self.layout == 'NHWC':
+      if self.global_pool:
+        dx1 = global_avg_pool_nhwc_backward(dx1, gap_cache)
+      else:
+        dx1 = dx1.transpose(0, 2, 3, 1)
+      (dx, dw1, db1) = conv_relu_pool_nhwc_backward(dx1, cache1)
+    else:
+      if self.global_pool:
+        dx1 = global_avg_pool_backward(dx1, gap_cache)
+      (dx, dw1, db1) = conv_relu_pool_backward(dx1, cache1)
 
     grads = {}
     grads["W1"] = dw1 + self.reg * W1
@@ -233,4 +316,39 @@ class UberConvNet(object):
     return loss, grads
 
 
+  def as_sequential(self):
+    """
+    Return a SequentialNet that computes the same loss as this network and
+    shares its params and bn_params2.
+    """
+    layers = _conv_head(self.params, self.layout, self.global_pool)
+    layers += [('affine_batchnorm_relu', ('W2', 'b2', 'gamma2', 'beta2'),
+                (self.bn_params2,)),
+               ('affine', ('W3', 'b3'), ())]
+    return SequentialNet(layers, self.params, reg=self.reg, dtype=self.dtype)
+
+
+def _conv_head(params, layout, global_pool):
+  """
+  Return the SequentialNet layers for the conv - relu - 2x2 max pool block of
+  ThreeLayerConvNet and UberConvNet, together with the global average pool or
+  the change of layout in front of the hidden affine layer.
+  """
+  filter_size = params['W1'].shape[2]
+  conv_param = {'stride': 1, 'pad': (filter_size - 1) / 2}
+  pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+  if layout == 'NHWC':
+    layers = [('transpose', (), ((0, 2, 3, 1),)),
+              ('conv_relu_pool_nhwc', ('W1', 'b1'), (conv_param, pool_param))]
+    if global_pool:
+      layers.append(('global_avg_pool_nhwc', (), ()))
+    else:
+      layers.append(('transpose', (), ((0, 3, 1, 2),)))
+  else:
+    layers = [('conv_relu_pool', ('W1', 'b1'), (conv_param, pool_param))]
+    if global_pool:
+      layers.append(('global_avg_pool', (), ()))
+  return layers
+
+
 pass
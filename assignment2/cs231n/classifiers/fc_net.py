@@ -2,6 +2,9 @@ import numpy as np
 
 from cs231n.layers import *
 from cs231n.layer_utils import *
+from cs231n.buffer_arena import BufferArena
+from cs231n.checkpointing import checkpoint_layers, snapshot_params
+from cs231n.classifiers.sequential import SequentialNet
 
 
 class TwoLayerNet(object):
@@ -124,6 +127,18 @@ class TwoLayerNet(object):
     return loss, grads
 
 
+  def as_sequential(self):
+    """
+    Return a SequentialNet that computes the same loss as this network and
+    shares its params.
+    """
+    layers = [('affine', ('W1', 'b1'), ()),
+              ('relu', (), ()),
+              ('affine', ('W2', 'b2'), ())]
+    return SequentialNet(layers, self.params, reg=self.reg,
+                         dtype=self.params['W1'].dtype)
+
+
 class FullyConnectedNet(object):
   """
   A fully-connected neural network with an arbitrary number of hidden layers,
@@ -134,7 +149,8 @@ class FullyConnectedNet(object):
   {affine - [batch norm] - relu - [dropout]} x (L - 1) - affine - softmax
   
   where batch normalization and dropout are optional, and the {...} block is
-  repeated L - 1 times.
+  repeated L - 1 times. Each {...} block is computed by the fused
+  affine_batchnorm_relu_dropout_forward kernel.
   
   Similar to the TwoLayerNet above, learnable parameters are stored in the
   self.params dictionary and will be learned using the Solver class.
@@ -142,7 +158,8 @@ class FullyConnectedNet(object):
 
   def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                dropout=0, use_batchnorm=False, reg=0.0,
-               weight_scale=1e-2, dtype=np.float32, seed=None):
+               weight_scale=1e-2, dtype=np.float32, seed=None,
+               use_arena=False, checkpoint=None):
     """
     Initialize a new FullyConnectedNet.
     
@@ -162,6 +179,18 @@ class FullyConnectedNet(object):
     - seed: If not None, then pass this random seed to the dropout layers. This
       will make the dropout layers deteriminstic so we can gradient check the
       model.
+    - use_arena: If True, the outputs and gradients of the affine and ReLU
+      layers are written into buffers of a BufferArena that are reused from
+      one call of loss to the next instead of being allocated on every call.
+      The scores and grads returned by loss are then only valid until the
+      next call.
+    - checkpoint: Segment policy for gradient checkpointing, as in
+      checkpoint_layers: None keeps the caches of all layers from the forward
+      to the backward pass; an integer k or 'sqrt' (k = sqrt(L)) keeps only
+      the input of every k-th layer and recomputes the other caches one
+      segment at a time during the backward pass. The layer outputs stay in
+      the arena with use_arena, so checkpointing then only saves the
+      batchnorm activations and masks.
     """
     self.use_batchnorm = use_batchnorm
     self.use_dropout = dropout > 0
@@ -169,6 +198,8 @@ class FullyConnectedNet(object):
     self.num_layers = 1 + len(hidden_dims)
     self.dtype = dtype
     self.params = {}
+    self.arena = BufferArena() if use_arena else None
+    self.checkpoint = checkpoint
 
     ############################################################################
     # TODO: Initialize the parameters of the network, storing all values in    #
@@ -197,12 +228,15 @@ class FullyConnectedNet(object):
 
     # When using dropout we need to pass a dropout_param dictionary to each
     # dropout layer so that the layer knows the dropout probability and the mode
-    # (train / test). You can pass the same dropout_param to each dropout layer.
-    self.dropout_param = {}
+    # (train / test). Each dropout layer gets its own dropout_param, and with it
+    # its own random number stream.
+    self.dropout_params = []
     if self.use_dropout:
-      self.dropout_param = {'mode': 'train', 'p': dropout}
+      self.dropout_params = [{'mode': 'train', 'p': dropout}
+                             for i in xrange(self.num_layers - 1)]
       if seed is not None:
-        self.dropout_param['seed'] = seed
+        for i, dropout_param in enumerate(self.dropout_params):
+          dropout_param['seed'] = seed + i
 
     # With batch normalization we need to keep track of running means and
     # variances, so we need to pass a special bn_param object to each batch
@@ -229,56 +263,49 @@ class FullyConnectedNet(object):
 
     # Set train/test mode for batchnorm params and dropout param since they
     # behave differently during training and testing.
-    if self.dropout_param is not None:
-      self.dropout_param['mode'] = mode
+    for dropout_param in self.dropout_params:
+      dropout_param['mode'] = mode
     if self.use_batchnorm:
       for bn_param in self.bn_params:
-        bn_param[mode] = mode
+        bn_param['mode'] = mode
 
     scores = None
     ############################################################################
     # TODO: Implement the forward pass for the fully-connected net, computing  #
     # the class scores for X and storing them in the scores variable.          #
     #                                                                          #
-    # When using dropout, you'll need to pass self.dropout_param to each       #
-    # dropout forward pass.                                                    #
+    # When using dropout, you'll need to pass self.dropout_params[0] to the    #
+    # first dropout forward pass, self.dropout_params[1] to the second, etc.   #
     #                                                                          #
     # When using batch normalization, you'll need to pass self.bn_params[0] to #
     # the forward pass for the first batch normalization layer, pass           #
     # self.bn_params[1] to the forward pass for the second batch normalization #
     # layer, etc.                                                              #
     ############################################################################
+    # With checkpointing only the inputs of the checkpoint layers are kept,
+    # together with snapshots of their segments' bn and dropout params, and
+    # the caches of the other layers are dropped except in the last segment,
+    # whose backward pass follows right away.
+    checkpointing = mode == 'train' and self.checkpoint is not None
+    if checkpointing:
+        starts = checkpoint_layers(self.num_layers, self.checkpoint)
+    checkpoints = {}
     X_i = X
     caches = []
     for layer in range(self.num_layers):
-        W_i = self.params['W%d' % (layer + 1)]
-        b_i = self.params['b%d' % (layer + 1)]
-
-        (affine_X, affine_cache) = affine_forward(X_i, W_i, b_i)
-
-        if layer != self.num_layers - 1:
-            if self.use_batchnorm:
-                gamma_i = self.params['gamma%d' % (layer + 1)]
-                beta_i = self.params['beta%d' % (layer + 1)]
-
-                (batchnorm_X, batchnorm_cache) = batchnorm_forward(affine_X, gamma_i, beta_i, self.bn_params[layer])
-            else:
-                (batchnorm_X, batchnorm_cache) = (affine_X, None)
-
-            (relu_X, relu_cache) = relu_forward(batchnorm_X)
+        bn_param, dropout_param = self._layer_params(layer)
+        if checkpointing:
+            if layer in starts:
+                checkpoints[layer] = (X_i, [])
+            checkpoints[max(checkpoints)][1].append(
+              (snapshot_params(bn_param), snapshot_params(dropout_param)))
 
-            if self.use_dropout:
-                (dropout_X, dropout_cache) = dropout_forward(relu_X, self.dropout_param)
-            else:
-                (dropout_X, dropout_cache) = (relu_X, None)
+        (X_i, cache) = self._layer_forward(layer, X_i, bn_param, dropout_param,
+                                           mode)
 
-            caches.append((affine_cache, batchnorm_cache, relu_cache, dropout_cache))
-
-            X_i = dropout_X
-        else:
-            caches.append((affine_cache, None, None, None))
-
-            X_i = affine_X
+        if checkpointing and layer < starts[-1]:
+            cache = None
+        caches.append(cache)
 
     scores = X_i
 
@@ -310,31 +337,38 @@ class FullyConnectedNet(object):
         W_i = self.params['W%d' % (layer + 1)]
         b_i = self.params['b%d' % (layer + 1)]
 
-        (affine_cache, batchnorm_cache, relu_cache, dropout_cache) = caches[layer]
+        if caches[layer] is None:
+            # Recompute the segment that ends with this layer
+            start = max(l for l in checkpoints if l <= layer)
+            x, params = checkpoints.pop(start)
+            for l, (bn_param, dropout_param) in zip(range(start, layer + 1), params):
+                (x, caches[l]) = self._layer_forward(l, x, bn_param, dropout_param,
+                                                     mode)
 
-        if layer != self.num_layers - 1:
-            if self.use_dropout:
-                dropout_dx = dropout_backward(loss_dx, dropout_cache)
-            else:
-                dropout_dx = loss_dx
+        cache = caches[layer]
+        caches[layer] = None
+        grad_buffers = self._affine_grad_buffers(layer, cache[0], W_i, b_i)
 
-            relu_dx = relu_backward(dropout_dx, relu_cache)
+        if layer != self.num_layers - 1:
+            (affine_dx, affine_dw, affine_db, dgamma, dbeta) = affine_batchnorm_relu_dropout_backward(
+              loss_dx, cache, out=grad_buffers)
 
             if self.use_batchnorm:
-                (batchnorm_dx, batchnorm_dgamma, batchnorm_dbeta) = batchnorm_backward_alt(relu_dx, batchnorm_cache)
-
-                grads['gamma%d' % (layer + 1)] = batchnorm_dgamma
-                grads['beta%d' % (layer + 1)] = batchnorm_dbeta
-            else:
-                batchnorm_dx = relu_dx
-
-            affine_dx, affine_dw, affine_db = affine_backward(batchnorm_dx, affine_cache)
-
+                grads['gamma%d' % (layer + 1)] = dgamma
+                grads['beta%d' % (layer + 1)] = dbeta
         else:
-            affine_dx, affine_dw, affine_db = affine_backward(loss_dx, affine_cache)
+            affine_dx, affine_dw, affine_db = affine_backward(
+              loss_dx, cache, out=grad_buffers)
 
-        grads['W%d' % (layer + 1)] = affine_dw + self.reg * W_i
-        grads['b%d' % (layer + 1)] = affine_db + self.reg * b_i
+        if self.arena is None:
+            grads['W%d' % (layer + 1)] = affine_dw + self.reg * W_i
+            grads['b%d' % (layer + 1)] = affine_db + self.reg * b_i
+        else:
+            grads['W%d' % (layer + 1)] = affine_dw
+            grads['b%d' % (layer + 1)] = affine_db
+            if self.reg != 0:
+                affine_dw += self.reg * W_i
+                affine_db += self.reg * b_i
 
         loss += 0.5 * self.reg * np.sum(W_i ** 2)
         loss += 0.5 * self.reg * np.sum(b_i ** 2)
@@ -346,3 +380,99 @@ class FullyConnectedNet(object):
     ############################################################################
 
     return loss, grads
+
+
+  def as_sequential(self):
+    """
+    Return a SequentialNet that computes the same loss as this network and
+    shares its params, bn_params and dropout_params. The arena and the
+    checkpoint policy are not used by the SequentialNet.
+    """
+    layers = []
+    for layer in range(self.num_layers):
+      names = ('W%d' % (layer + 1), 'b%d' % (layer + 1))
+      if layer == self.num_layers - 1:
+        layers.append(('affine', names, ()))
+        continue
+      if self.use_batchnorm:
+        names += ('gamma%d' % (layer + 1), 'beta%d' % (layer + 1))
+      else:
+        names += (None, None)
+      layers.append(('affine_batchnorm_relu_dropout', names,
+                     self._layer_params(layer)))
+    # Unlike the other models this one also regularizes the biases
+    reg_params = ['%s%d' % (k, layer + 1) for layer in range(self.num_layers)
+                  for k in ('W', 'b')]
+    return SequentialNet(layers, self.params, reg=self.reg,
+                         reg_params=reg_params, dtype=self.dtype)
+
+
+  def _layer_params(self, layer):
+    """
+    Return the (bn_param, dropout_param) of a layer; either is None if the
+    layer has no batch normalization or dropout.
+    """
+    if layer == self.num_layers - 1:
+      return None, None
+    bn_param = self.bn_params[layer] if self.use_batchnorm else None
+    dropout_param = None
+    if self.use_dropout:
+      dropout_param = self.dropout_params[layer]
+      # Create the random number generator now so that a snapshot of the
+      # dropout_param reproduces the masks of this pass
+      dropout_rng(dropout_param)
+    return bn_param, dropout_param
+
+
+  def _layer_forward(self, layer, x, bn_param, dropout_param, mode):
+    """
+    Run the forward pass of one layer.
+
+    Inputs:
+    - layer: Index of the layer.
+    - x: Input of the layer.
+    - bn_param, dropout_param: The params returned by _layer_params, or
+      snapshots of them to recompute the layer.
+    - mode: 'train' or 'test'; in test mode no cache is built.
+
+    Returns a tuple of:
+    - out: Output of the layer.
+    - cache: Cache for the backward pass of the layer.
+    """
+    W_i = self.params['W%d' % (layer + 1)]
+    b_i = self.params['b%d' % (layer + 1)]
+    out = self._buffer(layer, 'out', (x.shape[0], W_i.shape[1]))
+
+    if layer == self.num_layers - 1:
+      return affine_forward(x, W_i, b_i, out=out)
+
+    # Each hidden block runs as one fused kernel with a compact cache
+    gamma_i, beta_i = None, None
+    if self.use_batchnorm:
+      gamma_i = self.params['gamma%d' % (layer + 1)]
+      beta_i = self.params['beta%d' % (layer + 1)]
+    return affine_batchnorm_relu_dropout_forward(
+      x, W_i, b_i, gamma_i, beta_i, bn_param, dropout_param, out=out,
+      mode=mode)
+
+
+  def _buffer(self, layer, role, shape):
+    """
+    Return the arena buffer for a value of a layer, or None without an arena.
+    """
+    if self.arena is None:
+      return None
+    return self.arena.get(layer, role, shape, self.dtype)
+
+
+  def _affine_grad_buffers(self, layer, x, w, b):
+    """
+    Return the (dx, dw, db) arena buffers for the backward pass of the affine
+    part of a layer with input x, weights w and biases b, or None without an
+    arena.
+    """
+    if self.arena is None:
+      return None
+    return (self._buffer(layer, 'affine_dx', x.shape),
+            self._buffer(layer, 'affine_dw', w.shape),
+            self._buffer(layer, 'affine_db', b.shape))
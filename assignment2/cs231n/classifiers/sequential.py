@@ -0,0 +1,130 @@
+import functools
+
+import numpy as np
+
+from cs231n import layer_utils
+from cs231n.layers import softmax_loss
+from cs231n.tape import Tape
+
+
+# Layers whose forward function takes the mode as a keyword argument, since
+# they may have no dictionary in args to carry it (such as an
+# affine_batchnorm_relu_dropout layer without batchnorm and dropout)
+MODE_LAYERS = ('affine_batchnorm_relu_dropout',)
+
+
+class SequentialNet(object):
+  """
+  A network given as a list of layers that are applied one after the other,
+  followed by a loss function.
+
+  Each layer is a tuple (layer, param_names, args):
+  - layer: The name of a pair of layer functions, such as 'affine' for
+    affine_forward and affine_backward, which are looked up in layer_utils
+    (and with it in layers and fast_layers); or a tuple (forward, backward).
+  - param_names: Keys of self.params of the parameters that the forward
+    function takes after its input, in order. None passes None for an unused
+    parameter, such as gamma of an affine_batchnorm_relu_dropout layer
+    without batch normalization.
+  - args: Further arguments that the forward function takes after the
+    parameters, such as conv_param or bn_param. The 'mode' of every
+    dictionary in args that has one is set to 'train' or 'test' by loss, and
+    the forward functions of layers named in MODE_LAYERS are also passed the
+    mode as a keyword argument.
+
+  The backward function must return the gradient of the input followed by
+  those of the parameters. A layer that only reshapes its input can have no
+  parameters; ThreeLayerConvNet for example is
+
+  [('conv_relu_pool', ('W1', 'b1'), (conv_param, pool_param)),
+   ('affine_relu', ('W2', 'b2'), ()),
+   ('affine', ('W3', 'b3'), ())]
+
+  The classifiers in fc_net.py and cnn.py can be converted with their
+  as_sequential method; the result shares the params dictionary (and the
+  bn_params and dropout_params) with the original model.
+
+  Training-time passes run through a Tape, so that the cache of each layer
+  and the gradient of its output are released as soon as its backward pass
+  has used them. The bytes of the caches and gradients that are live at the
+  same time are counted, and the largest count of the last call of loss is
+  kept in self.peak_bytes.
+  """
+
+  def __init__(self, layers, params, reg=0.0, reg_params=None,
+               dtype=np.float32, loss_function=softmax_loss):
+    """
+    Initialize a new network.
+
+    Inputs:
+    - layers: List of (layer, param_names, args) tuples as described above.
+    - params: Dictionary mapping parameter names to numpy arrays.
+    - reg: Scalar giving L2 regularization strength.
+    - reg_params: Names of the parameters that are regularized; by default
+      all parameters whose names start with 'W'.
+    - dtype: numpy datatype to use for computation.
+    - loss_function: Function taking (scores, y) and returning a tuple of the
+      loss and its gradient with respect to scores.
+    """
+    self.layers = []
+    for layer, param_names, args in layers:
+      takes_mode = False
+      if isinstance(layer, basestring):
+        takes_mode = layer in MODE_LAYERS
+        layer = (getattr(layer_utils, '%s_forward' % layer),
+                 getattr(layer_utils, '%s_backward' % layer))
+      self.layers.append((layer, tuple(param_names), tuple(args), takes_mode))
+    self.params = params
+    self.reg = reg
+    if reg_params is None:
+      reg_params = [k for k in params if k.startswith('W')]
+    self.reg_params = sorted(reg_params)
+    self.dtype = dtype
+    self.loss_function = loss_function
+    self.peak_bytes = 0
+
+
+  def loss(self, X, y=None):
+    """
+    Compute loss and gradient for a minibatch of data.
+
+    Input / output: Same as TwoLayerNet in fc_net.py.
+    """
+    X = X.astype(self.dtype)
+    mode = 'test' if y is None else 'train'
+    for _, _, args, _ in self.layers:
+      for arg in args:
+        if isinstance(arg, dict) and 'mode' in arg:
+          arg['mode'] = mode
+
+    # Test-time passes drop every cache right away
+    tape = Tape(exclude=self.params.values()) if mode == 'train' else None
+    x = X
+    for i, ((forward, backward), param_names, args, takes_mode) in enumerate(
+        self.layers):
+      params = [self.params[k] if k is not None else None for k in param_names]
+      if takes_mode:
+        forward = functools.partial(forward, mode=mode)
+      if tape is None:
+        x, _ = forward(x, *(params + list(args)))
+      else:
+        x = tape.run(forward, backward, i + 1, (i,) + param_names,
+                     x, *(params + list(args)))
+    scores = x
+
+    if mode == 'test':
+      return scores
+
+    loss, dscores = self.loss_function(scores, y)
+    douts = {len(self.layers): dscores}
+    del x, scores, dscores
+    grads = tape.backward(douts)
+    self.peak_bytes = tape.peak_bytes
+
+    grads.pop(0, None)
+    for k in self.reg_params:
+      w = self.params[k]
+      loss += 0.5 * self.reg * np.sum(w ** 2)
+      grads[k] = grads[k] + self.reg * w
+
+    return loss, grads
@@ -1,11 +1,44 @@
+import json
+import multiprocessing
+import os
+import time
+
 import numpy as np
-try:
-  from cs231n.im2col_cython import col2im_cython, im2col_cython
-  from cs231n.im2col_cython import col2im_6d_cython
-except ImportError:
-  print 'run the following from the cs231n directory and try again:'
-  print 'python setup.py build_ext --inplace'
-  print 'You may also need to restart your iPython kernel'
+
+from cs231n import dtype_policy
+
+# The im2col / col2im kernels come from the Cython extension if it is built and
+# from the slower pure-numpy versions in im2col.py otherwise; set the
+# environment variable CS231N_BACKEND=numpy to use the numpy versions anyway.
+# BACKEND records the choice.
+BACKEND = os.environ.get('CS231N_BACKEND', 'cython')
+if BACKEND == 'cython':
+  try:
+    from cs231n.im2col_cython import col2im_cython, im2col_cython
+    from cs231n.im2col_cython import col2im_6d_cython, col2im_nhwc_cython
+    from cs231n.im2col_cython import bias_relu_pool_cython, relu_pool_backward_cython
+    from cs231n.im2col_cython import max_pool_cython, max_pool_backward_cython
+    from cs231n.im2col_cython import max_pool_nhwc_cython
+    from cs231n.im2col_cython import max_pool_nhwc_backward_cython
+  except ImportError:
+    print 'im2col_cython is not built; falling back to the numpy backend.'
+    print 'For faster convolutions run the following from the cs231n directory:'
+    print 'python setup.py build_ext --inplace'
+    print 'You may also need to restart your iPython kernel'
+    BACKEND = 'numpy'
+if BACKEND == 'numpy':
+  from cs231n.im2col import im2col_numpy as im2col_cython
+  from cs231n.im2col import col2im_numpy as col2im_cython
+  from cs231n.im2col import col2im_6d_numpy as col2im_6d_cython
+  from cs231n.im2col import col2im_nhwc_numpy as col2im_nhwc_cython
+  from cs231n.im2col import bias_relu_pool_numpy as bias_relu_pool_cython
+  from cs231n.im2col import relu_pool_backward_numpy as relu_pool_backward_cython
+  from cs231n.im2col import max_pool_numpy as max_pool_cython
+  from cs231n.im2col import max_pool_backward_numpy as max_pool_backward_cython
+  from cs231n.im2col import max_pool_nhwc_numpy as max_pool_nhwc_cython
+  from cs231n.im2col import max_pool_nhwc_backward_numpy as max_pool_nhwc_backward_cython
+elif BACKEND != 'cython':
+  raise ValueError('Unknown CS231N_BACKEND "%s"' % BACKEND)
 
 from cs231n.im2col import *
 
@@ -39,14 +72,12 @@ def conv_forward_im2col(x, w, b, conv_param):
   return out, cache
 
 
-def conv_forward_strides(x, w, b, conv_param):
+def _im2col_strides(x, HH, WW, stride, pad):
+  """
+  Build the im2col matrix of shape (C * HH * WW, N * out_h * out_w) of the
+  padded input by picking clever strides. Returns (x_cols, out_h, out_w).
+  """
   N, C, H, W = x.shape
-  F, _, HH, WW = w.shape
-  stride, pad = conv_param['stride'], conv_param['pad']
-
-  # Check dimensions
-  assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
-  assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
 
   # Pad the input
   p = pad
@@ -66,24 +97,49 @@ def conv_forward_strides(x, w, b, conv_param):
                 shape=shape, strides=strides)
   x_cols = np.ascontiguousarray(x_stride)
   x_cols.shape = (C * HH * WW, N * out_h * out_w)
+  return x_cols, out_h, out_w
+
+
+def conv_forward_strides(x, w, b, conv_param, out=None):
+  """
+  A fast implementation of the forward pass for a convolutional layer that
+  builds the im2col matrix with stride tricks. If out is given, the output is
+  written into it instead of a new array; it must have shape
+  (N, F, out_h, out_w) and the dtype of the result.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  # Check dimensions
+  assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
+  assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
+
+  x_cols, out_h, out_w = _im2col_strides(x, HH, WW, stride, pad)
 
   # Now all our convolutions are a big matrix multiply
   res = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
 
   # Reshape the output
   res.shape = (F, N, out_h, out_w)
-  out = res.transpose(1, 0, 2, 3)
 
   # Be nice and return a contiguous array
   # The old version of conv_forward_fast doesn't do this, so for a fair
   # comparison we won't either
-  out = np.ascontiguousarray(out)
+  if out is None:
+    out = np.ascontiguousarray(res.transpose(1, 0, 2, 3))
+  else:
+    np.copyto(out, res.transpose(1, 0, 2, 3))
 
   cache = (x, w, b, conv_param, x_cols)
   return out, cache
   
 
-def conv_backward_strides(dout, cache):
+def conv_backward_strides(dout, cache, out=None):
+  """
+  Backward pass for conv_forward_strides. If out is given, it is a tuple
+  (dx, dw, db) of arrays that the gradients are written into.
+  """
   x, w, b, conv_param, x_cols = cache
   stride, pad = conv_param['stride'], conv_param['pad']
 
@@ -91,14 +147,19 @@ def conv_backward_strides(dout, cache):
   F, _, HH, WW = w.shape
   _, _, out_h, out_w = dout.shape
 
-  db = np.sum(dout, axis=(0, 2, 3))
-
   dout_reshaped = dout.transpose(1, 0, 2, 3).reshape(F, -1)
-  dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
-
   dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
   dx_cols.shape = (C, HH, WW, N, out_h, out_w)
-  dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+
+  if out is None:
+    db = np.sum(dout, axis=(0, 2, 3))
+    dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+    dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+  else:
+    dx, dw, db = out
+    np.sum(dout, axis=(0, 2, 3), out=db)
+    np.dot(dout_reshaped, x_cols.T, out=dw.reshape(F, -1))
+    np.copyto(dx, col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride))
 
   return dx, dw, db
 
@@ -125,28 +186,710 @@ def conv_backward_im2col(dout, cache):
   return dx, dw, db
 
 
-conv_forward_fast = conv_forward_strides
-conv_backward_fast = conv_backward_strides
+def _fft_len(n):
+  """
+  Smallest integer >= n whose only prime factors are 2, 3 and 5, for which
+  numpy's FFT is fast.
+  """
+  while True:
+    m = n
+    for p in (2, 3, 5):
+      while m % p == 0:
+        m /= p
+    if m == 1:
+      return n
+    n += 1
+
+
+def conv_forward_fft(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a convolutional layer based
+  on the FFT, which does not build the im2col matrix and whose cost does not
+  grow with the filter size. Convolutions with a stride other than 1 fall back
+  to conv_forward_strides.
+
+  The spectra of the filters are computed once per call and shared by all
+  images of the minibatch; the spectra of the input and filters are cached
+  for the backward pass.
+  """
+  stride, pad = conv_param['stride'], conv_param['pad']
+  if stride != 1:
+    out, cache = conv_forward_strides(x, w, b, conv_param)
+    return out, ('strides', cache)
+
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+  out_h, out_w = Hp - HH + 1, Wp - WW + 1
+  s = (_fft_len(Hp), _fft_len(Wp))
+
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+  x_hat = np.fft.rfft2(x_padded, s)
+  freq_shape = x_hat.shape[2:]
+  K = freq_shape[0] * freq_shape[1]
+
+  # Spectra are kept as contiguous (K, rows, cols) stacks of matrices, one per
+  # frequency, so that sums over channels are batched matrix multiplies.
+  x_k = np.ascontiguousarray(x_hat.reshape(N, C, K).transpose(2, 0, 1))
+  w_k = np.ascontiguousarray(np.fft.rfft2(w, s).reshape(F, C, K).transpose(2, 0, 1))
+
+  # Cross-correlation is a product with the conjugate filter spectrum
+  out_hat = np.matmul(x_k, w_k.conj().transpose(0, 2, 1))
+  out_hat = out_hat.transpose(1, 2, 0).reshape(N, F, *freq_shape)
+
+  out = np.fft.irfft2(out_hat, s)[:, :, :out_h, :out_w]
+  out += b.reshape(1, F, 1, 1)
+  out = out.astype(x.dtype)
+
+  cache = ('fft', (x.shape, w.shape, conv_param, x_k, w_k, s, freq_shape))
+  return out, cache
+
+
+def conv_backward_fft(dout, cache):
+  """
+  Backward pass for conv_forward_fft, using the cached spectra of the input
+  and filters.
+  """
+  kind, cache = cache
+  if kind == 'strides':
+    return conv_backward_strides(dout, cache)
+
+  x_shape, w_shape, conv_param, x_k, w_k, s, freq_shape = cache
+  pad = conv_param['pad']
+  N, C, H, W = x_shape
+  F, _, HH, WW = w_shape
+  K = freq_shape[0] * freq_shape[1]
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  d_hat = np.fft.rfft2(dout, s)
+  d_k = np.ascontiguousarray(d_hat.reshape(N, F, K).transpose(2, 0, 1))
+
+  # dx is the full convolution of dout with the filters
+  dx_hat = np.matmul(d_k, w_k).transpose(1, 2, 0).reshape(N, C, *freq_shape)
+  dx = np.fft.irfft2(dx_hat, s)[:, :, pad:pad + H, pad:pad + W]
+
+  # dw is the cross-correlation of the padded input with dout, summed over
+  # the minibatch
+  dw_hat = np.matmul(d_k.conj().transpose(0, 2, 1), x_k)
+  dw_hat = dw_hat.transpose(1, 2, 0).reshape(F, C, *freq_shape)
+  dw = np.fft.irfft2(dw_hat, s)[:, :, :HH, :WW]
+
+  return dx.astype(dout.dtype), dw.astype(dout.dtype), db
+
+
+# Winograd F(2x2, 3x3) transforms (Lavin & Gray, 2015). A tile of 4x4 inputs
+# d and a 3x3 filter g give 2x2 outputs A^T [(G g G^T) * (B^T d B)] A. The 2D
+# transforms are applied as Kronecker products to flattened tiles.
+_WINOGRAD_BT = np.array([[1, 0, -1, 0],
+                         [0, 1, 1, 0],
+                         [0, -1, 1, 0],
+                         [0, 1, 0, -1]], dtype=np.float64)
+_WINOGRAD_G = np.array([[1, 0, 0],
+                        [0.5, 0.5, 0.5],
+                        [0.5, -0.5, 0.5],
+                        [0, 0, 1]], dtype=np.float64)
+_WINOGRAD_AT = np.array([[1, 1, 1, 0],
+                         [0, 1, -1, -1]], dtype=np.float64)
+_WINOGRAD_BT2 = np.kron(_WINOGRAD_BT, _WINOGRAD_BT)
+_WINOGRAD_G2 = np.kron(_WINOGRAD_G, _WINOGRAD_G)
+_WINOGRAD_AT2 = np.kron(_WINOGRAD_AT, _WINOGRAD_AT)
+
+
+def winograd_filter_transform(w):
+  """
+  Transform 3x3 filters for conv_forward_winograd.
+
+  Inputs:
+  - w: Filters of shape (F, C, 3, 3)
+
+  Returns:
+  - U: Transformed filters G w G^T of shape (16, C, F)
+  """
+  F, C, HH, WW = w.shape
+  assert (HH, WW) == (3, 3), 'winograd needs 3x3 filters'
+  U = np.dot(_WINOGRAD_G2.astype(w.dtype), w.reshape(F * C, 9).T)
+  return np.ascontiguousarray(U.reshape(16, F, C).transpose(0, 2, 1))
+
+
+def conv_forward_winograd(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a 3x3, stride 1
+  convolutional layer using Winograd's minimal filtering algorithm F(2x2, 3x3),
+  which needs 16 instead of 36 multiplies for every 2x2 block of outputs.
+  Other convolutions fall back to conv_forward_strides.
+
+  If conv_param contains 'winograd_filters', it must be a tuple (w_cached, U)
+  with U = winograd_filter_transform(w_cached); U is reused when w is the same
+  array as w_cached, so that the filter transform can be computed once while
+  the weights do not change. Weights that are modified in place keep their
+  identity, so the entry must be dropped after such an edit.
+  """
+  F, C, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  if stride != 1 or (HH, WW) != (3, 3):
+    out, cache = conv_forward_strides(x, w, b, conv_param)
+    return out, ('strides', cache)
+
+  N, _, H, W = x.shape
+  out_h, out_w = H + 2 * pad - 2, W + 2 * pad - 2
+  th, tw = (out_h + 1) / 2, (out_w + 1) / 2
+  P = N * th * tw
+
+  filters = conv_param.get('winograd_filters')
+  if filters is not None and filters[0] is w:
+    U = filters[1]
+  else:
+    U = winograd_filter_transform(w)
+
+  # Pad so that the 4x4 input tiles, which overlap by 2, cover the input
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, 2 * th + 2 - H - pad),
+                        (pad, 2 * tw + 2 - W - pad)), mode='constant')
+  sN, sC, sH, sW = x_padded.strides
+  tiles = np.lib.stride_tricks.as_strided(x_padded,
+                shape=(4, 4, N, th, tw, C),
+                strides=(sH, sW, sN, 2 * sH, 2 * sW, sC))
+  tiles = np.ascontiguousarray(tiles).reshape(16, P * C)
+
+  # V = B^T d B for all tiles, then one (P, C) x (C, F) multiply per element
+  V = np.dot(_WINOGRAD_BT2.astype(x.dtype), tiles).reshape(16, P, C)
+  M = np.matmul(V, U)
+
+  Y = np.dot(_WINOGRAD_AT2.astype(x.dtype), M.reshape(16, P * F))
+  Y = Y.reshape(2, 2, N, th, tw, F).transpose(2, 5, 3, 0, 4, 1)
+  out = Y.reshape(N, F, 2 * th, 2 * tw)[:, :, :out_h, :out_w]
+  out = out + b.reshape(1, F, 1, 1)
+
+  cache = ('winograd', (x.shape, conv_param, V, U))
+  return out, cache
+
+
+def conv_backward_winograd(dout, cache):
+  """
+  Backward pass for conv_forward_winograd.
+  """
+  kind, cache = cache
+  if kind == 'strides':
+    return conv_backward_strides(dout, cache)
+
+  x_shape, conv_param, V, U = cache
+  pad = conv_param['pad']
+  N, C, H, W = x_shape
+  _, F, out_h, out_w = dout.shape
+  th, tw = (out_h + 1) / 2, (out_w + 1) / 2
+  P = N * th * tw
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  dY = np.zeros((N, F, 2 * th, 2 * tw), dtype=dout.dtype)
+  dY[:, :, :out_h, :out_w] = dout
+  dY = dY.reshape(N, F, th, 2, tw, 2).transpose(3, 5, 0, 2, 4, 1)
+  dY = np.ascontiguousarray(dY).reshape(4, P * F)
+  dM = np.dot(_WINOGRAD_AT2.T.astype(dout.dtype), dY).reshape(16, P, F)
+
+  # dw = G^T dU G, where dU sums the elementwise products over all tiles
+  dU = np.matmul(V.transpose(0, 2, 1), dM)
+  dw = np.dot(_WINOGRAD_G2.T.astype(dout.dtype), dU.reshape(16, C * F))
+  dw = dw.reshape(3, 3, C, F).transpose(3, 2, 0, 1)
+
+  # dx: bring the tile gradients back with B and add up the overlapping tiles
+  dV = np.matmul(dM, U.transpose(0, 2, 1))
+  dtiles = np.dot(_WINOGRAD_BT2.T.astype(dout.dtype), dV.reshape(16, P * C))
+  dtiles = dtiles.reshape(2, 2, 2, 2, N, th, tw, C)
+  dx_padded = np.zeros((N, C, th + 1, 2, tw + 1, 2), dtype=dout.dtype)
+  for i in xrange(2):
+    for j in xrange(2):
+      dx_padded[:, :, i:i + th, :, j:j + tw, :] += (
+        dtiles[i, :, j].transpose(2, 5, 3, 0, 4, 1))
+  dx_padded = dx_padded.reshape(N, C, 2 * th + 2, 2 * tw + 2)
+  dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+
+  return np.ascontiguousarray(dx), np.ascontiguousarray(dw), db
+
+
+def depthwise_conv_forward(x, w, b, conv_param):
+  """
+  Forward pass for a depthwise convolutional layer, which convolves each input
+  channel with its own filter, so that it costs HH * WW instead of
+  C * HH * WW multiply-adds per output value.
+
+  Inputs:
+  - x: Input data of shape (N, C, H, W)
+  - w: Filter weights of shape (C, 1, HH, WW)
+  - b: Biases, of shape (C,)
+  - conv_param: A dictionary with the keys 'stride' and 'pad'.
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, C, H', W')
+  - cache: (x_padded, w, conv_param)
+  """
+  N, C, H, W = x.shape
+  _, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  out_h = (H + 2 * pad - HH) / stride + 1
+  out_w = (W + 2 * pad - WW) / stride + 1
+
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+
+  # One multiply-add over the whole minibatch for each filter tap
+  out = np.empty((N, C, out_h, out_w), dtype=np.result_type(x, w, b))
+  out[...] = b.reshape(1, C, 1, 1)
+  for i in xrange(HH):
+    for j in xrange(WW):
+      window = x_padded[:, :, i:i + stride * out_h:stride, j:j + stride * out_w:stride]
+      out += window * w[:, 0, i, j].reshape(1, C, 1, 1)
+
+  cache = (x_padded, w, conv_param)
+  return out, cache
+
+
+def depthwise_conv_backward(dout, cache):
+  """
+  Backward pass for a depthwise convolutional layer.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, C, H', W')
+  - cache: (x_padded, w, conv_param) from depthwise_conv_forward
+
+  Returns a tuple of:
+  - dx: Gradient with respect to x
+  - dw: Gradient with respect to w
+  - db: Gradient with respect to b
+  """
+  x_padded, w, conv_param = cache
+  stride, pad = conv_param['stride'], conv_param['pad']
+  N, C, out_h, out_w = dout.shape
+  _, _, HH, WW = w.shape
+
+  db = np.sum(dout, axis=(0, 2, 3))
+  dw = np.empty_like(w)
+  dx_padded = np.zeros_like(x_padded)
+  for i in xrange(HH):
+    for j in xrange(WW):
+      window = (slice(None), slice(None),
+                slice(i, i + stride * out_h, stride),
+                slice(j, j + stride * out_w, stride))
+      dw[:, 0, i, j] = np.sum(x_padded[window] * dout, axis=(0, 2, 3))
+      dx_padded[window] += dout * w[:, 0, i, j].reshape(1, C, 1, 1)
+
+  H, W = x_padded.shape[2] - 2 * pad, x_padded.shape[3] - 2 * pad
+  dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+  return dx, dw, db
+
+
+def pointwise_conv_forward(x, w, b):
+  """
+  Forward pass for a pointwise (1x1) convolutional layer. This is a single
+  (F, C) x (C, H * W) matrix multiply per image on x as it is laid out in
+  memory, with no im2col and no transposes.
+
+  Inputs:
+  - x: Input data of shape (N, C, H, W)
+  - w: Filter weights of shape (F, C, 1, 1)
+  - b: Biases, of shape (F,)
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, F, H, W)
+  - cache: (x, w)
+  """
+  N, C, H, W = x.shape
+  F = w.shape[0]
+  out = np.matmul(w.reshape(F, C), x.reshape(N, C, H * W))
+  out += b.reshape(1, F, 1)
+  out.shape = (N, F, H, W)
+  cache = (x, w)
+  return out, cache
+
+
+def pointwise_conv_backward(dout, cache):
+  """
+  Backward pass for a pointwise (1x1) convolutional layer.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, F, H, W)
+  - cache: (x, w) from pointwise_conv_forward
+
+  Returns a tuple of:
+  - dx: Gradient with respect to x
+  - dw: Gradient with respect to w
+  - db: Gradient with respect to b
+  """
+  x, w = cache
+  N, C, H, W = x.shape
+  F = w.shape[0]
+  dout_flat = dout.reshape(N, F, H * W)
+
+  db = np.sum(dout, axis=(0, 2, 3))
+  # Summing the per-image products over the minibatch is one GEMM over the
+  # (N, H * W) pixels
+  dw = np.tensordot(dout_flat, x.reshape(N, C, H * W), axes=([0, 2], [0, 2]))
+  dw = dw.reshape(w.shape)
+  dx = np.matmul(w.reshape(F, C).T, dout_flat).reshape(x.shape)
+  return dx, dw, db
+
+
+def conv_forward_pointwise(x, w, b, conv_param):
+  """
+  conv_forward_fast method for 1x1 convolutions with stride 1 and no padding,
+  using pointwise_conv_forward. Other convolutions fall back to
+  conv_forward_strides.
+  """
+  if w.shape[2:] != (1, 1) or conv_param['stride'] != 1 or conv_param['pad'] != 0:
+    out, cache = conv_forward_strides(x, w, b, conv_param)
+    return out, ('strides', cache)
+  out, cache = pointwise_conv_forward(x, w, b)
+  return out, ('pointwise', cache)
+
+
+def conv_backward_pointwise(dout, cache):
+  """
+  Backward pass for conv_forward_pointwise.
+  """
+  kind, cache = cache
+  if kind == 'strides':
+    return conv_backward_strides(dout, cache)
+  return pointwise_conv_backward(dout, cache)
+
+
+# Default workspace of conv_forward_chunked in bytes
+CONV_WORKSPACE_BYTES = 64 << 20
+
+
+def conv_forward_chunked(x, w, b, conv_param):
+  """
+  A memory-bounded version of conv_forward_strides that processes the batch
+  in chunks, so that the im2col matrix of one chunk fits into a workspace of
+  conv_param['workspace_bytes'] bytes (default CONV_WORKSPACE_BYTES; at least
+  one image per chunk).
+
+  If conv_param['recompute'] is True (the default) the im2col matrices are
+  dropped after the forward pass and rebuilt chunk by chunk in the backward
+  pass, so the cache holds no more than x itself. This trades one extra
+  im2col per chunk for the C * HH * WW * out_h * out_w values per image that
+  conv_forward_strides keeps until the backward pass. With recompute False the
+  cache keeps the im2col matrices of all chunks, which only bounds the
+  transient memory of the forward pass.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  workspace_bytes = conv_param.get('workspace_bytes', CONV_WORKSPACE_BYTES)
+  recompute = conv_param.get('recompute', True)
+
+  out_h = (H + 2 * pad - HH) / stride + 1
+  out_w = (W + 2 * pad - WW) / stride + 1
+  cols_bytes = C * HH * WW * out_h * out_w * x.itemsize
+  chunk = int(max(1, min(N, workspace_bytes // cols_bytes)))
+
+  w_rows = w.reshape(F, -1)
+  out = np.empty((N, F, out_h, out_w), dtype=np.result_type(x, w, b))
+  cols = []
+  for i in xrange(0, N, chunk):
+    x_cols, _, _ = _im2col_strides(x[i:i + chunk], HH, WW, stride, pad)
+    res = w_rows.dot(x_cols)
+    res += b.reshape(-1, 1)
+    res.shape = (F, -1, out_h, out_w)
+    out[i:i + chunk] = res.transpose(1, 0, 2, 3)
+    if not recompute:
+      cols.append(x_cols)
+
+  cache = (x, w, b, conv_param, chunk, None if recompute else cols)
+  return out, cache
+
+
+def conv_backward_chunked(dout, cache):
+  """
+  Backward pass for conv_forward_chunked.
+  """
+  x, w, b, conv_param, chunk, cols = cache
+  stride, pad = conv_param['stride'], conv_param['pad']
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  _, _, out_h, out_w = dout.shape
+
+  w_rows = w.reshape(F, -1)
+  db = np.sum(dout, axis=(0, 2, 3))
+  dw = np.zeros((F, C * HH * WW), dtype=np.result_type(dout, x))
+  dx = np.empty(x.shape, dtype=np.result_type(dout, w))
+  for k, i in enumerate(xrange(0, N, chunk)):
+    if cols is None:
+      x_cols, _, _ = _im2col_strides(x[i:i + chunk], HH, WW, stride, pad)
+    else:
+      x_cols = cols[k]
+    n = x_cols.shape[1] / (out_h * out_w)
+    dout_rows = dout[i:i + chunk].transpose(1, 0, 2, 3).reshape(F, -1)
+    dw += dout_rows.dot(x_cols.T)
+    dx_cols = w_rows.T.dot(dout_rows)
+    dx_cols.shape = (C, HH, WW, n, out_h, out_w)
+    dx[i:i + chunk] = col2im_6d_cython(dx_cols, n, C, H, W, HH, WW, pad, stride)
+
+  return dx, dw.reshape(w.shape), db
+
+
+# Convolution implementations selected by conv_param['method'] in
+# conv_forward_fast; all of them share the conv_param format.
+CONV_METHODS = {
+  'strides': (conv_forward_strides, conv_backward_strides),
+  'im2col': (conv_forward_im2col, conv_backward_im2col),
+  'fft': (conv_forward_fft, conv_backward_fft),
+  'winograd': (conv_forward_winograd, conv_backward_winograd),
+  'pointwise': (conv_forward_pointwise, conv_backward_pointwise),
+  'chunked': (conv_forward_chunked, conv_backward_chunked),
+}
+
+
+def conv_method_applies(method, x, w, conv_param):
+  """
+  Whether a method of CONV_METHODS computes a convolution of x with filters w
+  and parameters conv_param itself, rather than failing or falling back to
+  'strides'.
+  """
+  H, W = x.shape[2:]
+  HH, WW = w.shape[2:]
+  stride, pad = conv_param['stride'], conv_param['pad']
+  if method == 'im2col':
+    return (H + 2 * pad - HH) % stride == 0 and (W + 2 * pad - WW) % stride == 0
+  if method == 'fft':
+    return stride == 1
+  if method == 'winograd':
+    return stride == 1 and (HH, WW) == (3, 3)
+  if method == 'pointwise':
+    return stride == 1 and pad == 0 and (HH, WW) == (1, 1)
+  return method in CONV_METHODS
+
+
+class ConvAutotuner(object):
+  """
+  Picks the fastest method of CONV_METHODS for each convolution signature
+  (N, C, H, W, F, HH, WW, stride, pad, dtype, backend, threads), where
+  backend is BACKEND and threads the number of OpenMP threads of the kernels.
+
+  The first time a signature is seen, every applicable method is run forward
+  and backward on the actual inputs and the one with the shortest best time
+  wins. Decisions can be stored in a JSON file, so that later processes reuse
+  them without timing anything; delete the file to tune again, for example on
+  a different machine.
+
+  Example usage:
+
+  tuner = ConvAutotuner('conv_autotune.json')
+  method = tuner.choose(x, w, b, conv_param)
+  """
+
+  def __init__(self, cache_file=None, repeats=2):
+    """
+    Inputs:
+    - cache_file: Path of the JSON decision cache, or None to keep decisions
+      in memory only.
+    - repeats: Number of timed forward / backward runs of each method.
+    """
+    self.cache_file = cache_file
+    self.repeats = repeats
+    self.decisions = None
+    self.timings = {}
+
+
+  def signature(self, x, w, conv_param):
+    """ The key of a convolution in the decision cache. """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    return '%d,%d,%d,%d,%d,%d,%d,%d,%d,%s,%s,%d' % (
+        N, C, H, W, F, HH, WW, conv_param['stride'], conv_param['pad'],
+        np.dtype(x.dtype).name, BACKEND, _num_threads())
+
+
+  def choose(self, x, w, b, conv_param):
+    """
+    Return the name of the fastest method for this convolution, tuning it
+    first if its signature has not been seen.
+    """
+    if self.decisions is None:
+      self.decisions = self._load()
+    key = self.signature(x, w, conv_param)
+    method = self.decisions.get(key)
+    if method not in CONV_METHODS:
+      method = self.tune(x, w, b, conv_param)
+      self.decisions[key] = method
+      self._save()
+    return method
+
+
+  def tune(self, x, w, b, conv_param):
+    """
+    Time all applicable methods on the given convolution and return the name
+    of the fastest; the best time of each method in seconds is recorded in
+    self.timings under the signature of the convolution.
+    """
+    params = {'stride': conv_param['stride'], 'pad': conv_param['pad']}
+    # 'chunked' trades speed for memory, so it is only used on request
+    methods = [m for m in sorted(CONV_METHODS) if m != 'chunked'
+               and conv_method_applies(m, x, w, params)]
+    if len(methods) == 1:
+      return methods[0]
+
+    timings = {}
+    for method in methods:
+      forward, backward = CONV_METHODS[method]
+      best = None
+      for _ in xrange(self.repeats):
+        start = time.time()
+        out, cache = forward(x, w, b, params)
+        backward(out, cache)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+      timings[method] = best
+    self.timings[self.signature(x, w, conv_param)] = timings
+    return min(timings, key=timings.get)
+
+
+  def _load(self):
+    if self.cache_file is None or not os.path.isfile(self.cache_file):
+      return {}
+    try:
+      with open(self.cache_file, 'r') as f:
+        return dict(json.load(f)['decisions'])
+    except (IOError, ValueError, KeyError, TypeError):
+      # An unreadable cache only means that we tune again
+      return {}
+
+
+  def _save(self):
+    if self.cache_file is None:
+      return
+    try:
+      directory = os.path.dirname(os.path.abspath(self.cache_file))
+      if not os.path.isdir(directory):
+        os.makedirs(directory)
+      # Write to a temporary file first so that concurrent processes never
+      # read a half-written cache
+      tmp_file = '%s.%d.tmp' % (self.cache_file, os.getpid())
+      with open(tmp_file, 'w') as f:
+        json.dump({'decisions': self.decisions}, f, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+      os.rename(tmp_file, self.cache_file)
+    except (IOError, OSError):
+      pass
+
+
+def _num_threads():
+  """
+  Number of threads of the OpenMP kernels: the first entry of OMP_NUM_THREADS
+  if it is set, otherwise the number of CPUs, which is the OpenMP default.
+  """
+  try:
+    return int(os.environ.get('OMP_NUM_THREADS', '').split(',')[0])
+  except ValueError:
+    return multiprocessing.cpu_count()
+
+
+# The autotuner used by conv_forward_fast; set CS231N_CONV_AUTOTUNE=0 to
+# disable tuning. Its decisions are kept in memory for the current process,
+# and are only stored on disk if the environment variable
+# CS231N_CONV_AUTOTUNE_CACHE names a JSON file to keep them in.
+conv_autotuner = None
+if os.environ.get('CS231N_CONV_AUTOTUNE', '1') != '0':
+  conv_autotuner = ConvAutotuner(
+      os.environ.get('CS231N_CONV_AUTOTUNE_CACHE') or None)
+
+
+def choose_conv_method(x, w, b, conv_param):
+  """
+  Return the name of the implementation (one of CONV_METHODS) that
+  conv_forward_fast uses for a convolution: conv_param['method'] if it is
+  given and not 'auto'. Otherwise conv_autotuner picks the fastest
+  implementation for the shapes at hand. If tuning is disabled, 1x1
+  convolutions with stride 1 and no padding use 'pointwise' and all others
+  use 'strides'.
+  """
+  method = conv_param.get('method', 'auto')
+  if method == 'auto' and conv_autotuner is not None:
+    method = conv_autotuner.choose(x, w, b, conv_param)
+  elif method == 'auto':
+    pointwise = conv_method_applies('pointwise', x, w, conv_param)
+    method = 'pointwise' if pointwise else 'strides'
+  return method
+
+
+def conv_forward_fast(x, w, b, conv_param):
+  """
+  Forward pass for a convolutional layer using the implementation picked by
+  choose_conv_method.
+  """
+  method = choose_conv_method(x, w, b, conv_param)
+  out, cache = CONV_METHODS[method][0](x, w, b, conv_param)
+  return out, (method, cache)
+
+
+def conv_backward_fast(dout, cache):
+  """
+  Backward pass for conv_forward_fast.
+  """
+  method, cache = cache
+  return CONV_METHODS[method][1](dout, cache)
+
+
+def conv_relu_pool_forward_fused(x, w, b, conv_param, pool_param=None):
+  """
+  Fused forward pass for a convolution, a ReLU and 2x2 max pooling with
+  stride 2; pool_param, if given, must describe this pooling. The convolution
+  is the GEMM of conv_forward_strides without the bias; bias_relu_pool_cython
+  then adds the bias, applies the ReLU and pools straight from the GEMM
+  output, so the full-resolution activations are neither transposed nor kept.
+  As for conv_forward_strides the filters and stride must tile the padded
+  input, and the output height and width of the convolution must be even so
+  that the pooling windows tile it.
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, F, out_h / 2, out_w / 2)
+  - cache: (conv_cache, idx) where conv_cache is the cache of
+    conv_forward_strides and idx holds the pooling indices from
+    bias_relu_pool_cython.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
+  assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
+  if pool_param is not None:
+    assert (pool_param['pool_height'] == pool_param['pool_width'] ==
+            pool_param['stride'] == 2), 'only 2x2 pooling with stride 2'
+
+  x_cols, out_h, out_w = _im2col_strides(x, HH, WW, stride, pad)
+  assert out_h % 2 == 0 and out_w % 2 == 0, 'conv output must have even size'
+
+  res = w.reshape(F, -1).dot(x_cols)
+  res.shape = (F, N, out_h, out_w)
+  out, idx = bias_relu_pool_cython(res, b.astype(res.dtype, copy=False))
+
+  cache = ((x, w, b, conv_param, x_cols), idx)
+  return out, cache
+
+
+def conv_relu_pool_backward_fused(dout, cache):
+  """
+  Backward pass for conv_relu_pool_forward_fused.
+  """
+  conv_cache, idx = cache
+  da = relu_pool_backward_cython(np.ascontiguousarray(dout), idx)
+  # da is in the (F, N, H, W) layout of the GEMM output, so the transposed
+  # view is reshaped back to (F, N * H * W) in conv_backward_strides without
+  # a copy
+  return conv_backward_strides(da.transpose(1, 0, 2, 3), conv_cache)
 
 
 def max_pool_forward_fast(x, pool_param):
   """
   A fast implementation of the forward pass for a max pooling layer.
 
-  This chooses between the reshape method and the im2col method. If the pooling
-  regions are square and tile the input image, then we can use the reshape
-  method which is very fast. Otherwise we fall back on the im2col method, which
-  is not much faster than the naive method.
+  This uses the argmax method for any window of up to 256 elements, including
+  square windows that tile the input, and falls back on the im2col method,
+  which is not much faster than the naive method, for larger windows.
   """
-  N, C, H, W = x.shape
   pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
-  stride = pool_param['stride']
 
-  same_size = pool_height == pool_width == stride
-  tiles = H % pool_height == 0 and W % pool_width == 0
-  if same_size and tiles:
-    out, reshape_cache = max_pool_forward_reshape(x, pool_param)
-    cache = ('reshape', reshape_cache)
+  if pool_height * pool_width <= 256:
+    out, argmax_cache = max_pool_forward_argmax(x, pool_param)
+    cache = ('argmax', argmax_cache)
   else:
     out, im2col_cache = max_pool_forward_im2col(x, pool_param)
     cache = ('im2col', im2col_cache)
@@ -157,11 +900,13 @@ def max_pool_backward_fast(dout, cache):
   """
   A fast implementation of the backward pass for a max pooling layer.
 
-  This switches between the reshape method an the im2col method depending on
+  This switches between the reshape, argmax and im2col methods depending on
   which method was used to generate the cache.
   """
   method, real_cache = cache
-  if method == 'reshape':
+  if method == 'argmax':
+    return max_pool_backward_argmax(dout, real_cache)
+  elif method == 'reshape':
     return max_pool_backward_reshape(dout, real_cache)
   elif method == 'im2col':
     return max_pool_backward_im2col(dout, real_cache)
@@ -169,6 +914,34 @@ def max_pool_backward_fast(dout, cache):
     raise ValueError('Unrecognized method "%s"' % method)
 
 
+def max_pool_forward_argmax(x, pool_param):
+  """
+  A fast implementation of the forward pass for a max pooling layer with any
+  window size and stride, such as overlapping 3x3 windows with stride 2.
+
+  Besides the output the cache only keeps the offset of the maximum within
+  each window as a uint8, so the backward pass scatters the upstream
+  derivatives directly and never looks at x again. If a window has several
+  maxima, the gradient goes to the first one.
+  """
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  out, idx = max_pool_cython(x, pool_height, pool_width, stride)
+  cache = (x.shape, idx, pool_param)
+  return out, cache
+
+
+def max_pool_backward_argmax(dout, cache):
+  """
+  A fast implementation of the backward pass for max_pool_forward_argmax.
+  """
+  x_shape, idx, pool_param = cache
+  N, C, H, W = x_shape
+  dx = max_pool_backward_cython(dout, idx, H, W, pool_param['pool_width'],
+                                pool_param['stride'])
+  return dx
+
+
 def max_pool_forward_reshape(x, pool_param):
   """
   A fast implementation of the forward pass for the max pooling layer that uses
@@ -239,7 +1012,7 @@ def max_pool_forward_im2col(x, pool_param):
   out_width = (W - pool_width) / stride + 1
 
   x_split = x.reshape(N * C, 1, H, W)
-  x_cols = im2col(x_split, pool_height, pool_width, padding=0, stride=stride)
+  x_cols = im2col_indices(x_split, pool_height, pool_width, padding=0, stride=stride)
   x_cols_argmax = np.argmax(x_cols, axis=0)
   x_cols_max = x_cols[x_cols_argmax, np.arange(x_cols.shape[1])]
   out = x_cols_max.reshape(out_height, out_width, N, C).transpose(2, 3, 0, 1)
@@ -268,3 +1041,220 @@ def max_pool_backward_im2col(dout, cache):
   dx = dx.reshape(x.shape)
 
   return dx
+
+
+def global_avg_pool_forward(x):
+  """
+  Forward pass for a global average pooling layer, which averages each
+  channel over all spatial positions.
+
+  Inputs:
+  - x: Input data of shape (N, C, H, W)
+
+  Returns a tuple of:
+  - out: Output data of shape (N, C)
+  - cache: (x.shape, x.dtype)
+  """
+  N, C, H, W = x.shape
+  out = x.reshape(N, C, H * W).mean(axis=2)
+  cache = (x.shape, x.dtype)
+  return out, cache
+
+
+def global_avg_pool_backward(dout, cache):
+  """
+  Backward pass for a global average pooling layer.
+
+  Inputs:
+  - dout: Upstream derivatives of shape (N, C)
+  - cache: (x.shape, x.dtype) from global_avg_pool_forward
+
+  Returns:
+  - dx: Gradient with respect to x, of shape (N, C, H, W)
+  """
+  shape, dtype = cache
+  N, C, H, W = shape
+  dx = np.empty(shape, dtype=np.result_type(dout, dtype))
+  dx[...] = (dout / float(H * W))[:, :, None, None]
+  return dx
+
+
+# Channels-last (NHWC) versions of the convolutional layers. Activations have
+# shape (N, H, W, C) throughout, so a network built from these layers never
+# transposes its activations between layers: the im2col matrix of a convolution
+# has one receptive field per row in (HH, WW, C) order and the GEMM output
+# (N * out_h * out_w, F) already is the next layer's input. Weights keep their
+# usual (F, C, HH, WW) shape, so the same parameters work in either layout.
+
+
+def _im2col_nhwc(x, HH, WW, stride, pad):
+  """
+  Build the im2col matrix of shape (N * out_h * out_w, HH * WW * C) of the
+  padded NHWC input by picking clever strides. Returns (x_cols, out_h, out_w).
+  """
+  N, H, W, C = x.shape
+
+  # Pad the input
+  p = pad
+  x_padded = np.pad(x, ((0, 0), (p, p), (p, p), (0, 0)), mode='constant')
+
+  # Figure out output dimensions
+  H += 2 * pad
+  W += 2 * pad
+  out_h = (H - HH) / stride + 1
+  out_w = (W - WW) / stride + 1
+
+  # Each receptive field is a contiguous run of C values in every row it
+  # touches, so the copy below moves whole channel vectors
+  sN, sH, sW, sC = x_padded.strides
+  shape = (N, out_h, out_w, HH, WW, C)
+  strides = (sN, stride * sH, stride * sW, sH, sW, sC)
+  x_stride = np.lib.stride_tricks.as_strided(x_padded,
+                shape=shape, strides=strides)
+  x_cols = np.ascontiguousarray(x_stride)
+  x_cols.shape = (N * out_h * out_w, HH * WW * C)
+  return x_cols, out_h, out_w
+
+
+def conv_nhwc_forward(x, w, b, conv_param):
+  """
+  Forward pass for a convolutional layer on channels-last data.
+
+  Inputs:
+  - x: Input data of shape (N, H, W, C)
+  - w: Filter weights of shape (F, C, HH, WW)
+  - b: Biases, of shape (F,)
+  - conv_param: Dictionary with the keys 'stride' and 'pad'; other keys such
+    as 'method' are ignored.
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, out_h, out_w, F) where
+    out_h = 1 + (H + 2 * pad - HH) / stride, rounded down, and likewise out_w
+  - cache: (x, w, b, conv_param, x_cols, w_cols)
+  """
+  N, H, W, C = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  # Rows and columns of the padded input that no window reaches are ignored
+  x_cols, out_h, out_w = _im2col_nhwc(x, HH, WW, stride, pad)
+
+  # Only the (small) filters are reordered to match the rows of x_cols
+  w_cols = w.transpose(2, 3, 1, 0).reshape(-1, F)
+  out = x_cols.dot(w_cols)
+  out += b
+  out.shape = (N, out_h, out_w, F)
+
+  cache = (x, w, b, conv_param, x_cols, w_cols)
+  return out, cache
+
+
+def conv_nhwc_backward(dout, cache):
+  """
+  Backward pass for conv_nhwc_forward.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, out_h, out_w, F)
+  - cache: A tuple (x, w, b, conv_param, x_cols, w_cols) as in
+    conv_nhwc_forward
+
+  Returns a tuple of:
+  - dx: Gradient with respect to x, of shape (N, H, W, C)
+  - dw: Gradient with respect to w, of shape (F, C, HH, WW)
+  - db: Gradient with respect to b, of shape (F,)
+  """
+  x, w, b, conv_param, x_cols, w_cols = cache
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  N, H, W, C = x.shape
+  F, _, HH, WW = w.shape
+  _, out_h, out_w, _ = dout.shape
+
+  dout_cols = dout.reshape(-1, F)
+  db = dout_cols.sum(axis=0)
+  dw = x_cols.T.dot(dout_cols).reshape(HH, WW, C, F).transpose(3, 2, 0, 1)
+  dw = np.ascontiguousarray(dw)
+
+  dx_cols = dout_cols.dot(w_cols.T)
+  dx_cols.shape = (N, out_h, out_w, HH, WW, C)
+  dx = col2im_nhwc_cython(dx_cols, H, W, pad, stride)
+
+  return dx, dw, db
+
+
+def max_pool_nhwc_forward(x, pool_param):
+  """
+  Forward pass for a max pooling layer on channels-last data, for any window
+  size and stride; the channels-last version of max_pool_forward_argmax.
+
+  Inputs:
+  - x: Input data of shape (N, H, W, C)
+  - pool_param: Dictionary with the keys 'pool_height', 'pool_width' and
+    'stride'; the window may have at most 256 elements.
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, out_h, out_w, C)
+  - cache: (x.shape, idx, pool_param) where idx is the uint8 offset of the
+    maximum within each window.
+  """
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  out, idx = max_pool_nhwc_cython(x, pool_height, pool_width, stride)
+  cache = (x.shape, idx, pool_param)
+  return out, cache
+
+
+def max_pool_nhwc_backward(dout, cache):
+  """
+  Backward pass for max_pool_nhwc_forward.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, out_h, out_w, C)
+  - cache: (x.shape, idx, pool_param) from max_pool_nhwc_forward
+
+  Returns:
+  - dx: Gradient with respect to x, of shape (N, H, W, C)
+  """
+  x_shape, idx, pool_param = cache
+  N, H, W, C = x_shape
+  dx = max_pool_nhwc_backward_cython(dout, idx, H, W,
+                                     pool_param['pool_width'],
+                                     pool_param['stride'])
+  return dx
+
+
+def global_avg_pool_nhwc_forward(x):
+  """
+  Forward pass for a global average pooling layer on channels-last data.
+
+  Inputs:
+  - x: Input data of shape (N, H, W, C)
+
+  Returns a tuple of:
+  - out: Output data of shape (N, C)
+  - cache: (x.shape, x.dtype)
+  """
+  out = x.mean(axis=(1, 2))
+  cache = (x.shape, x.dtype)
+  return out, cache
+
+
+def global_avg_pool_nhwc_backward(dout, cache):
+  """
+  Backward pass for global_avg_pool_nhwc_forward.
+
+  Inputs:
+  - dout: Upstream derivatives of shape (N, C)
+  - cache: (x.shape, x.dtype) from global_avg_pool_nhwc_forward
+
+  Returns:
+  - dx: Gradient with respect to x, of shape (N, H, W, C)
+  """
+  shape, dtype = cache
+  N, H, W, C = shape
+  dx = np.empty(shape, dtype=np.result_type(dout, dtype))
+  dx[...] = (dout / float(H * W))[:, None, None, :]
+  return dx
+
+
+dtype_policy.instrument(globals())
@@ -1,6 +1,7 @@
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel import prange
 
 # DTYPE = np.float64
 # ctypedef np.float64_t DTYPE_t
@@ -9,6 +10,13 @@ ctypedef fused DTYPE_t:
     np.float32_t
     np.float64_t
 
+# The im2col and col2im kernels run without the GIL and split channels across
+# OpenMP threads (see setup.py); set OMP_NUM_THREADS to control the number of
+# threads. Copies between the (N, ..., W) image layout and the (..., W, N)
+# column layout are transposes, which are done in tiles of TILE output
+# positions so that both sides of the copy stay in cache.
+DEF TILE = 16
+
 def im2col_cython(np.ndarray[DTYPE_t, ndim=4] x, int field_height,
                   int field_width, int padding, int stride):
     cdef int N = x.shape[0]
@@ -23,34 +31,42 @@ def im2col_cython(np.ndarray[DTYPE_t, ndim=4] x, int field_height,
     cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.pad(x,
             ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
 
-    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.zeros(
+    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.empty(
             (C * field_height * field_width, N * HH * WW),
             dtype=x.dtype)
 
-    # Moving the inner loop to a C function with no bounds checking works, but does
-    # not seem to help performance in any measurable way.
-
-    im2col_cython_inner(cols, x_padded, N, C, H, W, HH, WW,
-                        field_height, field_width, padding, stride)
+    cdef DTYPE_t[:, ::1] cols_view = cols
+    cdef DTYPE_t[:, :, :, ::1] x_view = x_padded
+    with nogil:
+        im2col_cython_inner(cols_view, x_view, N, C, H, W, HH, WW,
+                            field_height, field_width, padding, stride)
     return cols
 
 
 @cython.boundscheck(False)
-cdef int im2col_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
-                             int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
-
-    for c in range(C):
-        for yy in range(HH):
-            for xx in range(WW):
-                for ii in range(field_height):
-                    for jj in range(field_width):
-                        row = c * field_width * field_height + ii * field_height + jj
+@cython.wraparound(False)
+cdef void im2col_cython_inner(DTYPE_t[:, ::1] cols,
+                              DTYPE_t[:, :, :, ::1] x_padded,
+                              int N, int C, int H, int W, int HH, int WW,
+                              int field_height, int field_width, int padding,
+                              int stride) nogil:
+    cdef int c, ii, jj, row, yy, xx, x0, x1, i
+    cdef DTYPE_t *src
+    cdef DTYPE_t *dst
+
+    # Each channel fills its own rows of cols
+    for c in prange(C, schedule='static'):
+        for ii in range(field_height):
+            for jj in range(field_width):
+                row = (c * field_height + ii) * field_width + jj
+                for yy in range(HH):
+                    for x0 in range(0, WW, TILE):
+                        x1 = x0 + TILE if x0 + TILE < WW else WW
                         for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            cols[row, col] = x_padded[i, c, stride * yy + ii, stride * xx + jj]
+                            src = &x_padded[i, c, stride * yy + ii, jj]
+                            dst = &cols[row, yy * WW * N + i]
+                            for xx in range(x0, x1):
+                                dst[xx * N] = src[stride * xx]
 
 
 
@@ -62,48 +78,67 @@ def col2im_cython(np.ndarray[DTYPE_t, ndim=2] cols, int N, int C, int H, int W,
     cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
                                         dtype=cols.dtype)
 
-    # Moving the inner loop to a C-function with no bounds checking improves
-    # performance quite a bit for col2im.
-    col2im_cython_inner(cols, x_padded, N, C, H, W, HH, WW, 
-                        field_height, field_width, padding, stride)
+    cdef DTYPE_t[:, ::1] cols_view = np.ascontiguousarray(cols)
+    cdef DTYPE_t[:, :, :, ::1] x_view = x_padded
+    with nogil:
+        col2im_cython_inner(cols_view, x_view, N, C, H, W, HH, WW,
+                            field_height, field_width, padding, stride)
     if padding > 0:
         return x_padded[:, :, padding:-padding, padding:-padding]
     return x_padded
 
 
 @cython.boundscheck(False)
-cdef int col2im_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
-                             int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
+@cython.wraparound(False)
+cdef void col2im_cython_inner(DTYPE_t[:, ::1] cols,
+                              DTYPE_t[:, :, :, ::1] x_padded,
+                              int N, int C, int H, int W, int HH, int WW,
+                              int field_height, int field_width, int padding,
+                              int stride) nogil:
+    cdef int c, ii, jj, row, yy, xx, x0, x1, i
+    cdef DTYPE_t *src
+    cdef DTYPE_t *dst
 
-    for c in range(C):
+    # Only the rows of channel c add into channel c of x_padded, so threads
+    # never write to the same element
+    for c in prange(C, schedule='static'):
         for ii in range(field_height):
             for jj in range(field_width):
-                row = c * field_width * field_height + ii * field_height + jj
+                row = (c * field_height + ii) * field_width + jj
                 for yy in range(HH):
-                    for xx in range(WW):
+                    for x0 in range(0, WW, TILE):
+                        x1 = x0 + TILE if x0 + TILE < WW else WW
                         for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            x_padded[i, c, stride * yy + ii, stride * xx + jj] += cols[row, col]
+                            src = &cols[row, yy * WW * N + i]
+                            dst = &x_padded[i, c, stride * yy + ii, jj]
+                            for xx in range(x0, x1):
+                                dst[stride * xx] += src[xx * N]
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef col2im_6d_cython_inner(np.ndarray[DTYPE_t, ndim=6] cols,
-                            np.ndarray[DTYPE_t, ndim=4] x_padded,
-                            int N, int C, int H, int W, int HH, int WW,
-                            int out_h, int out_w, int pad, int stride):
+cdef void col2im_6d_cython_inner(DTYPE_t[:, :, :, :, :, ::1] cols,
+                                 DTYPE_t[:, :, :, ::1] x_padded,
+                                 int N, int C, int H, int W, int HH, int WW,
+                                 int out_h, int out_w, int pad,
+                                 int stride) nogil:
 
     cdef int c, hh, ww, n, h, w
-    for n in range(N):
-        for c in range(C):
+    cdef DTYPE_t *src
+    cdef DTYPE_t *dst
+    # All filter taps of one (n, c) plane are added while the plane is in
+    # cache, reading cols in contiguous runs of out_w. The innermost loop
+    # works on raw row pointers so that the compiler can vectorize it.
+    # Threads own disjoint channels.
+    for c in prange(C, schedule='static'):
+        for n in range(N):
             for hh in range(HH):
                 for ww in range(WW):
                     for h in range(out_h):
+                        src = &cols[c, hh, ww, n, h, 0]
+                        dst = &x_padded[n, c, stride * h + hh, ww]
                         for w in range(out_w):
-                            x_padded[n, c, stride * h + hh, stride * w + ww] += cols[c, hh, ww, n, h, w]
+                            dst[stride * w] += src[w]
     
 
 def col2im_6d_cython(np.ndarray[DTYPE_t, ndim=6] cols, int N, int C, int H, int W,
@@ -114,8 +149,360 @@ def col2im_6d_cython(np.ndarray[DTYPE_t, ndim=6] cols, int N, int C, int H, int
     cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad),
                                                   dtype=cols.dtype)
 
-    col2im_6d_cython_inner(cols, x_padded, N, C, H, W, HH, WW, out_h, out_w, pad, stride)
+    cdef DTYPE_t[:, :, :, :, :, ::1] cols_view = np.ascontiguousarray(cols)
+    cdef DTYPE_t[:, :, :, ::1] x_view = x_padded
+    with nogil:
+        col2im_6d_cython_inner(cols_view, x_view, N, C, H, W, HH, WW,
+                               out_h, out_w, pad, stride)
 
     if pad > 0:
         return x_padded[:, :, pad:-pad, pad:-pad]
     return x_padded 
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def col2im_nhwc_cython(np.ndarray[DTYPE_t, ndim=6] cols, int H, int W,
+                       int pad, int stride):
+    """
+    Channels-last col2im: add the columns of shape
+    (N, out_h, out_w, HH, WW, C) back into an input of shape (N, H, W, C).
+    """
+    cdef int N = cols.shape[0]
+    cdef int C = cols.shape[5]
+    x_padded = np.zeros((N, H + 2 * pad, W + 2 * pad, C), dtype=cols.dtype)
+
+    cdef DTYPE_t[:, :, :, :, :, ::1] cols_view = np.ascontiguousarray(cols)
+    cdef DTYPE_t[:, :, :, ::1] x_view = x_padded
+    with nogil:
+        col2im_nhwc_cython_inner(cols_view, x_view, stride)
+
+    if pad > 0:
+        return x_padded[:, pad:-pad, pad:-pad]
+    return x_padded
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void col2im_nhwc_cython_inner(DTYPE_t[:, :, :, :, :, ::1] cols,
+                                   DTYPE_t[:, :, :, ::1] x_padded,
+                                   int stride) nogil:
+    cdef int N = cols.shape[0]
+    cdef int out_h = cols.shape[1]
+    cdef int out_w = cols.shape[2]
+    cdef int HH = cols.shape[3]
+    cdef int WW = cols.shape[4]
+    cdef int C = cols.shape[5]
+    cdef int n, i, j, ii, jj, c
+    cdef DTYPE_t *src
+    cdef DTYPE_t *dst
+
+    # Threads own disjoint images; every tap adds a contiguous run of C
+    # values into a contiguous run of C values
+    for n in prange(N, schedule='static'):
+        for i in range(out_h):
+            for j in range(out_w):
+                for ii in range(HH):
+                    for jj in range(WW):
+                        src = &cols[n, i, j, ii, jj, 0]
+                        dst = &x_padded[n, stride * i + ii, stride * j + jj, 0]
+                        for c in range(C):
+                            dst[c] += src[c]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def bias_relu_pool_cython(np.ndarray[DTYPE_t, ndim=4] res,
+                          np.ndarray[DTYPE_t, ndim=1] b):
+    """
+    Apply a bias, a ReLU and 2x2 max pooling with stride 2 to the output of
+    the convolution GEMM in a single pass.
+
+    Inputs:
+    - res: Convolution outputs without bias, of shape (F, N, H, W) with even
+      H and W; this is the layout of the GEMM output in conv_forward_strides.
+    - b: Biases, of shape (F,)
+
+    Returns a tuple of:
+    - out: Pooled outputs, of shape (N, F, H / 2, W / 2)
+    - idx: int8 array of the shape of out with the position (0 to 3, in row
+      major order) of the maximum within each pooling window, or -1 where the
+      ReLU clipped the maximum to zero and no gradient flows back.
+    """
+    cdef int F = res.shape[0]
+    cdef int N = res.shape[1]
+    cdef int PH = res.shape[2] / 2
+    cdef int PW = res.shape[3] / 2
+    cdef np.ndarray[DTYPE_t, ndim=4] out = np.empty((N, F, PH, PW),
+                                                    dtype=res.dtype)
+    cdef np.ndarray[np.int8_t, ndim=4] idx = np.empty((N, F, PH, PW),
+                                                      dtype=np.int8)
+    cdef int f, n, i, j, k
+    cdef DTYPE_t m, v, bias
+
+    for f in range(F):
+        bias = b[f]
+        for n in range(N):
+            for i in range(PH):
+                for j in range(PW):
+                    m = res[f, n, 2 * i, 2 * j]
+                    k = 0
+                    v = res[f, n, 2 * i, 2 * j + 1]
+                    if v > m:
+                        m = v
+                        k = 1
+                    v = res[f, n, 2 * i + 1, 2 * j]
+                    if v > m:
+                        m = v
+                        k = 2
+                    v = res[f, n, 2 * i + 1, 2 * j + 1]
+                    if v > m:
+                        m = v
+                        k = 3
+                    m += bias
+                    if m > 0:
+                        out[n, f, i, j] = m
+                        idx[n, f, i, j] = k
+                    else:
+                        out[n, f, i, j] = 0
+                        idx[n, f, i, j] = -1
+    return out, idx
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def relu_pool_backward_cython(np.ndarray[DTYPE_t, ndim=4] dout,
+                              np.ndarray[np.int8_t, ndim=4] idx):
+    """
+    Backward pass for bias_relu_pool_cython.
+
+    Inputs:
+    - dout: Upstream derivatives, of shape (N, F, PH, PW)
+    - idx: Pooling indices from bias_relu_pool_cython
+
+    Returns:
+    - da: Gradient with respect to the convolution outputs, of shape
+      (F, N, 2 * PH, 2 * PW), the layout of res in bias_relu_pool_cython.
+    """
+    cdef int N = dout.shape[0]
+    cdef int F = dout.shape[1]
+    cdef int PH = dout.shape[2]
+    cdef int PW = dout.shape[3]
+    cdef np.ndarray[DTYPE_t, ndim=4] da = np.zeros((F, N, 2 * PH, 2 * PW),
+                                                   dtype=dout.dtype)
+    cdef int f, n, i, j, k
+
+    for n in range(N):
+        for f in range(F):
+            for i in range(PH):
+                for j in range(PW):
+                    k = idx[n, f, i, j]
+                    if k >= 0:
+                        da[f, n, 2 * i + k / 2, 2 * j + k % 2] = dout[n, f, i, j]
+    return da
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def max_pool_cython(np.ndarray[DTYPE_t, ndim=4] x, int pool_height,
+                    int pool_width, int stride):
+    """
+    Max pooling with any window size and stride.
+
+    Inputs:
+    - x: Input data, of shape (N, C, H, W)
+    - pool_height, pool_width: Size of the pooling windows; their area must
+      be at most 256
+    - stride: Distance between adjacent windows
+
+    Returns a tuple of:
+    - out: Output data, of shape (N, C, out_h, out_w) with
+      out_h = (H - pool_height) / stride + 1 and likewise out_w
+    - idx: uint8 array of the shape of out holding the offset
+      ii * pool_width + jj of the (first) maximum within each window
+    """
+    cdef int N = x.shape[0]
+    cdef int C = x.shape[1]
+    cdef int H = x.shape[2]
+    cdef int W = x.shape[3]
+    cdef int out_h = (H - pool_height) / stride + 1
+    cdef int out_w = (W - pool_width) / stride + 1
+    assert pool_height * pool_width <= 256, 'pooling window is too large'
+
+    out = np.empty((N, C, out_h, out_w), dtype=x.dtype)
+    idx = np.empty((N, C, out_h, out_w), dtype=np.uint8)
+    cdef DTYPE_t[:, :, ::1] x_view = np.ascontiguousarray(x).reshape(N * C, H, W)
+    cdef DTYPE_t[:, :, ::1] out_view = out.reshape(N * C, out_h, out_w)
+    cdef np.uint8_t[:, :, ::1] idx_view = idx.reshape(N * C, out_h, out_w)
+    with nogil:
+        max_pool_cython_inner(x_view, out_view, idx_view, pool_height,
+                              pool_width, stride)
+    return out, idx
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void max_pool_cython_inner(DTYPE_t[:, :, ::1] x, DTYPE_t[:, :, ::1] out,
+                                np.uint8_t[:, :, ::1] idx, int pool_height,
+                                int pool_width, int stride) nogil:
+    cdef int P = x.shape[0]
+    cdef int out_h = out.shape[1]
+    cdef int out_w = out.shape[2]
+    cdef int p, i, j, ii, jj, k
+    cdef DTYPE_t m, v
+
+    # Threads own disjoint (n, c) planes
+    for p in prange(P, schedule='static'):
+        for i in range(out_h):
+            for j in range(out_w):
+                m = x[p, stride * i, stride * j]
+                k = 0
+                for ii in range(pool_height):
+                    for jj in range(pool_width):
+                        v = x[p, stride * i + ii, stride * j + jj]
+                        if v > m:
+                            m = v
+                            k = ii * pool_width + jj
+                out[p, i, j] = m
+                idx[p, i, j] = k
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def max_pool_backward_cython(np.ndarray[DTYPE_t, ndim=4] dout,
+                             np.ndarray[np.uint8_t, ndim=4] idx,
+                             int H, int W, int pool_width, int stride):
+    """
+    Backward pass for max_pool_cython: each upstream derivative is added to
+    the input position recorded in idx.
+
+    Returns:
+    - dx: Gradient with respect to x, of shape (N, C, H, W)
+    """
+    cdef int N = dout.shape[0]
+    cdef int C = dout.shape[1]
+    cdef int out_h = dout.shape[2]
+    cdef int out_w = dout.shape[3]
+
+    dx = np.zeros((N, C, H, W), dtype=dout.dtype)
+    cdef DTYPE_t[:, :, ::1] dout_view = np.ascontiguousarray(dout).reshape(N * C, out_h, out_w)
+    cdef np.uint8_t[:, :, ::1] idx_view = np.ascontiguousarray(idx).reshape(N * C, out_h, out_w)
+    cdef DTYPE_t[:, :, ::1] dx_view = dx.reshape(N * C, H, W)
+    cdef int p, i, j, k
+
+    # Overlapping windows add into the same positions, but only within one
+    # (n, c) plane, so threads never write to the same element
+    with nogil:
+        for p in prange(N * C, schedule='static'):
+            for i in range(out_h):
+                for j in range(out_w):
+                    k = idx_view[p, i, j]
+                    dx_view[p, stride * i + k / pool_width,
+                            stride * j + k % pool_width] += dout_view[p, i, j]
+    return dx
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def max_pool_nhwc_cython(np.ndarray[DTYPE_t, ndim=4] x, int pool_height,
+                         int pool_width, int stride):
+    """
+    Channels-last version of max_pool_cython.
+
+    Inputs:
+    - x: Input data, of shape (N, H, W, C)
+    - pool_height, pool_width, stride: As for max_pool_cython
+
+    Returns a tuple of:
+    - out: Output data, of shape (N, out_h, out_w, C)
+    - idx: uint8 array of the shape of out, as for max_pool_cython
+    """
+    cdef int N = x.shape[0]
+    cdef int H = x.shape[1]
+    cdef int W = x.shape[2]
+    cdef int C = x.shape[3]
+    cdef int out_h = (H - pool_height) / stride + 1
+    cdef int out_w = (W - pool_width) / stride + 1
+    assert pool_height * pool_width <= 256, 'pooling window is too large'
+
+    out = np.empty((N, out_h, out_w, C), dtype=x.dtype)
+    idx = np.empty((N, out_h, out_w, C), dtype=np.uint8)
+    cdef DTYPE_t[:, :, :, ::1] x_view = np.ascontiguousarray(x)
+    cdef DTYPE_t[:, :, :, ::1] out_view = out
+    cdef np.uint8_t[:, :, :, ::1] idx_view = idx
+    with nogil:
+        max_pool_nhwc_cython_inner(x_view, out_view, idx_view, pool_height,
+                                   pool_width, stride)
+    return out, idx
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void max_pool_nhwc_cython_inner(DTYPE_t[:, :, :, ::1] x,
+                                     DTYPE_t[:, :, :, ::1] out,
+                                     np.uint8_t[:, :, :, ::1] idx,
+                                     int pool_height, int pool_width,
+                                     int stride) nogil:
+    cdef int N = x.shape[0]
+    cdef int C = x.shape[3]
+    cdef int out_h = out.shape[1]
+    cdef int out_w = out.shape[2]
+    cdef int n, i, j, ii, jj, c, k
+    cdef DTYPE_t *m
+    cdef np.uint8_t *mi
+    cdef DTYPE_t *v
+
+    # Threads own disjoint images; the innermost loop runs over the
+    # contiguous channels of one input position
+    for n in prange(N, schedule='static'):
+        for i in range(out_h):
+            for j in range(out_w):
+                m = &out[n, i, j, 0]
+                mi = &idx[n, i, j, 0]
+                v = &x[n, stride * i, stride * j, 0]
+                for c in range(C):
+                    m[c] = v[c]
+                    mi[c] = 0
+                for ii in range(pool_height):
+                    for jj in range(pool_width):
+                        k = ii * pool_width + jj
+                        if k == 0:
+                            continue
+                        v = &x[n, stride * i + ii, stride * j + jj, 0]
+                        for c in range(C):
+                            if v[c] > m[c]:
+                                m[c] = v[c]
+                                mi[c] = k
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def max_pool_nhwc_backward_cython(np.ndarray[DTYPE_t, ndim=4] dout,
+                                  np.ndarray[np.uint8_t, ndim=4] idx,
+                                  int H, int W, int pool_width, int stride):
+    """
+    Backward pass for max_pool_nhwc_cython.
+
+    Returns:
+    - dx: Gradient with respect to x, of shape (N, H, W, C)
+    """
+    cdef int N = dout.shape[0]
+    cdef int out_h = dout.shape[1]
+    cdef int out_w = dout.shape[2]
+    cdef int C = dout.shape[3]
+
+    dx = np.zeros((N, H, W, C), dtype=dout.dtype)
+    cdef DTYPE_t[:, :, :, ::1] dout_view = np.ascontiguousarray(dout)
+    cdef np.uint8_t[:, :, :, ::1] idx_view = np.ascontiguousarray(idx)
+    cdef DTYPE_t[:, :, :, ::1] dx_view = dx
+    cdef int n, i, j, c, k
+
+    with nogil:
+        for n in prange(N, schedule='static'):
+            for i in range(out_h):
+                for j in range(out_w):
+                    for c in range(C):
+                        k = idx_view[n, i, j, c]
+                        dx_view[n, stride * i + k / pool_width,
+                                stride * j + k % pool_width, c] += dout_view[n, i, j, c]
+    return dx
@@ -1,7 +1,18 @@
 import numpy as np
 
+from cs231n import dtype_policy
 
-def affine_forward(x, w, b):
+try:
+  from numpy.random import Generator, PCG64
+  def _make_rng(seed=None):
+    return Generator(PCG64(seed))
+except ImportError:
+  # numpy < 1.17 has no Generator; fall back to a private RandomState stream
+  def _make_rng(seed=None):
+    return np.random.RandomState(seed)
+
+
+def affine_forward(x, w, b, out=None):
   """
   Computes the forward pass for an affine (fully-connected) layer.
 
@@ -14,19 +25,21 @@ def affine_forward(x, w, b):
   - x: A numpy array containing input data, of shape (N, d_1, ..., d_k)
   - w: A numpy array of weights, of shape (D, M)
   - b: A numpy array of biases, of shape (M,)
+  - out: Optional C-contiguous array of shape (N, M) and the dtype of the
+    result to write the output into instead of allocating a new one.
 
   Returns a tuple of:
   - out: output, of shape (N, M)
   - cache: (x, w, b)
   """
-  out = None
   #############################################################################
   # TODO: Implement the affine forward pass. Store the result in out. You     #
   # will need to reshape the input into rows.                                 #
   #############################################################################
   N = x.shape[0]
   (D, M) = w.shape
-  out = np.dot(x.reshape(N, -1), w) + b
+  out = np.dot(x.reshape(N, -1), w, out=out)
+  out += b
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -34,7 +47,7 @@ def affine_forward(x, w, b):
   return out, cache
 
 
-def affine_backward(dout, cache):
+def affine_backward(dout, cache, out=None):
   """
   Computes the backward pass for an affine layer.
 
@@ -43,6 +56,8 @@ def affine_backward(dout, cache):
   - cache: Tuple of:
     - x: Input data, of shape (N, d_1, ... d_k)
     - w: Weights, of shape (D, M)
+  - out: Optional tuple (dx, dw, db) of C-contiguous arrays to write the
+    gradients into instead of allocating new ones.
 
   Returns a tuple of:
   - dx: Gradient with respect to x, of shape (N, d1, ..., d_k)
@@ -57,34 +72,43 @@ def affine_backward(dout, cache):
   N = x.shape[0]
   (D, M) = w.shape
 
-  dx = np.dot(dout, w.T)
-  dx.shape = x.shape
+  if out is None:
+    dx = np.dot(dout, w.T)
+    dx.shape = x.shape
+
+    dw = np.dot(dout.T, x.reshape(N, -1)).T
 
-  dw = np.dot(dout.T, x.reshape(N, -1)).T
+    db = np.sum(dout, axis = 0)
+  else:
+    dx, dw, db = out
+
+    np.dot(dout, w.T, out=dx.reshape(N, D))
 
-  db = np.sum(dout, axis = 0)
+    np.dot(x.reshape(N, -1).T, dout, out=dw)
+
+    np.sum(dout, axis = 0, out=db)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
   return dx, dw, db
 
 
-def relu_forward(x):
+def relu_forward(x, out=None):
   """
   Computes the forward pass for a layer of rectified linear units (ReLUs).
 
   Input:
   - x: Inputs, of any shape
+  - out: Optional array of the shape and dtype of x to write the output into
 
   Returns a tuple of:
   - out: Output, of the same shape as x
   - cache: x
   """
-  out = None
   #############################################################################
   # TODO: Implement the ReLU forward pass.                                    #
   #############################################################################
-  out = np.maximum(x, 0)
+  out = np.maximum(x, 0, out=out)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -92,13 +116,14 @@ def relu_forward(x):
   return out, cache
 
 
-def relu_backward(dout, cache):
+def relu_backward(dout, cache, out=None):
   """
   Computes the backward pass for a layer of rectified linear units (ReLUs).
 
   Input:
-  - dout: Upstream derivatives, of any shape
+  - dout: Upstream derivatives, of any shape; overwritten unless out is given
   - cache: Input x, of same shape as dout
+  - out: Optional array of the shape and dtype of dout to write dx into
 
   Returns:
   - dx: Gradient with respect to x
@@ -107,6 +132,9 @@ def relu_backward(dout, cache):
   #############################################################################
   # TODO: Implement the ReLU backward pass.                                   #
   #############################################################################
+  if out is not None:
+    np.copyto(out, dout)
+    dout = out
   dx = dout
   dx[x < 0] = 0
   #############################################################################
@@ -115,7 +143,37 @@ def relu_backward(dout, cache):
   return dx
 
 
-def batchnorm_forward(x, gamma, beta, bn_param):
+def transpose_forward(x, axes):
+  """
+  Computes the forward pass for a permutation of the axes of x, such as the
+  change from the (N, C, H, W) to the (N, H, W, C) layout.
+
+  Inputs:
+  - x: Inputs, of any shape
+  - axes: Permutation of range(x.ndim) as for np.transpose
+
+  Returns a tuple of:
+  - out: A transposed view of x
+  - cache: axes
+  """
+  return x.transpose(axes), axes
+
+
+def transpose_backward(dout, cache):
+  """
+  Computes the backward pass for a permutation of axes.
+
+  Inputs:
+  - dout: Upstream derivatives, of the shape of out
+  - cache: axes from transpose_forward
+
+  Returns:
+  - dx: Gradient with respect to x, a transposed view of dout
+  """
+  return dout.transpose(np.argsort(cache))
+
+
+def batchnorm_forward(x, gamma, beta, bn_param, lean=False):
   """
   Forward pass for batch normalization.
 
@@ -148,6 +206,10 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     - momentum: Constant for running mean / variance.
     - running_mean: Array of shape (D,) giving running mean of features
     - running_var Array of shape (D,) giving running variance of features
+  - lean: If True, the training-time cache only holds the normalized data,
+    gamma and the per-feature inverse standard deviation instead of all
+    intermediates (one (N, D) array instead of six). A lean cache can only be
+    used with batchnorm_backward_alt.
 
   Returns a tuple of:
   - out: of shape (N, D)
@@ -183,6 +245,24 @@ def batchnorm_forward(x, gamma, beta, bn_param):
 
     # cache = (sample_mean, sample_var, gamma, beta)
 
+    if lean:
+      sample_mean = np.mean(x, axis = 0)
+      x_norm = x - sample_mean
+      sample_var = np.mean(x_norm ** 2, axis = 0)
+      sample_var_sqrt_inv = 1 / np.sqrt(sample_var + eps)
+      x_norm *= sample_var_sqrt_inv
+
+      out = x_norm * gamma
+      out += beta
+      cache = (x_norm, gamma, sample_var_sqrt_inv)
+
+      running_mean = momentum * running_mean + (1 - momentum) * sample_mean
+      running_var = momentum * running_var + (1 - momentum) * sample_var
+
+      bn_param['running_mean'] = running_mean
+      bn_param['running_var'] = running_var
+      return out, cache
+
     sample_mean = np.sum(x, axis = 0) / N
 
     x_center = x - sample_mean
@@ -260,6 +340,10 @@ def batchnorm_backward(dout, cache):
   # http://cthorey.github.io./backpropagation/
   # https://kevinzakka.github.io/2016/09/14/batch_normalization/
 
+  if len(cache) == 3:
+    raise ValueError('batchnorm_backward needs the full cache; '
+                     'use batchnorm_backward_alt with lean batchnorm_forward')
+
   (x_center, x_centered_squared, sample_var, sample_var_sqrt,
    sample_var_sqrt_inv, x_norm, x_norm_gamma, x_norm_gamma_beta,
    gamma, beta, eps, x, sample_mean) = cache
@@ -294,7 +378,7 @@ def batchnorm_backward(dout, cache):
 
   dL_dsample_var = dL_dsample_var_sqrt / (2 * (sample_var + eps))
 
-  dL_dx_center_squared = dL_dsample_var * np.ones((N, D)) / N
+  dL_dx_center_squared = dL_dsample_var * np.ones((N, D), dtype=dout.dtype) / N
 
   dL_dx_center_2 = 2 * x_center * dL_dx_center_squared
 
@@ -302,7 +386,7 @@ def batchnorm_backward(dout, cache):
 
   dL_dsample_mean = - np.sum(dL_dx_center_1 + dL_dx_center_2, axis = 0)
 
-  dL_dx2 = np.ones((N, D)) * dL_dsample_mean / N
+  dL_dx2 = np.ones((N, D), dtype=dout.dtype) * dL_dsample_mean / N
 
   dx = dL_dx1 + dL_dx2
   dgamma = dL_dgamma
@@ -325,6 +409,7 @@ def batchnorm_backward_alt(dout, cache):
 
   Note: This implementation should expect to receive the same cache variable
   as batchnorm_backward, but might not use all of the values in the cache.
+  It also accepts the cache of batchnorm_forward with lean=True.
 
   Inputs / outputs: Same as batchnorm_backward
   """
@@ -337,21 +422,25 @@ def batchnorm_backward_alt(dout, cache):
   # should be able to compute gradients with respect to the inputs in a       #
   # single statement; our implementation fits on a single 80-character line.  #
   #############################################################################
-  (x_center, x_centered_squared, sample_var, sample_var_sqrt,
-   sample_var_sqrt_inv, x_norm, x_norm_gamma, x_norm_gamma_beta,
-   gamma, beta, eps, x, sample_mean) = cache
-
-  N, D = x.shape
-
-  dxhat = dout * gamma
+  if len(cache) == 3:
+    x_norm, gamma, sample_var_sqrt_inv = cache
+  else:
+    x_norm, gamma, sample_var_sqrt_inv = cache[5], cache[8], cache[4]
 
-  dx = (1. / N) * sample_var_sqrt_inv * (N * dxhat - np.sum(dxhat, axis = 0) -
-                                         x_norm * np.sum(dxhat * x_norm, axis=0))
+  N, D = x_norm.shape
 
+  # dgamma and dbeta are exactly the sums the simplified dx needs, so dx is
+  # a single pass over dout without the intermediate dxhat = dout * gamma
   dbeta = np.sum(dout, axis=0)
 
   dgamma = np.sum(dout * x_norm, axis = 0)
 
+  dx = x_norm * dgamma
+  dx += dbeta
+  dx *= -1. / N
+  dx += dout
+  dx *= gamma * sample_var_sqrt_inv
+
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -359,6 +448,20 @@ def batchnorm_backward_alt(dout, cache):
   return dx, dgamma, dbeta
 
 
+def dropout_rng(dropout_param):
+  """
+  Return the random number generator from which a dropout layer draws its
+  mask: a new generator seeded with dropout_param['seed'] if it is given, and
+  otherwise dropout_param['rng'], which is created on the first call.
+  """
+  if 'seed' in dropout_param:
+    return _make_rng(dropout_param['seed'])
+  rng = dropout_param.get('rng')
+  if rng is None:
+    rng = dropout_param['rng'] = _make_rng()
+  return rng
+
+
 def dropout_forward(x, dropout_param):
   """
   Performs the forward pass for (inverted) dropout.
@@ -372,15 +475,18 @@ def dropout_forward(x, dropout_param):
     - seed: Seed for the random number generator. Passing seed makes this
       function deterministic, which is needed for gradient checking but not in
       real networks.
+    - rng: Random number generator of this dropout layer. Without a seed it is
+      created on the first call and then reused, so that each dropout_param
+      draws from its own stream and the global np.random state is untouched.
 
   Outputs:
   - out: Array of the same shape as x.
-  - cache: A tuple (dropout_param, mask). In training mode, mask is the dropout
-    mask that was used to multiply the input; in test mode, mask is None.
+  - cache: A tuple (dropout_param, mask). In training mode, mask is the
+    bit-packed (np.packbits) boolean mask of the kept inputs; in test mode,
+    mask is None.
   """
   p, mode = dropout_param['p'], dropout_param['mode']
-  if 'seed' in dropout_param:
-    np.random.seed(dropout_param['seed'])
+  rng = dropout_rng(dropout_param)
 
   mask = None
   out = None
@@ -390,8 +496,10 @@ def dropout_forward(x, dropout_param):
     # TODO: Implement the training phase forward pass for inverted dropout.   #
     # Store the dropout mask in the mask variable.                            #
     ###########################################################################
-    mask = (np.random.rand(*x.shape) < p) / p
-    out = x * mask
+    keep = rng.uniform(size=x.shape) < p
+    out = x * keep
+    out *= 1.0 / p
+    mask = np.packbits(keep)
     ###########################################################################
     #                            END OF YOUR CODE                             #
     ###########################################################################
@@ -426,7 +534,9 @@ def dropout_backward(dout, cache):
     ###########################################################################
     # TODO: Implement the training phase backward pass for inverted dropout.  #
     ###########################################################################
-    dx = dout * mask
+    keep = np.unpackbits(mask)[:dout.size].reshape(dout.shape).view(np.bool_)
+    dx = dout * keep
+    dx *= 1.0 / dropout_param['p']
     ###########################################################################
     #                            END OF YOUR CODE                             #
     ###########################################################################
@@ -435,6 +545,154 @@ def dropout_backward(dout, cache):
   return dx
 
 
+def affine_batchnorm_relu_dropout_forward(x, w, b, gamma, beta, bn_param,
+                                          dropout_param, out=None, mode=None):
+  """
+  Fused forward pass for an affine layer followed by an optional batch
+  normalization, a ReLU and an optional (inverted) dropout, which is one
+  hidden block of FullyConnectedNet.
+
+  The block is computed as one matrix multiply and a few in-place passes over
+  two (N, M) arrays: the pre-activations, which are normalized in place, and
+  the output. The ReLU and dropout masks are merged into one boolean mask
+  that is stored bit-packed, so besides x the training-time cache holds one
+  (N, M) array with batch normalization and none without it.
+
+  For the same inputs, bn_param and dropout_param the result equals
+  affine_forward, batchnorm_forward, relu_forward and dropout_forward applied
+  in sequence.
+
+  Inputs:
+  - x: Input data, of shape (N, d_1, ..., d_k)
+  - w: Weights, of shape (D, M)
+  - b: Biases, of shape (M,)
+  - gamma, beta, bn_param: Scale, shift and parameters of the batch
+    normalization as in batchnorm_forward, or None to skip it.
+  - dropout_param: Parameters of the dropout as in dropout_forward, or None to
+    skip it.
+  - out: Optional C-contiguous array of shape (N, M) and the dtype of the
+    result to write the output into instead of allocating a new one.
+  - mode: 'train' or 'test'. If None, the mode of bn_param, or of
+    dropout_param without batch normalization, is used; without either the
+    default is 'train', so callers that run a plain affine-ReLU block at test
+    time should pass mode='test' to skip building the training cache.
+
+  Returns a tuple of:
+  - out: Output, of shape (N, M)
+  - cache: In training mode a tuple (x, w, x_norm, gamma, std_inv, mask,
+    scale); x_norm, gamma and std_inv are None without batch normalization.
+    In test mode None.
+  """
+  use_bn = bn_param is not None
+  if mode is None:
+    mode = 'train'
+    if use_bn:
+      mode = bn_param['mode']
+    elif dropout_param is not None:
+      mode = dropout_param['mode']
+  N = x.shape[0]
+  D, M = w.shape
+  x_rows = x.reshape(N, D)
+
+  x_norm, std_inv = None, None
+  if not use_bn:
+    out = np.dot(x_rows, w, out=out)
+    out += b
+  else:
+    eps = bn_param.get('eps', 1e-5)
+    momentum = bn_param.get('momentum', 0.9)
+    running_mean = bn_param.get('running_mean', np.zeros(M, dtype=x.dtype))
+    running_var = bn_param.get('running_var', np.zeros(M, dtype=x.dtype))
+
+    a = np.dot(x_rows, w)
+    a += b
+    if mode == 'train':
+      sample_mean = np.mean(a, axis=0)
+      a -= sample_mean
+      sample_var = np.einsum('ij,ij->j', a, a) / N
+      std_inv = 1 / np.sqrt(sample_var + eps)
+      a *= std_inv
+      x_norm = a
+      out = np.multiply(x_norm, gamma, out=out)
+      out += beta
+
+      bn_param['running_mean'] = momentum * running_mean + (1 - momentum) * sample_mean
+      bn_param['running_var'] = momentum * running_var + (1 - momentum) * sample_var
+    elif mode == 'test':
+      # Fold the running statistics into a single scale and shift
+      scale = gamma / np.sqrt(running_var + eps)
+      out = np.multiply(a, scale, out=out)
+      out += beta - running_mean * scale
+      bn_param['running_mean'] = running_mean
+      bn_param['running_var'] = running_var
+    else:
+      raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+  if mode == 'test':
+    np.maximum(out, 0, out=out)
+    return out, None
+
+  mask = out > 0
+  scale = 1.0
+  if dropout_param is not None:
+    p = dropout_param['p']
+    rng = dropout_rng(dropout_param)
+    mask &= rng.uniform(size=out.shape) < p
+    scale = 1.0 / p
+  out *= mask
+  if scale != 1.0:
+    out *= scale
+
+  cache = (x, w, x_norm, gamma, std_inv, np.packbits(mask), scale)
+  return out, cache
+
+
+def affine_batchnorm_relu_dropout_backward(dout, cache, out=None):
+  """
+  Backward pass for affine_batchnorm_relu_dropout_forward.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, M)
+  - cache: Training-time cache from affine_batchnorm_relu_dropout_forward
+  - out: Optional tuple (dx, dw, db) of C-contiguous arrays to write the
+    affine gradients into instead of allocating new ones.
+
+  Returns a tuple of:
+  - dx: Gradient with respect to x, of shape (N, d_1, ..., d_k)
+  - dw: Gradient with respect to w, of shape (D, M)
+  - db: Gradient with respect to b, of shape (M,)
+  - dgamma, dbeta: Gradients with respect to gamma and beta, of shape (M,),
+    or None without batch normalization
+  """
+  x, w, x_norm, gamma, std_inv, mask, scale = cache
+  N = x.shape[0]
+  D, M = w.shape
+
+  mask = np.unpackbits(mask)[:dout.size].reshape(dout.shape).view(np.bool_)
+  da = dout * mask
+  if scale != 1.0:
+    da *= scale
+
+  dgamma, dbeta = None, None
+  if x_norm is not None:
+    dbeta = np.sum(da, axis=0)
+    dgamma = np.einsum('ij,ij->j', da, x_norm)
+    da -= x_norm * (dgamma / N)
+    da -= dbeta / N
+    da *= gamma * std_inv
+
+  if out is None:
+    dx = np.dot(da, w.T).reshape(x.shape)
+    dw = np.dot(x.reshape(N, D).T, da)
+    db = np.sum(da, axis=0)
+  else:
+    dx, dw, db = out
+    np.dot(da, w.T, out=dx.reshape(N, D))
+    np.dot(x.reshape(N, D).T, da, out=dw)
+    np.sum(da, axis=0, out=db)
+  return dx, dw, db, dgamma, dbeta
+
+
 def conv_forward_naive(x, w, b, conv_param):
   """
   A naive implementation of the forward pass for a convolutional layer.
@@ -472,7 +730,7 @@ def conv_forward_naive(x, w, b, conv_param):
   H_new = 1 + (H + 2 * pad - HH) / stride
   W_new = 1 + (W + 2 * pad - WW) / stride
 
-  out = np.zeros((N, F, H_new, W_new))
+  out = np.zeros((N, F, H_new, W_new), dtype=x.dtype)
 
   x_pad = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), "constant", constant_values=0)
 
@@ -516,9 +774,9 @@ def conv_backward_naive(dout, cache):
   H_new = 1 + (H + 2 * pad - HH) / stride
   W_new = 1 + (W + 2 * pad - WW) / stride
 
-  dx = np.zeros(x.shape)
-  dw = np.zeros(w.shape)
-  db = np.zeros(b.shape)
+  dx = np.zeros_like(x)
+  dw = np.zeros_like(w)
+  db = np.zeros_like(b)
 
   x_pad = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), "constant", constant_values=0)
   dx_pad = np.pad(dx, ((0, 0), (0, 0), (pad, pad), (pad, pad)), "constant", constant_values=0)
@@ -564,7 +822,7 @@ def max_pool_forward_naive(x, pool_param):
   H_new = H / stride
   W_new = W / stride
 
-  out = np.zeros((N, C, H_new, W_new))
+  out = np.zeros((N, C, H_new, W_new), dtype=x.dtype)
 
   for i in range(N):
     for j in range(C):
@@ -602,7 +860,7 @@ def max_pool_backward_naive(dout, cache):
   H_new = H / stride
   W_new = W / stride
 
-  dx = np.zeros(x.shape)
+  dx = np.zeros_like(x)
 
   for i in range(N):
     for j in range(C):
@@ -637,7 +895,8 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
 
   Returns a tuple of:
   - out: Output data, of shape (N, C, H, W)
-  - cache: Values needed for the backward pass
+  - cache: Values needed for the backward pass; in test mode the backward
+    pass treats the running statistics as constants.
   """
   out, cache = None, None
 
@@ -648,14 +907,44 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
   # version of batch normalization defined above. Your implementation should  #
   # be very short; ours is less than five lines.                              #
   #############################################################################
-  C = x.shape[1]
-  x_swaped = x.swapaxes(0, 1)
+  # Statistics are reduced over the (N, H, W) axes and broadcast back per
+  # channel, so x is never transposed or copied into an (N * H * W, C) matrix.
+  # The cache has the same lean layout as batchnorm_forward with lean=True.
+  mode = bn_param['mode']
+  eps = bn_param.get('eps', 1e-5)
+  momentum = bn_param.get('momentum', 0.9)
 
-  (vanilla_out, vanilla_cache) = batchnorm_forward(x_swaped.reshape(C, -1).T, gamma, beta, bn_param)
+  N, C, H, W = x.shape
+  running_mean = bn_param.get('running_mean', np.zeros(C, dtype=x.dtype))
+  running_var = bn_param.get('running_var', np.zeros(C, dtype=x.dtype))
+  channel_shape = (1, C, 1, 1)
+
+  if mode == 'train':
+    sample_mean = np.mean(x, axis = (0, 2, 3))
+    x_norm = x - sample_mean.reshape(channel_shape)
+    sample_var = np.mean(x_norm ** 2, axis = (0, 2, 3))
+    sample_var_sqrt_inv = 1 / np.sqrt(sample_var + eps)
+    x_norm *= sample_var_sqrt_inv.reshape(channel_shape)
 
-  out = vanilla_out.T.reshape(x_swaped.shape).swapaxes(0, 1)
+    out = x_norm * gamma.reshape(channel_shape)
+    out += beta.reshape(channel_shape)
+    cache = (mode, x_norm, gamma, sample_var_sqrt_inv)
 
-  cache = (x.shape, x_swaped.shape, vanilla_cache)
+    running_mean = momentum * running_mean + (1 - momentum) * sample_mean
+    running_var = momentum * running_var + (1 - momentum) * sample_var
+  elif mode == 'test':
+    sample_var_sqrt_inv = 1 / np.sqrt(running_var + eps)
+    scale = gamma * sample_var_sqrt_inv
+    out = x * scale.reshape(channel_shape)
+    out += (beta - running_mean * scale).reshape(channel_shape)
+    # The statistics are constants at test time, so the backward pass (used
+    # for image gradients) only needs x and the running mean
+    cache = (mode, x, gamma, sample_var_sqrt_inv, running_mean)
+  else:
+    raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+  bn_param['running_mean'] = running_mean
+  bn_param['running_var'] = running_var
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -685,12 +974,35 @@ def spatial_batchnorm_backward(dout, cache):
   # version of batch normalization defined above. Your implementation should  #
   # be very short; ours is less than five lines.                              #
   #############################################################################
-  (x_shape, x_swaped_shape, vanilla_cache) = cache
-  C = x_shape[1]
+  mode = cache[0]
+  if mode == 'train':
+    _, x_norm, gamma, sample_var_sqrt_inv = cache
+
+    N, C, H, W = x_norm.shape
+    channel_shape = (1, C, 1, 1)
+
+    # Same single pass as batchnorm_backward_alt, reduced over (N, H, W)
+    dbeta = np.sum(dout, axis = (0, 2, 3))
+
+    dgamma = np.sum(dout * x_norm, axis = (0, 2, 3))
+
+    dx = x_norm * dgamma.reshape(channel_shape)
+    dx += dbeta.reshape(channel_shape)
+    dx *= -1. / (N * H * W)
+    dx += dout
+    dx *= (gamma * sample_var_sqrt_inv).reshape(channel_shape)
+  else:
+    _, x, gamma, sample_var_sqrt_inv, running_mean = cache
+
+    C = x.shape[1]
+    channel_shape = (1, C, 1, 1)
 
-  (vanilla_dx, dgamma, dbeta) = batchnorm_backward_alt(dout.swapaxes(0, 1).reshape(C, -1).T, vanilla_cache)
+    dbeta = np.sum(dout, axis = (0, 2, 3))
 
-  dx = vanilla_dx.T.reshape(x_swaped_shape).swapaxes(0,1)
+    dgamma = np.sum(dout * x, axis = (0, 2, 3)) - running_mean * dbeta
+    dgamma *= sample_var_sqrt_inv
+
+    dx = dout * (gamma * sample_var_sqrt_inv).reshape(channel_shape)
 
   #############################################################################
   #                             END OF YOUR CODE                              #
@@ -699,6 +1011,48 @@ def spatial_batchnorm_backward(dout, cache):
   return dx, dgamma, dbeta
 
 
+def spatial_batchnorm_nhwc_forward(x, gamma, beta, bn_param):
+  """
+  Computes the forward pass for spatial batch normalization of channels-last
+  data.
+
+  Inputs:
+  - x: Input data of shape (N, H, W, C)
+  - gamma, beta, bn_param: As for spatial_batchnorm_forward
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, H, W, C)
+  - cache: Values needed for the backward pass
+  """
+  N, H, W, C = x.shape
+  # Viewed as (N * H * W, C, 1, 1) the data has its channels on the axis that
+  # spatial_batchnorm_forward normalizes, without copying or transposing it
+  out, cache = spatial_batchnorm_forward(x.reshape(N * H * W, C, 1, 1),
+                                         gamma, beta, bn_param)
+  return out.reshape(x.shape), (x.shape, cache)
+
+
+def spatial_batchnorm_nhwc_backward(dout, cache):
+  """
+  Computes the backward pass for spatial batch normalization of channels-last
+  data.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, H, W, C)
+  - cache: Values from the forward pass
+
+  Returns a tuple of:
+  - dx: Gradient with respect to inputs, of shape (N, H, W, C)
+  - dgamma: Gradient with respect to scale parameter, of shape (C,)
+  - dbeta: Gradient with respect to shift parameter, of shape (C,)
+  """
+  shape, cache = cache
+  N, H, W, C = shape
+  dx, dgamma, dbeta = spatial_batchnorm_backward(
+      dout.reshape(N * H * W, C, 1, 1), cache)
+  return dx.reshape(shape), dgamma, dbeta
+
+
 def svm_loss(x, y):
   """
   Computes the loss and gradient using for multiclass SVM classification.
@@ -726,7 +1080,46 @@ def svm_loss(x, y):
   return loss, dx
 
 
-def softmax_loss(x, y):
+def softmax_cross_entropy(x, y, weights=None, top_k=None):
+  """
+  Fused log-softmax cross-entropy over the rows of x, shared by softmax_loss
+  and temporal_softmax_loss.
+
+  The loss of row i is log(sum_j exp(x[i, j])) - x[i, y[i]], computed with the
+  log-sum-exp trick, and its gradient is softmax(x[i]) - onehot(y[i]). Both are
+  computed in a single buffer of the size of x which is returned as dx, and
+  that buffer keeps the dtype of x.
+
+  Inputs:
+  - x: Scores of shape (M, C)
+  - y: Labels of shape (M,) where 0 <= y[i] < C
+  - weights: Optional array of shape (M,) giving the weight of each row
+  - top_k: If not None, also find the rows where y[i] is among the top_k scores
+
+  Returns a tuple of:
+  - loss: Weighted sum (not mean) of the per-row losses
+  - dx: Gradient of loss with respect to x, of shape (M, C)
+  - correct: Boolean array of shape (M,) telling whether y[i] is among the
+    top_k scores of row i, or None if top_k is None
+  """
+  rows = np.arange(x.shape[0])
+  dx = x - np.max(x, axis=1, keepdims=True)
+  correct_scores = dx[rows, y]
+  correct = None
+  if top_k is not None:
+    correct = np.sum(dx > correct_scores[:, np.newaxis], axis=1) < top_k
+  np.exp(dx, out=dx)
+  sums = np.sum(dx, axis=1)
+  dx /= sums[:, np.newaxis]
+  dx[rows, y] -= 1
+  losses = np.log(sums) - correct_scores
+  if weights is not None:
+    losses = losses * weights
+    dx *= weights[:, np.newaxis]
+  return np.sum(losses), dx, correct
+
+
+def softmax_loss(x, y, class_weights=None, top_k=None):
   """
   Computes the loss and gradient for softmax classification.
 
@@ -735,16 +1128,24 @@ def softmax_loss(x, y):
     for the ith input.
   - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
     0 <= y[i] < C
+  - class_weights: Optional array of shape (C,); the loss of x[i] is weighted
+    by class_weights[y[i]].
+  - top_k: If not None, also return the top-k accuracy of x.
 
   Returns a tuple of:
   - loss: Scalar giving the loss
   - dx: Gradient of the loss with respect to x
+  - accuracy: Fraction of inputs whose label is among their top_k scores; only
+    returned if top_k is not None
   """
-  probs = np.exp(x - np.max(x, axis=1, keepdims=True))
-  probs /= np.sum(probs, axis=1, keepdims=True)
   N = x.shape[0]
-  loss = -np.sum(np.log(probs[np.arange(N), y])) / N
-  dx = probs.copy()
-  dx[np.arange(N), y] -= 1
+  weights = None if class_weights is None else class_weights[y]
+  loss, dx, correct = softmax_cross_entropy(x, y, weights, top_k)
+  loss /= N
   dx /= N
-  return loss, dx
+  if top_k is None:
+    return loss, dx
+  return loss, dx, np.mean(correct)
+
+
+dtype_policy.instrument(globals())
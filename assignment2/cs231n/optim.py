@@ -1,5 +1,7 @@
 import numpy as np
 
+from cs231n import dtype_policy
+
 """
 This file implements various first-order update rules that are commonly used for
 training neural networks. Each update rule accepts current weights and the
@@ -149,7 +151,5 @@ def adam(x, dx, config=None):
   
   return next_x, config
 
-  
-  
-  
 
+dtype_policy.instrument(globals(), names=('sgd', 'sgd_momentum', 'rmsprop', 'adam'))
@@ -0,0 +1,62 @@
+import copy
+
+import numpy as np
+
+
+"""
+Helpers for gradient checkpointing in the sequential models.
+
+Normally the forward pass of a model keeps the cache of every layer until the
+backward pass, so that the memory held between the two grows linearly with the
+depth of the network. With checkpointing the forward pass only keeps the input
+of every k-th layer (a checkpoint) and drops the caches of the layers in
+between. The backward pass then reruns the forward pass of each segment from
+its checkpoint just before it needs the caches of that segment, so that at any
+time at most one segment holds caches. This costs one extra forward pass over
+all but the last segment, which is about a third of the time of a training
+step, and lets a network with L layers keep O(L / k + k) instead of O(L)
+activations; k = sqrt(L) minimizes this to O(sqrt(L)).
+
+The recomputed forward pass must produce the same values as the original one,
+so layers with state must see the state they had in the original pass: batch
+normalization layers must not update their running averages a second time and
+dropout layers must draw the same masks. Models therefore take a snapshot of
+the bn_param and dropout_param dictionaries of each segment with
+snapshot_params before running it forward, and recompute the segment with the
+snapshot.
+"""
+
+
+def checkpoint_layers(num_layers, every):
+  """
+  Return the indices of the layers whose inputs are kept as checkpoints.
+
+  Inputs:
+  - num_layers: Number of layers L of the network (or of the part of it that
+    is run forward).
+  - every: The segment policy. None keeps the caches of all layers; an integer
+    k keeps the input of every k-th layer; 'sqrt' uses k = sqrt(L), rounded
+    to the nearest integer.
+
+  Returns:
+  - layers: Sorted list of layer indices; always starts with 0. Each segment
+    runs from one checkpoint to the layer before the next one, and the last
+    segment to layer L - 1.
+  """
+  if every is None:
+    return range(num_layers)
+  if every == 'sqrt':
+    every = int(round(np.sqrt(num_layers)))
+  elif not isinstance(every, (int, long)):
+    raise ValueError('Invalid checkpoint policy "%s"' % every)
+  return range(0, num_layers, max(every, 1))
+
+
+def snapshot_params(param):
+  """
+  Return a copy of a bn_param or dropout_param dictionary (or of None) for
+  recomputing a layer. Arrays such as running averages and random number
+  generators are copied, so that running the layer again with the copy
+  reproduces the original pass and leaves param unchanged.
+  """
+  return copy.deepcopy(param)
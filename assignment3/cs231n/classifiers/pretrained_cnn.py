@@ -4,11 +4,43 @@ import h5py
 from cs231n.layers import *
 from cs231n.fast_layers import *
 from cs231n.layer_utils import *
+from cs231n.checkpointing import checkpoint_layers, snapshot_params
 
 
 class PretrainedCNN(object):
-  def __init__(self, dtype=np.float32, num_classes=100, input_size=64, h5_file=None):
+  def __init__(self, dtype=np.float32, num_classes=100, input_size=64, h5_file=None,
+               global_pool=False, workspace_bytes=None, layout='NCHW',
+               checkpoint=None):
+    """
+    Inputs:
+    - dtype: numpy datatype to use for computation.
+    - num_classes: Number of scores produced by the last affine layer.
+    - input_size: Height and width of the input images.
+    - h5_file: If given, load weights from this HDF5 file.
+    - global_pool: If True, average the output of the last conv layer over all
+      spatial positions before the fully-connected hidden layer, which then
+      has 1024 inputs instead of cur_size * cur_size * 1024. Weights saved
+      without global pooling cannot be loaded into such a model.
+    - workspace_bytes: If given, run every convolution with conv_forward_chunked
+      so that no layer holds more than this many bytes of im2col columns; the
+      columns are recomputed in the backward pass instead of being cached.
+      Only used with layout='NCHW'.
+    - layout: 'NCHW' or 'NHWC'. With 'NHWC' the conv layers pass channels-last
+      activations to each other. The inputs and outputs of forward and
+      backward keep the (N, C, H, W) layout, and the weights are the same in
+      both layouts.
+    - checkpoint: Segment policy for gradient checkpointing, as in
+      checkpoint_layers: None keeps the caches of all layers from forward to
+      backward; an integer k or 'sqrt' (k = sqrt(L) for the L layers that are
+      run) keeps only the input of every k-th layer, and backward recomputes
+      the caches of the other layers one segment at a time.
+    """
+    if layout not in ('NCHW', 'NHWC'):
+      raise ValueError('Invalid layout "%s"' % layout)
     self.dtype = dtype
+    self.global_pool = global_pool
+    self.layout = layout
+    self.checkpoint = checkpoint
     self.conv_params = []
     self.input_size = input_size
     self.num_classes = num_classes
@@ -29,6 +61,15 @@ class PretrainedCNN(object):
     self.num_filters = [64, 64, 128, 128, 256, 256, 512, 512, 1024]
     hidden_dim = 512
 
+    # 3x3 convolutions with stride 1 use Winograd's minimal filtering
+    for conv_param, f in zip(self.conv_params, self.filter_sizes):
+      if conv_param['stride'] == 1 and f == 3:
+        conv_param['method'] = 'winograd'
+    if workspace_bytes is not None:
+      for conv_param in self.conv_params:
+        conv_param['method'] = 'chunked'
+        conv_param['workspace_bytes'] = workspace_bytes
+
     self.bn_params = []
     
     cur_size = input_size
@@ -45,7 +86,9 @@ class PretrainedCNN(object):
       if self.conv_params[i]['stride'] == 2: cur_size /= 2
     
     # Add a fully-connected layers
-    fan_in = cur_size * cur_size * self.num_filters[-1]
+    fan_in = self.num_filters[-1]
+    if not global_pool:
+      fan_in *= cur_size * cur_size
     self.params['W%d' % (i + 2)] = np.sqrt(2.0 / fan_in) * np.random.randn(fan_in, hidden_dim)
     self.params['b%d' % (i + 2)] = np.zeros(hidden_dim)
     self.params['gamma%d' % (i + 2)] = np.ones(hidden_dim)
@@ -101,6 +144,21 @@ class PretrainedCNN(object):
     for k, v in self.params.iteritems():
       self.params[k] = v.astype(self.dtype)
 
+    self.invalidate_winograd_filters()
+
+
+  def invalidate_winograd_filters(self):
+    """
+    Drop the Winograd filter transforms cached by test-time forward passes.
+
+    The cached transforms are only recomputed when a weight in self.params is
+    replaced by a different array, so this must be called after modifying
+    weights in place (for example self.params['W2'][...] = 0) outside of a
+    training pass.
+    """
+    for conv_param in self.conv_params:
+      conv_param.pop('winograd_filters', None)
+
   
   def forward(self, X, start=None, end=None, mode='test'):
     """
@@ -117,6 +175,17 @@ class PretrainedCNN(object):
     [affine - batchnorm - relu] (There is one of these)
     [affine] (There is one of these)
 
+    If the model was built with global_pool=True, the affine - batchnorm - relu
+    layer starts with a global average pool over its input.
+
+    With layout='NHWC' the input is transposed once before the first conv
+    layer and the conv layers then work on channels-last activations; the
+    output of a conv end layer is returned as an (N, C, H, W) view.
+
+    If the model was built with a checkpoint policy, the cache only holds the
+    inputs of the checkpoint layers and the caches of the last segment; the
+    backward method recomputes the others.
+
     Inputs:
     - X: The input to the starting layer. If start=0, then this should be an
       array of shape (N, C, 64, 64).
@@ -135,42 +204,129 @@ class PretrainedCNN(object):
     X = X.astype(self.dtype)
     if start is None: start = 0
     if end is None: end = len(self.conv_params) + 1
+    nhwc = self.layout == 'NHWC'
+
+    # With checkpointing only the inputs of the checkpoint layers are kept,
+    # together with snapshots of the bn_params of their segments, and the
+    # caches of the other layers are dropped except in the last segment.
+    layers = range(start, end + 1)
+    starts = [layers[j] for j in checkpoint_layers(len(layers), self.checkpoint)]
     layer_caches = []
+    checkpoints = {}
 
     prev_a = X
-    for i in xrange(start, end + 1):
-      i1 = i + 1
-      if 0 <= i < len(self.conv_params):
-        # This is a conv layer
-        w, b = self.params['W%d' % i1], self.params['b%d' % i1]
-        gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
-        conv_param = self.conv_params[i]
+    if nhwc and start < len(self.conv_params):
+      prev_a = X.transpose(0, 2, 3, 1)
+    for i in layers:
+      bn_param = None
+      if 0 <= i < len(self.bn_params):
         bn_param = self.bn_params[i]
         bn_param['mode'] = mode
+      if self.checkpoint is not None:
+        if i in starts:
+          checkpoints[i] = (prev_a, mode, [])
+        checkpoints[max(checkpoints)][2].append(snapshot_params(bn_param))
 
-        next_a, cache = conv_bn_relu_forward(prev_a, w, b, gamma, beta, conv_param, bn_param)
-      elif i == len(self.conv_params):
-        # This is the fully-connected hidden layer
-        w, b = self.params['W%d' % i1], self.params['b%d' % i1]
-        gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
-        bn_param = self.bn_params[i]
-        bn_param['mode'] = mode
-        next_a, cache = affine_bn_relu_forward(prev_a, w, b, gamma, beta, bn_param)
-      elif i == len(self.conv_params) + 1:
-        # This is the last fully-connected layer that produces scores
-        w, b = self.params['W%d' % i1], self.params['b%d' % i1]
-        next_a, cache = affine_forward(prev_a, w, b)
-      else:
-        raise ValueError('Invalid layer index %d' % i)
+      next_a, cache = self._layer_forward(i, prev_a, start, mode, bn_param)
 
+      if self.checkpoint is not None and i < starts[-1]:
+        cache = None
       layer_caches.append(cache)
       prev_a = next_a
 
     out = prev_a
-    cache = (start, end, layer_caches)
+    if nhwc and end < len(self.conv_params):
+      out = out.transpose(0, 3, 1, 2)
+    cache = (start, end, layer_caches, checkpoints)
     return out, cache
 
 
+  def _layer_forward(self, i, prev_a, start, mode, bn_param):
+    """
+    Run the forward pass of one layer.
+
+    Inputs:
+    - i: Index of the layer.
+    - prev_a: Input of the layer; channels-last for a conv layer in NHWC mode.
+    - start: Index of the first layer of the forward pass.
+    - mode: 'test' or 'train'.
+    - bn_param: The bn_param of the layer or a snapshot of it to recompute the
+      layer; None for the last layer.
+
+    Returns a tuple of:
+    - next_a: Output of the layer.
+    - cache: Cache for the backward pass of the layer.
+    """
+    i1 = i + 1
+    nhwc = self.layout == 'NHWC'
+    if 0 <= i < len(self.conv_params):
+      # This is a conv layer
+      w, b = self.params['W%d' % i1], self.params['b%d' % i1]
+      gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
+      conv_param = self.conv_params[i]
+
+      # Winograd filter transforms are stored with the weights they were
+      # computed from and reused by later test-time passes while self.params
+      # holds the same array; training passes drop them since they precede a
+      # weight update. See invalidate_winograd_filters for in-place edits.
+      if conv_param.get('method') == 'winograd':
+        if mode == 'test':
+          filters = conv_param.get('winograd_filters')
+          if filters is None or filters[0] is not w:
+            conv_param['winograd_filters'] = (w, winograd_filter_transform(w))
+        else:
+          conv_param.pop('winograd_filters', None)
+
+      if nhwc:
+        return conv_bn_relu_nhwc_forward(prev_a, w, b, gamma, beta,
+                                         conv_param, bn_param)
+      return conv_bn_relu_forward(prev_a, w, b, gamma, beta, conv_param,
+                                  bn_param)
+    elif i == len(self.conv_params):
+      # This is the fully-connected hidden layer
+      w, b = self.params['W%d' % i1], self.params['b%d' % i1]
+      gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
+      gap_cache = None
+      # The activations of a preceding conv layer are channels-last in
+      # NHWC mode; the weights take them in (C, H, W) order
+      nhwc_in = nhwc and start < i
+      if self.global_pool and nhwc_in:
+        prev_a, gap_cache = global_avg_pool_nhwc_forward(prev_a)
+      elif self.global_pool:
+        prev_a, gap_cache = global_avg_pool_forward(prev_a)
+      elif nhwc_in:
+        prev_a = prev_a.transpose(0, 3, 1, 2)
+      next_a, cache = affine_bn_relu_forward(prev_a, w, b, gamma, beta, bn_param)
+      return next_a, (gap_cache, cache)
+    elif i == len(self.conv_params) + 1:
+      # This is the last fully-connected layer that produces scores
+      w, b = self.params['W%d' % i1], self.params['b%d' % i1]
+      return affine_forward(prev_a, w, b)
+    else:
+      raise ValueError('Invalid layer index %d' % i)
+
+
+  def _recompute_segment(self, seg_start, start, checkpoint):
+    """
+    Run the layers of a checkpointed segment forward again.
+
+    Inputs:
+    - seg_start: Index of the first layer of the segment.
+    - start: Index of the first layer of the forward pass.
+    - checkpoint: Tuple (input, mode, bn_params) stored by forward for the
+      segment, where bn_params are the snapshots of the layers' bn_params.
+
+    Returns:
+    - caches: List of the caches of the layers of the segment.
+    """
+    a, mode, bn_params = checkpoint
+    caches = []
+    for i, bn_param in enumerate(bn_params, seg_start):
+      a, cache = self._layer_forward(i, a, start, mode, bn_param)
+      caches.append(cache)
+    return caches
+
+
   def backward(self, dout, cache):
     """
     Run the model backward over a sequence of layers that were previously run
@@ -191,11 +347,19 @@ class PretrainedCNN(object):
       layers. The grads dictionary will therefore contain a subset of the keys
       of self.params, and grads[k] and self.params[k] will have the same shape.
     """
-    start, end, layer_caches = cache
+    start, end, layer_caches, checkpoints = cache
+    nhwc = self.layout == 'NHWC'
     dnext_a = dout
+    if nhwc and end < len(self.conv_params):
+      dnext_a = dout.transpose(0, 2, 3, 1)
     grads = {}
     for i in reversed(range(start, end + 1)):
       i1 = i + 1
+      if layer_caches[-1] is None:
+        # Recompute the segment that ends with this layer
+        seg_start = max(j for j in checkpoints if j <= i)
+        layer_caches[seg_start - start:] = self._recompute_segment(
+          seg_start, start, checkpoints.pop(seg_start))
       if i == len(self.conv_params) + 1:
         # This is the last fully-connected layer
         dprev_a, dw, db = affine_backward(dnext_a, layer_caches.pop())
@@ -203,15 +367,26 @@ class PretrainedCNN(object):
         grads['b%d' % i1] = db
       elif i == len(self.conv_params):
         # This is the fully-connected hidden layer
-        temp = affine_bn_relu_backward(dnext_a, layer_caches.pop())
+        gap_cache, cache = layer_caches.pop()
+        temp = affine_bn_relu_backward(dnext_a, cache)
         dprev_a, dw, db, dgamma, dbeta = temp
+        nhwc_in = nhwc and start < i
+        if gap_cache is not None and nhwc_in:
+          dprev_a = global_avg_pool_nhwc_backward(dprev_a, gap_cache)
+        elif gap_cache is not None:
+          dprev_a = global_avg_pool_backward(dprev_a, gap_cache)
+        elif nhwc_in:
+          dprev_a = dprev_a.transpose(0, 2, 3, 1)
         grads['W%d' % i1] = dw
         grads['b%d' % i1] = db
         grads['gamma%d' % i1] = dgamma
         grads['beta%d' % i1] = dbeta
       elif 0 <= i < len(self.conv_params):
         # This is a conv layer
-        temp = conv_bn_relu_backward(dnext_a, layer_caches.pop())
+        if nhwc:
+          temp = conv_bn_relu_nhwc_backward(dnext_a, layer_caches.pop())
+        else:
+          temp = conv_bn_relu_backward(dnext_a, layer_caches.pop())
         dprev_a, dw, db, dgamma, dbeta = temp
         grads['W%d' % i1] = dw
         grads['b%d' % i1] = db
@@ -222,6 +397,8 @@ class PretrainedCNN(object):
       dnext_a = dprev_a
 
     dX = dnext_a
+    if nhwc and start < len(self.conv_params):
+      dX = dX.transpose(0, 3, 1, 2)
     return dX, grads
 
 
@@ -2,6 +2,7 @@ import numpy as np
 
 from cs231n.layers import *
 from cs231n.rnn_layers import *
+from cs231n.tape import Tape
 
 
 class CaptioningRNN(object):
@@ -14,6 +15,9 @@ class CaptioningRNN(object):
   of dimension W, and operates on minibatches of size N.
 
   Note that we don't use any regularization for the CaptioningRNN.
+
+  The loss runs its layers through a Tape and keeps the peak bytes of caches
+  and gradients that were live at the same time in self.peak_bytes.
   """
   
   def __init__(self, word_to_idx, input_dim=512, wordvec_dim=128,
@@ -39,6 +43,7 @@ class CaptioningRNN(object):
     self.word_to_idx = word_to_idx
     self.idx_to_word = {i: w for w, i in word_to_idx.iteritems()}
     self.params = {}
+    self.peak_bytes = 0
     
     vocab_size = len(word_to_idx)
 
@@ -88,6 +93,8 @@ class CaptioningRNN(object):
     - loss: Scalar loss
     - grads: Dictionary of gradients parallel to self.params
     """
+    features = features.astype(self.dtype)
+
     # Cut captions into two pieces: captions_in has everything but the last word
     # and will be input to the RNN; captions_out has everything but the first
     # word and this is what we will expect the RNN to generate. These are offset
@@ -135,39 +142,32 @@ class CaptioningRNN(object):
     # defined above to store loss and gradients; grads[k] should give the      #
     # gradients for self.params[k].                                            #
     ############################################################################
-    h0, h0_cache = affine_forward(features, W_proj, b_proj)
-
-    we, we_cache = word_embedding_forward(captions_in, W_embed)
-
-    if self.cell_type == 'rnn':
-      (h, rnn_cache) = rnn_forward(we, h0, Wx, Wh, b)
-    else:
-      (h, rnn_cache) = lstm_forward(we, h0, Wx, Wh, b)
-
-    (vs, vs_cache) = temporal_affine_forward(h, W_vocab, b_vocab)
-
-    loss, dloss = temporal_softmax_loss(vs, captions_out, mask)
+    # The layers run through a tape, which releases each cache and
+    # intermediate gradient as soon as the backward pass has used it
+    tape = Tape(exclude=self.params.values())
+    h0 = tape.run(affine_forward, affine_backward,
+                  'h0', (None, 'W_proj', 'b_proj'), features, W_proj, b_proj)
 
-    (dh, dW_vocab, db_vocab) = temporal_affine_backward(dloss, vs_cache)
+    x = tape.run(word_embedding_forward, word_embedding_backward,
+                 'we', ('W_embed',), captions_in, W_embed)
 
     if self.cell_type == 'rnn':
-      dwe, dh0, dWx, dWh, db = rnn_backward(dh, rnn_cache)
+      rnn_layer = (rnn_forward, rnn_backward)
     else:
-      dwe, dh0, dWx, dWh, db = lstm_backward(dh, rnn_cache)
+      rnn_layer = (lstm_forward, lstm_backward)
+    x = tape.run(rnn_layer[0], rnn_layer[1],
+                 'h', ('we', 'h0', 'Wx', 'Wh', 'b'), x, h0, Wx, Wh, b)
+    del h0
 
-    dW_embed = word_embedding_backward(dwe, we_cache)
+    x = tape.run(temporal_affine_forward, temporal_affine_backward,
+                 'scores', ('h', 'W_vocab', 'b_vocab'), x, W_vocab, b_vocab)
 
-    _, dW_proj, db_proj = affine_backward(dh0, h0_cache)
+    loss, dscores = temporal_softmax_loss(x, captions_out, mask)
+    douts = {'scores': dscores}
+    del x, dscores
 
-    grads = {}
-    grads["W_embed"] = dW_embed
-    grads["Wx"] = dWx
-    grads["Wh"] = dWh
-    grads["b"] = db
-    grads["W_vocab"] = dW_vocab
-    grads["b_vocab"] = db_vocab
-    grads["W_proj"] = dW_proj
-    grads["b_proj"] = db_proj
+    grads = tape.backward(douts)
+    self.peak_bytes = tape.peak_bytes
 
     ############################################################################
     #                             END OF YOUR CODE                             #
@@ -200,6 +200,7 @@ class CaptioningRNN(object):
       where each element is an integer in the range [0, V). The first element
       of captions should be the first sampled word, not the <START> token.
     """
+    features = features.astype(self.dtype)
     N = features.shape[0]
     captions = self._null * np.ones((N, max_length), dtype=np.int32)
 
@@ -1,44 +1,50 @@
 import cPickle as pickle
+import json
+import struct
 import numpy as np
 import os
+from collections import OrderedDict
 from scipy.misc import imread
 
-def load_CIFAR_batch(filename):
-  """ load single batch of cifar """
+from cs231n.dtype_policy import float_dtype
+
+def load_CIFAR_batch(filename, dtype=None):
+  """ load single batch of cifar as dtype, by default the float dtype policy """
   with open(filename, 'rb') as f:
     datadict = pickle.load(f)
     X = datadict['data']
     Y = datadict['labels']
-    X = X.reshape(10000, 3, 32, 32).transpose(0,2,3,1).astype("float")
+    X = X.reshape(-1, 3, 32, 32).transpose(0,2,3,1).astype(float_dtype(dtype))
     Y = np.array(Y)
     return X, Y
 
-def load_CIFAR10(ROOT):
-  """ load all of cifar """
+def load_CIFAR10(ROOT, dtype=None):
+  """ load all of cifar as dtype, by default the float dtype policy """
   xs = []
   ys = []
   for b in range(1,6):
     f = os.path.join(ROOT, 'data_batch_%d' % (b, ))
-    X, Y = load_CIFAR_batch(f)
+    X, Y = load_CIFAR_batch(f, dtype)
     xs.append(X)
     ys.append(Y)    
   Xtr = np.concatenate(xs)
   Ytr = np.concatenate(ys)
   del X, Y
-  Xte, Yte = load_CIFAR_batch(os.path.join(ROOT, 'test_batch'))
+  Xte, Yte = load_CIFAR_batch(os.path.join(ROOT, 'test_batch'), dtype)
   return Xtr, Ytr, Xte, Yte
 
 
 def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
-                     subtract_mean=True):
+                     subtract_mean=True, dtype=None):
     """
     Load the CIFAR-10 dataset from disk and perform preprocessing to prepare
     it for classifiers. These are the same steps as we used for the SVM, but
-    condensed to a single function.
+    condensed to a single function. The images are returned as dtype, by
+    default the float dtype policy (see cs231n/dtype_policy.py).
     """
     # Load the raw CIFAR-10 data
     cifar10_dir = 'cs231n/datasets/cifar-10-batches-py'
-    X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir)
+    X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir, dtype)
         
     # Subsample the data
     mask = range(num_training, num_training + num_validation)
@@ -208,6 +214,9 @@ def load_models(models_dir):
 
   Returns:
   A dictionary mapping model file names to models.
+
+  This loads every model into memory up front; for large directories use
+  ModelRegistry with models saved by save_model instead.
   """
   models = {}
   for model_file in os.listdir(models_dir):
@@ -217,3 +226,194 @@ def load_models(models_dir):
       except pickle.UnpicklingError:
         continue
   return models
+
+
+# Every model file written by save_model starts with this magic string,
+# followed by a little-endian uint32 giving the length of a JSON header. The
+# raw parameter arrays follow the header, each aligned to MODEL_ALIGN bytes so
+# that they can be memory-mapped directly.
+MODEL_MAGIC = 'CS231NMD'
+MODEL_ALIGN = 64
+
+
+def _align(offset):
+  return (offset + MODEL_ALIGN - 1) // MODEL_ALIGN * MODEL_ALIGN
+
+
+def save_model(filename, params, metadata=None):
+  """
+  Save model parameters in a format that ModelRegistry can index by reading
+  only a small header, and whose arrays can later be memory-mapped.
+
+  Inputs:
+  - filename: Path of the file to write.
+  - params: Dictionary mapping parameter names to numpy arrays.
+  - metadata: Optional JSON-serializable dictionary stored in the header, such
+    as the model class, hyperparameters or validation accuracy.
+  """
+  arrays = [(k, np.ascontiguousarray(v)) for k, v in sorted(params.iteritems())]
+
+  # The header records absolute offsets but its own length shifts them, so
+  # grow the space reserved for it until the header fits.
+  data_start = 0
+  while True:
+    layout, offset = {}, data_start
+    for k, v in arrays:
+      offset = _align(offset)
+      layout[k] = {'dtype': v.dtype.str, 'shape': list(v.shape),
+                   'offset': offset}
+      offset += v.nbytes
+    header = {'params': layout, 'metadata': metadata or {}}
+    header_bytes = json.dumps(header, sort_keys=True)
+    header_end = len(MODEL_MAGIC) + 4 + len(header_bytes)
+    if header_end <= data_start:
+      break
+    data_start = _align(header_end)
+
+  with open(filename, 'wb') as f:
+    f.write(MODEL_MAGIC)
+    f.write(struct.pack('<I', len(header_bytes)))
+    f.write(header_bytes)
+    for k, v in arrays:
+      f.write('\0' * (layout[k]['offset'] - f.tell()))
+      f.write(v.tobytes())
+
+
+def read_model_header(filename):
+  """
+  Read the header of a file written by save_model without touching any of the
+  parameter data.
+
+  Returns:
+  The header dictionary, with keys 'params' (name -> dtype, shape and offset)
+  and 'metadata', or None if the file is not a model file.
+  """
+  with open(filename, 'rb') as f:
+    if f.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+      return None
+    size = f.read(4)
+    if len(size) != 4:
+      return None
+    header = f.read(struct.unpack('<I', size)[0])
+  try:
+    return json.loads(header)
+  except ValueError:
+    return None
+
+
+class ModelRegistry(object):
+  """
+  A lazy replacement for load_models. Creating a registry only reads the small
+  header of each model file in a directory; the parameters of a model are read
+  the first time the model is accessed. At most max_resident models are kept
+  alive at once and the least recently used one is dropped when that limit is
+  exceeded.
+
+  Example usage:
+
+  registry = ModelRegistry('cs231n/models', max_resident=2)
+  print registry.keys()
+  params = registry['model_1.npm']  # parameters are only loaded here
+  print registry.metadata('model_1.npm')
+  """
+
+  def __init__(self, models_dir, max_resident=4, mmap_mode='r'):
+    """
+    Inputs:
+    - models_dir: String giving the path to a directory containing model files
+      written by save_model. Any other files (such as README.txt or old
+      pickles) are skipped.
+    - max_resident: Maximum number of models whose parameters are kept loaded;
+      None means no limit.
+    - mmap_mode: Passed to np.memmap when loading parameters; 'r' maps them
+      read-only and 'c' gives copy-on-write arrays that can be modified in
+      place. If None then parameters are read into ordinary arrays.
+    """
+    self.models_dir = models_dir
+    self.max_resident = max_resident
+    self.mmap_mode = mmap_mode
+    self._headers = {}
+    self._resident = OrderedDict()
+    for model_file in sorted(os.listdir(models_dir)):
+      path = os.path.join(models_dir, model_file)
+      if not os.path.isfile(path):
+        continue
+      try:
+        header = read_model_header(path)
+      except IOError:
+        continue
+      if header is not None:
+        self._headers[model_file] = header
+
+  def keys(self):
+    return sorted(self._headers.keys())
+
+  def __len__(self):
+    return len(self._headers)
+
+  def __contains__(self, name):
+    return name in self._headers
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def metadata(self, name):
+    """
+    Return the metadata dictionary stored with a model without loading it.
+    """
+    return self._headers[name]['metadata']
+
+  def param_shapes(self, name):
+    """
+    Return a dictionary mapping parameter names of a model to their shapes
+    without loading it.
+    """
+    params = self._headers[name]['params']
+    return {k: tuple(v['shape']) for k, v in params.iteritems()}
+
+  def resident(self):
+    """
+    Return the names of currently loaded models, least recently used first.
+    """
+    return list(self._resident.keys())
+
+  def evict(self, name=None):
+    """
+    Drop the loaded parameters of a model, or of all models if name is None.
+    """
+    if name is None:
+      self._resident.clear()
+    else:
+      self._resident.pop(name, None)
+
+  def __getitem__(self, name):
+    """
+    Return the parameters of a model as a dictionary mapping parameter names
+    to arrays, loading them on first access.
+    """
+    if name not in self._headers:
+      raise KeyError(name)
+    if name in self._resident:
+      params = self._resident.pop(name)
+    else:
+      params = self._load(name)
+    self._resident[name] = params
+    if self.max_resident is not None:
+      while len(self._resident) > self.max_resident:
+        self._resident.popitem(last=False)
+    return params
+
+  def _load(self, name):
+    path = os.path.join(self.models_dir, name)
+    params = {}
+    for k, info in self._headers[name]['params'].iteritems():
+      dtype, shape = np.dtype(str(info['dtype'])), tuple(info['shape'])
+      if self.mmap_mode is not None and np.prod(shape) > 0:
+        params[k] = np.memmap(path, dtype=dtype, mode=self.mmap_mode,
+                              offset=info['offset'], shape=shape)
+      else:
+        with open(path, 'rb') as f:
+          f.seek(info['offset'])
+          count = int(np.prod(shape))
+          params[k] = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+    return params
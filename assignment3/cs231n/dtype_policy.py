@@ -0,0 +1,116 @@
+import functools
+import os
+import warnings
+
+import numpy as np
+
+
+"""
+A global datatype policy for floating point arrays.
+
+FLOAT_DTYPE is the datatype in which the data loaders return images and which
+the layers, models and update rules are expected to keep for activations,
+gradients and optimizer state. It defaults to float64, which the numeric
+gradient checks need; set the environment variable CS231N_FLOAT_DTYPE=float32
+(or call set_float_dtype(np.float32) before loading data) to run everything in
+float32, which halves the memory traffic and lets BLAS use its single precision
+kernels.
+
+Layers allocate their outputs and gradients in the dtype of their inputs, so a
+float64 array anywhere in a float32 network is an upcast that doubles the cost
+of everything downstream of it. To find such upcasts set CS231N_DTYPE_DEBUG=1:
+the forward, backward and loss functions of layers, fast_layers, layer_utils
+and rnn_layers and the update rules in optim are then wrapped at import time so
+that they issue an UpcastWarning whenever they return a floating point array
+that is wider than FLOAT_DTYPE. The warning names the function that returned
+the array; use warnings.simplefilter('error', UpcastWarning) to stop there.
+"""
+
+
+FLOAT_DTYPE = np.dtype(os.environ.get('CS231N_FLOAT_DTYPE', 'float64'))
+DEBUG = os.environ.get('CS231N_DTYPE_DEBUG', '0') != '0'
+
+
+class UpcastWarning(RuntimeWarning):
+  pass
+
+
+def set_float_dtype(dtype):
+  """
+  Set FLOAT_DTYPE. Arrays that already exist keep their datatype.
+  """
+  global FLOAT_DTYPE
+  FLOAT_DTYPE = np.dtype(dtype)
+
+
+def float_dtype(dtype=None):
+  """
+  Return np.dtype(dtype) if dtype is given and FLOAT_DTYPE otherwise; used for
+  the dtype=None defaults of the data loaders.
+  """
+  return FLOAT_DTYPE if dtype is None else np.dtype(dtype)
+
+
+def _float_arrays(value):
+  """
+  Yield all floating point arrays in value, searching tuples, lists and
+  dictionaries such as caches and optimizer configs.
+  """
+  if isinstance(value, np.ndarray):
+    if value.dtype.kind == 'f':
+      yield value
+  elif isinstance(value, (tuple, list)):
+    for v in value:
+      for a in _float_arrays(v):
+        yield a
+  elif isinstance(value, dict):
+    for v in value.itervalues():
+      for a in _float_arrays(v):
+        yield a
+
+
+def check_upcasts(fn):
+  """
+  Wrap fn so that it issues an UpcastWarning whenever it returns a floating
+  point array that is wider than FLOAT_DTYPE.
+  """
+  @functools.wraps(fn)
+  def wrapper(*args, **kwargs):
+    result = fn(*args, **kwargs)
+    for a in _float_arrays(result):
+      if a.dtype.itemsize > FLOAT_DTYPE.itemsize:
+        warnings.warn('%s returned a %s array of shape %s, but the float dtype '
+                      'policy is %s' % (fn.__name__, a.dtype, a.shape,
+                                        FLOAT_DTYPE),
+                      UpcastWarning, stacklevel=2)
+        break
+    return result
+  return wrapper
+
+
+def instrument(namespace, names=None):
+  """
+  In debug mode, replace functions defined in a module by check_upcasts
+  wrappers; modules call this as instrument(globals()) after their last
+  definition. Does nothing unless DEBUG is set.
+
+  Inputs:
+  - namespace: The globals() of the module.
+  - names: Names of the functions to wrap. By default all functions with
+    _forward or _backward in their name and all functions ending in _loss.
+  """
+  if not DEBUG:
+    return
+  module = namespace['__name__']
+  for name, fn in namespace.items():
+    if not callable(fn) or isinstance(fn, type):
+      continue
+    if getattr(fn, '__module__', None) != module:
+      continue
+    if names is None:
+      if ('_forward' not in name and '_backward' not in name
+          and not name.endswith('_loss')):
+        continue
+    elif name not in names:
+      continue
+    namespace[name] = check_upcasts(fn)
@@ -1,11 +1,34 @@
+from collections import OrderedDict
+
 import numpy as np
 
 
-def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
+# Index arrays of get_im2col_indices and col2im_indices, keyed by the shape of
+# one image and the layer parameters. Building them costs about as much as the
+# gather itself, and a network only ever sees a handful of distinct shapes, so
+# the most recently used INDEX_CACHE_SIZE entries are kept. The arrays do not
+# depend on the batch size, so the cache does not grow with it.
+INDEX_CACHE_SIZE = 32
+_index_cache = OrderedDict()
+
+
+def _cached(key, build):
+  """ Return the cached value for key, building it on a miss. """
+  try:
+    value = _index_cache.pop(key)
+  except KeyError:
+    value = build()
+    if len(_index_cache) >= INDEX_CACHE_SIZE:
+      _index_cache.popitem(last=False)
+  _index_cache[key] = value
+  return value
+
+
+def _build_im2col_indices(x_shape, field_height, field_width, padding, stride):
   # First figure out what the size of the output should be
   N, C, H, W = x_shape
   assert (H + 2 * padding - field_height) % stride == 0
-  assert (W + 2 * padding - field_height) % stride == 0
+  assert (W + 2 * padding - field_width) % stride == 0
   out_height = (H + 2 * padding - field_height) / stride + 1
   out_width = (W + 2 * padding - field_width) / stride + 1
 
@@ -19,9 +42,19 @@ def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
 
   k = np.repeat(np.arange(C), field_height * field_width).reshape(-1, 1)
 
+  # The arrays are shared through the cache, so they must not be modified
+  for a in (k, i, j):
+    a.setflags(write=False)
   return (k, i, j)
 
 
+def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
+  key = ('im2col', tuple(x_shape[1:]), field_height, field_width, padding,
+         stride)
+  return _cached(key, lambda: _build_im2col_indices(
+      x_shape, field_height, field_width, padding, stride))
+
+
 def im2col_indices(x, field_height, field_width, padding=1, stride=1):
   """ An implementation of im2col based on some fancy indexing """
   # Zero-pad the input
@@ -39,17 +72,188 @@ def im2col_indices(x, field_height, field_width, padding=1, stride=1):
 
 def col2im_indices(cols, x_shape, field_height=3, field_width=3, padding=1,
                    stride=1):
-  """ An implementation of col2im based on fancy indexing and np.add.at """
+  """
+  An implementation of col2im based on fancy indexing. The scatter-add is a
+  single np.bincount over flat indices into the padded images, which is much
+  faster than np.add.at. The indices into one image are cached and the offset
+  of each image is added per call.
+  """
   N, C, H, W = x_shape
   H_padded, W_padded = H + 2 * padding, W + 2 * padding
-  x_padded = np.zeros((N, C, H_padded, W_padded), dtype=cols.dtype)
-  k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding,
-                               stride)
-  cols_reshaped = cols.reshape(C * field_height * field_width, -1, N)
-  cols_reshaped = cols_reshaped.transpose(2, 0, 1)
-  np.add.at(x_padded, (slice(None), k, i, j), cols_reshaped)
+
+  def build():
+    k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding,
+                                 stride)
+    # Flat index into one padded image of every row (k, i, j) of cols and
+    # every output position
+    flat = (k * H_padded + i) * W_padded + j
+    flat.setflags(write=False)
+    return flat
+
+  key = ('col2im', (C, H, W), field_height, field_width, padding, stride)
+  flat = _cached(key, build)
+  # Flat index into x_padded of every entry of cols, in the memory order of
+  # cols: rows (k, i, j), then output positions, then the batch
+  flat = flat[:, :, None] + C * H_padded * W_padded * np.arange(N)
+  flat = flat.ravel()
+  x_padded = np.bincount(flat, weights=cols.ravel(),
+                         minlength=N * C * H_padded * W_padded)
+  x_padded = x_padded.astype(cols.dtype, copy=False)
+  x_padded.shape = (N, C, H_padded, W_padded)
   if padding == 0:
     return x_padded
   return x_padded[:, :, padding:-padding, padding:-padding]
 
+
+# Pure-numpy versions of the kernels in im2col_cython.pyx, with the same
+# signatures and results. fast_layers uses them when the Cython extension is
+# not built. They gather with stride tricks and scatter with one strided add
+# per filter tap, so no index arrays are needed.
+
+
+def _window_view(x_padded, field_height, field_width, out_h, out_w, stride):
+  """
+  View of shape (N, C, field_height, field_width, out_h, out_w) into x_padded
+  whose [n, c, ii, jj, yy, xx] entry is x_padded[n, c, stride * yy + ii,
+  stride * xx + jj].
+  """
+  sN, sC, sH, sW = x_padded.strides
+  N, C = x_padded.shape[:2]
+  return np.lib.stride_tricks.as_strided(
+      x_padded, shape=(N, C, field_height, field_width, out_h, out_w),
+      strides=(sN, sC, sH, sW, stride * sH, stride * sW))
+
+
+def im2col_numpy(x, field_height, field_width, padding, stride):
+  N, C, H, W = x.shape
+  out_h = (H + 2 * padding - field_height) / stride + 1
+  out_w = (W + 2 * padding - field_width) / stride + 1
+  p = padding
+  x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+  windows = _window_view(x_padded, field_height, field_width, out_h, out_w,
+                         stride)
+  cols = np.ascontiguousarray(windows.transpose(1, 2, 3, 4, 5, 0))
+  cols.shape = (C * field_height * field_width, out_h * out_w * N)
+  return cols
+
+
+def _col2im_taps(taps, N, C, H, W, field_height, field_width, padding, stride,
+                 dtype):
+  """
+  Sum taps(ii, jj), an (N, C, out_h, out_w) array for each filter tap, into
+  the image positions that the tap reads from.
+  """
+  H_padded, W_padded = H + 2 * padding, W + 2 * padding
+  out_h = (H_padded - field_height) / stride + 1
+  out_w = (W_padded - field_width) / stride + 1
+  x_padded = np.zeros((N, C, H_padded, W_padded), dtype=dtype)
+  for ii in xrange(field_height):
+    for jj in xrange(field_width):
+      x_padded[:, :, ii:ii + stride * out_h:stride,
+               jj:jj + stride * out_w:stride] += taps(ii, jj)
+  if padding > 0:
+    return x_padded[:, :, padding:-padding, padding:-padding]
+  return x_padded
+
+
+def col2im_numpy(cols, N, C, H, W, field_height, field_width, padding,
+                 stride):
+  out_h = (H + 2 * padding - field_height) / stride + 1
+  out_w = (W + 2 * padding - field_width) / stride + 1
+  cols = cols.reshape(C, field_height, field_width, out_h, out_w, N)
+  return _col2im_taps(lambda ii, jj: cols[:, ii, jj].transpose(3, 0, 1, 2),
+                      N, C, H, W, field_height, field_width, padding, stride,
+                      cols.dtype)
+
+
+def col2im_6d_numpy(cols, N, C, H, W, HH, WW, pad, stride):
+  return _col2im_taps(lambda ii, jj: cols[:, ii, jj].transpose(1, 0, 2, 3),
+                      N, C, H, W, HH, WW, pad, stride, cols.dtype)
+
+
+def col2im_nhwc_numpy(cols, H, W, pad, stride):
+  N, out_h, out_w, HH, WW, C = cols.shape
+  x_padded = np.zeros((N, H + 2 * pad, W + 2 * pad, C), dtype=cols.dtype)
+  for ii in xrange(HH):
+    for jj in xrange(WW):
+      x_padded[:, ii:ii + stride * out_h:stride,
+               jj:jj + stride * out_w:stride] += cols[:, :, :, ii, jj]
+  return x_padded[:, pad:pad + H, pad:pad + W]
+
+
+def bias_relu_pool_numpy(res, b):
+  F, N, H, W = res.shape
+  PH, PW = H / 2, W / 2
+  windows = res.reshape(F, N, PH, 2, PW, 2).transpose(1, 0, 2, 4, 3, 5)
+  windows = windows.reshape(N, F, PH, PW, 4)
+  idx = windows.argmax(axis=4)
+  out = np.take_along_axis(windows, idx[..., None], axis=4)[..., 0]
+  out += b.reshape(1, F, 1, 1)
+  dead = out <= 0
+  out[dead] = 0
+  idx = idx.astype(np.int8)
+  idx[dead] = -1
+  return out, idx
+
+
+def relu_pool_backward_numpy(dout, idx):
+  N, F, PH, PW = dout.shape
+  da = np.zeros((N, F, PH, PW, 4), dtype=dout.dtype)
+  live = idx >= 0
+  da.reshape(-1, 4)[np.flatnonzero(live), idx[live]] = dout[live]
+  da = da.reshape(N, F, PH, PW, 2, 2).transpose(1, 0, 2, 4, 3, 5)
+  return np.ascontiguousarray(da).reshape(F, N, 2 * PH, 2 * PW)
+
+
+def max_pool_numpy(x, pool_height, pool_width, stride):
+  N, C, H, W = x.shape
+  assert pool_height * pool_width <= 256, 'pooling window is too large'
+  out_h = (H - pool_height) / stride + 1
+  out_w = (W - pool_width) / stride + 1
+  windows = _window_view(np.ascontiguousarray(x), pool_height, pool_width,
+                         out_h, out_w, stride)
+  windows = windows.transpose(0, 1, 4, 5, 2, 3).reshape(
+      N, C, out_h, out_w, pool_height * pool_width)
+  idx = windows.argmax(axis=4)
+  out = np.take_along_axis(windows, idx[..., None], axis=4)[..., 0]
+  return out, idx.astype(np.uint8)
+
+
+def max_pool_backward_numpy(dout, idx, H, W, pool_width, stride):
+  N, C, out_h, out_w = dout.shape
+  dx = np.zeros((N, C, H, W), dtype=dout.dtype)
+  for k in np.unique(idx):
+    ii, jj = k // pool_width, k % pool_width
+    dx[:, :, ii:ii + stride * out_h:stride,
+       jj:jj + stride * out_w:stride] += np.where(idx == k, dout, 0)
+  return dx
+
+
+def max_pool_nhwc_numpy(x, pool_height, pool_width, stride):
+  N, H, W, C = x.shape
+  assert pool_height * pool_width <= 256, 'pooling window is too large'
+  out_h = (H - pool_height) / stride + 1
+  out_w = (W - pool_width) / stride + 1
+  # Running maximum over the window offsets; ties keep the first maximum
+  out = x[:, :stride * out_h:stride, :stride * out_w:stride].copy()
+  idx = np.zeros(out.shape, dtype=np.uint8)
+  mask = np.empty(out.shape, dtype=bool)
+  for k in xrange(1, pool_height * pool_width):
+    ii, jj = k // pool_width, k % pool_width
+    window = x[:, ii:ii + stride * out_h:stride, jj:jj + stride * out_w:stride]
+    np.greater(window, out, out=mask)
+    np.maximum(out, window, out=out)
+    idx[mask] = k
+  return out, idx
+
+
+def max_pool_nhwc_backward_numpy(dout, idx, H, W, pool_width, stride):
+  N, out_h, out_w, C = dout.shape
+  dx = np.zeros((N, H, W, C), dtype=dout.dtype)
+  for k in np.unique(idx):
+    ii, jj = k // pool_width, k % pool_width
+    dx[:, ii:ii + stride * out_h:stride,
+       jj:jj + stride * out_w:stride] += np.where(idx == k, dout, 0)
+  return dx
+
 pass
@@ -0,0 +1,609 @@
+import copy
+import sys
+import time
+
+import numpy as np
+
+from cs231n import layers, fast_layers, layer_utils
+from cs231n.gradient_check import eval_numerical_gradient
+try:
+  from cs231n import rnn_layers
+except ImportError:
+  rnn_layers = None
+try:
+  from cs231n.classifiers.fc_net import FullyConnectedNet
+except ImportError:
+  FullyConnectedNet = None
+
+
+"""
+An automated check of every forward / backward pair defined in layers.py,
+fast_layers.py, rnn_layers.py (if present) and layer_utils.py, and of the loss
+functions. For each pair we draw a few random input shapes from LAYER_SPECS
+and:
+
+- compare the analytic gradients from the backward pass against numeric
+  gradients from gradient_check;
+- compare every implementation of a layer (naive, im2col, strides, ...) and
+  every backward variant (such as batchnorm_backward_alt) against the first
+  one;
+- rerun the pair in float32 and compare it against float64, failing it if
+  any output or gradient was upcast to float64;
+- record the time per forward and backward call.
+
+Where the classifiers are present we also check that the SequentialNet from
+FullyConnectedNet.as_sequential computes the same test-time scores as the
+network itself without building training caches.
+
+Run it from the assignment directory with
+
+python -m cs231n.layer_checks
+
+A forward function without an entry in LAYER_SPECS counts as a failure, so
+new layers have to be registered here before they are used.
+"""
+
+
+def _shape(rng, low=2, high=5):
+  return rng.randint(low, high)
+
+
+def _away_from_zero(x, margin=1e-2):
+  """ Push values away from the kink of ReLUs and max pools. """
+  return x + margin * np.sign(x)
+
+
+def _distinct(rng, *shape):
+  """
+  Values in [-1, 1) without ties, so that max pooling has a unique argmax that
+  small numeric perturbations cannot change.
+  """
+  n = int(np.prod(shape))
+  return 2.0 * rng.permutation(n).reshape(shape) / n - 1.0
+
+
+def _affine_spec(rng):
+  N, d1, d2, M = [_shape(rng) for _ in xrange(4)]
+  return {'args': [rng.randn(N, d1, d2), rng.randn(d1 * d2, M), rng.randn(M)],
+          'wrt': (0, 1, 2)}
+
+
+def _relu_spec(rng):
+  return {'args': [_away_from_zero(rng.randn(_shape(rng), _shape(rng)))],
+          'wrt': (0,)}
+
+
+def _batchnorm_spec(rng):
+  N, D = _shape(rng, 4, 8), _shape(rng)
+  return {'args': [3 * rng.randn(N, D) + 1, rng.randn(D), rng.randn(D),
+                   {'mode': 'train'}],
+          'wrt': (0, 1, 2)}
+
+
+def _dropout_spec(rng):
+  return {'args': [rng.randn(_shape(rng, 5, 10), _shape(rng, 5, 10)),
+                   {'mode': 'train', 'p': 0.7, 'seed': rng.randint(1000)}],
+          'wrt': (0,)}
+
+
+def _spatial_batchnorm_spec(rng):
+  N, C, H, W = _shape(rng), _shape(rng), _shape(rng), _shape(rng)
+  return {'args': [3 * rng.randn(N, C, H, W) + 1, rng.randn(C), rng.randn(C),
+                   {'mode': 'train'}],
+          'wrt': (0, 1, 2)}
+
+
+def _conv_param(rng):
+  stride = rng.randint(1, 3)
+  # with 3x3 filters and pad 1 a stride of 2 needs an odd input size
+  H = 2 * _shape(rng) + (stride == 2)
+  W = 2 * _shape(rng) + (stride == 2)
+  return H, W, {'stride': stride, 'pad': 1}
+
+
+def _conv_spec(rng):
+  N, C, F = _shape(rng), _shape(rng), _shape(rng)
+  H, W, conv_param = _conv_param(rng)
+  # one image per chunk in conv_forward_chunked
+  conv_param['workspace_bytes'] = 1
+  return {'args': [rng.randn(N, C, H, W), rng.randn(F, C, 3, 3), rng.randn(F),
+                   conv_param],
+          'wrt': (0, 1, 2)}
+
+
+def _max_pool_spec(rng):
+  N, C, H, W = _shape(rng), _shape(rng), 2 * _shape(rng), 2 * _shape(rng)
+  return {'args': [_distinct(rng, N, C, H, W),
+                   {'pool_height': 2, 'pool_width': 2, 'stride': 2}],
+          'wrt': (0,)}
+
+
+def _global_avg_pool_spec(rng):
+  N, C, H, W = [_shape(rng) for _ in xrange(4)]
+  return {'args': [rng.randn(N, C, H, W)], 'wrt': (0,)}
+
+
+def _transpose_spec(rng):
+  N, C, H, W = [_shape(rng) for _ in xrange(4)]
+  return {'args': [rng.randn(N, C, H, W), (0, 2, 3, 1)], 'wrt': (0,)}
+
+
+def _affine_relu_spec(rng):
+  spec = _affine_spec(rng)
+  spec['args'][0] = _away_from_zero(spec['args'][0])
+  return spec
+
+
+def _affine_batchnorm_relu_spec(rng):
+  N, D, M = _shape(rng, 4, 8), _shape(rng), _shape(rng)
+  return {'args': [rng.randn(N, D), rng.randn(D, M), rng.randn(M),
+                   rng.randn(M), rng.randn(M), {'mode': 'train'}],
+          'wrt': (0, 1, 2, 3, 4)}
+
+
+def _affine_batchnorm_relu_dropout_spec(rng):
+  spec = _affine_batchnorm_relu_spec(rng)
+  spec['args'].append({'mode': 'train', 'p': 0.7, 'seed': rng.randint(1000)})
+  return spec
+
+
+def _conv_relu_spec(rng):
+  return _conv_spec(rng)
+
+
+def _conv_relu_pool_spec(rng):
+  N, C, F = _shape(rng), _shape(rng), _shape(rng)
+  H, W = 2 * _shape(rng), 2 * _shape(rng)
+  return {'args': [rng.randn(N, C, H, W), rng.randn(F, C, 3, 3), rng.randn(F),
+                   {'stride': 1, 'pad': 1},
+                   {'pool_height': 2, 'pool_width': 2, 'stride': 2}],
+          'wrt': (0, 1, 2)}
+
+
+def _conv_bn_relu_spec(rng):
+  N, C, F = _shape(rng), _shape(rng), _shape(rng)
+  H, W, conv_param = _conv_param(rng)
+  return {'args': [rng.randn(N, C, H, W), rng.randn(F, C, 3, 3), rng.randn(F),
+                   rng.randn(F), rng.randn(F), conv_param, {'mode': 'train'}],
+          'wrt': (0, 1, 2, 3, 4)}
+
+
+def _rnn_step_spec(rng):
+  N, D, H = _shape(rng), _shape(rng), _shape(rng)
+  return {'args': [rng.randn(N, D), rng.randn(N, H), 0.5 * rng.randn(D, H),
+                   0.5 * rng.randn(H, H), rng.randn(H)],
+          'wrt': (0, 1, 2, 3, 4)}
+
+
+def _rnn_spec(rng):
+  N, T, D, H = _shape(rng), _shape(rng), _shape(rng), _shape(rng)
+  return {'args': [rng.randn(N, T, D), rng.randn(N, H), 0.5 * rng.randn(D, H),
+                   0.5 * rng.randn(H, H), rng.randn(H)],
+          'wrt': (0, 1, 2, 3, 4)}
+
+
+def _word_embedding_spec(rng):
+  N, T, V, D = _shape(rng), _shape(rng), _shape(rng, 5, 10), _shape(rng)
+  return {'args': [rng.randint(V, size=(N, T)), rng.randn(V, D)],
+          'wrt': (1,)}
+
+
+def _lstm_step_spec(rng):
+  N, D, H = _shape(rng), _shape(rng), _shape(rng)
+  return {'args': [rng.randn(N, D), rng.randn(N, H), rng.randn(N, H),
+                   0.5 * rng.randn(D, 4 * H), 0.5 * rng.randn(H, 4 * H),
+                   rng.randn(4 * H)],
+          'wrt': (0, 1, 2, 3, 4, 5), 'num_outputs': 2}
+
+
+def _lstm_spec(rng):
+  N, T, D, H = _shape(rng), _shape(rng), _shape(rng), _shape(rng)
+  return {'args': [rng.randn(N, T, D), rng.randn(N, H),
+                   0.5 * rng.randn(D, 4 * H), 0.5 * rng.randn(H, 4 * H),
+                   rng.randn(4 * H)],
+          'wrt': (0, 1, 2, 3, 4)}
+
+
+def _temporal_affine_spec(rng):
+  N, T, D, M = [_shape(rng) for _ in xrange(4)]
+  return {'args': [rng.randn(N, T, D), rng.randn(D, M), rng.randn(M)],
+          'wrt': (0, 1, 2)}
+
+
+def _depthwise_conv_spec(rng):
+  N, C = _shape(rng), _shape(rng)
+  H, W, conv_param = _conv_param(rng)
+  return {'args': [rng.randn(N, C, H, W), rng.randn(C, 1, 3, 3), rng.randn(C),
+                   conv_param],
+          'wrt': (0, 1, 2)}
+
+
+def _pointwise_conv_spec(rng):
+  N, C, F, H, W = [_shape(rng) for _ in xrange(5)]
+  return {'args': [rng.randn(N, C, H, W), rng.randn(F, C, 1, 1), rng.randn(F)],
+          'wrt': (0, 1, 2)}
+
+
+def _depthwise_separable_relu_spec(rng):
+  N, C, F = _shape(rng), _shape(rng), _shape(rng)
+  H, W, conv_param = _conv_param(rng)
+  return {'args': [rng.randn(N, C, H, W), rng.randn(C, 1, 3, 3), rng.randn(C),
+                   rng.randn(F, C, 1, 1), rng.randn(F), conv_param],
+          'wrt': (0, 1, 2, 3, 4)}
+
+
+# Maps the name of a layer, which is the part of a forward function name
+# before "_forward", to a function that draws random arguments for it. The
+# returned dictionary holds the positional arguments, the indices of the
+# arguments that the backward pass returns gradients for, in order, and
+# optionally the number of arrays the forward pass returns before its cache.
+def _nhwc(spec_fn):
+  """ Wrap a spec so that its first argument is channels-last. """
+  def spec(rng):
+    spec = spec_fn(rng)
+    spec['args'][0] = np.ascontiguousarray(spec['args'][0].transpose(0, 2, 3, 1))
+    return spec
+  return spec
+
+
+LAYER_SPECS = {
+  'affine': _affine_spec,
+  'relu': _relu_spec,
+  'batchnorm': _batchnorm_spec,
+  'dropout': _dropout_spec,
+  'spatial_batchnorm': _spatial_batchnorm_spec,
+  'conv': _conv_spec,
+  'max_pool': _max_pool_spec,
+  'global_avg_pool': _global_avg_pool_spec,
+  'transpose': _transpose_spec,
+  'affine_relu': _affine_relu_spec,
+  'affine_batchnorm_relu': _affine_batchnorm_relu_spec,
+  'affine_bn_relu': _affine_batchnorm_relu_spec,
+  'affine_batchnorm_relu_dropout': _affine_batchnorm_relu_dropout_spec,
+  'conv_relu': _conv_relu_spec,
+  'conv_relu_pool': _conv_relu_pool_spec,
+  'conv_bn_relu': _conv_bn_relu_spec,
+  'rnn_step': _rnn_step_spec,
+  'rnn': _rnn_spec,
+  'word_embedding': _word_embedding_spec,
+  'lstm_step': _lstm_step_spec,
+  'lstm': _lstm_spec,
+  'temporal_affine': _temporal_affine_spec,
+  'depthwise_conv': _depthwise_conv_spec,
+  'pointwise_conv': _pointwise_conv_spec,
+  'depthwise_separable_relu': _depthwise_separable_relu_spec,
+  'conv_nhwc': _nhwc(_conv_spec),
+  'max_pool_nhwc': _nhwc(_max_pool_spec),
+  'global_avg_pool_nhwc': _nhwc(_global_avg_pool_spec),
+  'spatial_batchnorm_nhwc': _nhwc(_spatial_batchnorm_spec),
+  'conv_relu_nhwc': _nhwc(_conv_relu_spec),
+  'conv_relu_pool_nhwc': _nhwc(_conv_relu_pool_spec),
+  'conv_bn_relu_nhwc': _nhwc(_conv_bn_relu_spec),
+}
+
+
+def _classification_loss_spec(rng):
+  N, C = _shape(rng, 5, 10), _shape(rng, 3, 10)
+  return {'args': [rng.randn(N, C), rng.randint(C, size=N)], 'wrt': (0,)}
+
+
+def _temporal_softmax_loss_spec(rng):
+  N, T, V = _shape(rng), _shape(rng), _shape(rng, 3, 10)
+  return {'args': [rng.randn(N, T, V), rng.randint(V, size=(N, T)),
+                   rng.rand(N, T) > 0.3],
+          'wrt': (0,)}
+
+
+# Loss functions return (loss, dx) from a single call.
+LOSS_SPECS = {
+  'svm_loss': _classification_loss_spec,
+  'softmax_loss': _classification_loss_spec,
+  'temporal_softmax_loss': _temporal_softmax_loss_spec,
+}
+
+
+def rel_error(x, y, floor=1e-8):
+  """
+  Maximum elementwise relative error, as used in the notebooks. Entries
+  smaller than floor are compared absolutely, so that gradients that are
+  exactly zero (such as the bias before a batchnorm) do not compare numeric
+  noise against noise.
+  """
+  return np.max(np.abs(x - y) / (np.maximum(floor, np.abs(x) + np.abs(y))))
+
+
+def norm_error(x, y, floor=1e-3):
+  """
+  Relative error of x with respect to y in the Frobenius norm; errors in
+  arrays with a norm below floor are measured relative to floor.
+  """
+  return np.linalg.norm(x - y) / max(np.linalg.norm(y), floor)
+
+
+def find_layer_pairs(modules=None):
+  """
+  Find all forward / backward pairs in the given modules.
+
+  Returns:
+  A list of tuples (layer, forward_name, forward, backwards) where layer is
+  the key into LAYER_SPECS and backwards is a list of (name, function) of all
+  matching backward passes, such as batchnorm_backward and
+  batchnorm_backward_alt for batchnorm_forward.
+  """
+  if modules is None:
+    modules = [m for m in [layers, fast_layers, rnn_layers, layer_utils]
+               if m is not None]
+  pairs = []
+  for module in modules:
+    functions = dict((k, v) for k, v in vars(module).iteritems()
+                     if callable(v) and getattr(v, '__module__', None) == module.__name__)
+    for name in sorted(functions):
+      if '_forward' not in name:
+        continue
+      layer, suffix = name.split('_forward', 1)
+      backward = '%s_backward%s' % (layer, suffix)
+      backwards = [(k, functions[k]) for k in sorted(functions)
+                   if k == backward or k.startswith(backward + '_')]
+      if backwards:
+        pairs.append((layer, '%s.%s' % (module.__name__.split('.')[-1], name),
+                      functions[name], backwards))
+  return pairs
+
+
+def _cast(args, dtype):
+  return [a.astype(dtype) if isinstance(a, np.ndarray) and a.dtype.kind == 'f'
+          else copy.deepcopy(a) for a in args]
+
+
+def _forward(forward, args, num_outputs):
+  res = forward(*copy.deepcopy(args))
+  return list(res[:num_outputs]), res[num_outputs]
+
+
+def _backward(backward, douts, cache):
+  grads = backward(*([d.copy() for d in douts] + [cache]))
+  return list(grads) if isinstance(grads, tuple) else [grads]
+
+
+def _timed(fn, repeats):
+  best = None
+  for _ in xrange(repeats):
+    start = time.time()
+    res = fn()
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return res, 1000.0 * best
+
+
+def check_layer(layer, forward, backward, spec, rng, repeats=3):
+  """
+  Check one forward / backward pair on one draw of random arguments.
+
+  Returns a dictionary with the gradient error against numeric gradients
+  (grad_error), the error of the float32 run against float64 (float32_error),
+  whether the float32 outputs were upcast (upcast), and the best time per
+  forward and backward call in milliseconds.
+  """
+  num_outputs = spec.get('num_outputs', 1)
+  args = _cast(spec['args'], np.float64)
+
+  outs, cache = _forward(forward, args, num_outputs)
+  douts = [rng.randn(*o.shape) for o in outs]
+  grads = _backward(backward, douts, cache)
+
+  def scalar(i):
+    def f(v):
+      call_args = list(args)
+      call_args[i] = v
+      outs, _ = _forward(forward, call_args, num_outputs)
+      return sum(np.sum(o * d) for o, d in zip(outs, douts))
+    return f
+
+  num_grads = [eval_numerical_gradient(scalar(i), args[i].copy(), verbose=False)
+               for i in spec['wrt']]
+  # numeric noise grows with the size of the gradients, so entries that are
+  # tiny compared to the largest gradient are compared absolutely
+  floor = 1e-4 * max([1.0] + [np.abs(g).max() for g in num_grads if g.size])
+  grad_error = max([0.0] + [rel_error(g, n, floor=floor)
+                            for g, n in zip(grads, num_grads)])
+
+  args32 = _cast(args, np.float32)
+  douts32 = [d.astype(np.float32) for d in douts]
+  (outs32, cache32), forward_ms = _timed(
+      lambda: _forward(forward, args32, num_outputs), repeats)
+  grads32, backward_ms = _timed(
+      lambda: _backward(backward, douts32, cache32), repeats)
+  # float32 rounding noise scales with the largest array, not the one at hand,
+  # so small arrays (such as the zero gradient of a bias before a batchnorm)
+  # are measured relative to the largest one
+  norm_floor = max([1e-3] + [np.linalg.norm(a) for a in outs + grads])
+  float32_error = max(norm_error(a, b, floor=norm_floor)
+                      for a, b in zip(outs32 + grads32, outs + grads))
+  upcast = any(a.dtype != np.float32 for a in outs32 + grads32)
+
+  return {
+    'outs': outs, 'grads': grads,
+    'grad_error': grad_error, 'float32_error': float32_error,
+    'upcast': upcast, 'forward_ms': forward_ms, 'backward_ms': backward_ms,
+  }
+
+
+def check_loss(loss_fn, spec):
+  """
+  Check the gradient of a loss function against a numeric gradient.
+  """
+  args = _cast(spec['args'], np.float64)
+  i = spec['wrt'][0]
+  loss, dx = loss_fn(*args)
+
+  def f(v):
+    call_args = list(args)
+    call_args[i] = v
+    return loss_fn(*call_args)[0]
+
+  num_dx = eval_numerical_gradient(f, args[i].copy(), verbose=False)
+  return {'grad_error': rel_error(dx, num_dx, floor=1e-5)}
+
+
+# Keyword arguments of the FullyConnectedNet models for check_sequential
+SEQUENTIAL_SPECS = [
+  {},
+  {'use_batchnorm': True},
+  {'dropout': 0.5},
+]
+
+
+def check_sequential(model, rng):
+  """
+  Compare the test-time scores of model.as_sequential() against those of
+  model, after one training pass to set the batchnorm running averages, and
+  check that no layer that takes the mode built a cache at test time.
+  """
+  seq = model.as_sequential()
+  caches = []
+
+  def recording(forward, takes_mode):
+    def wrapper(*args, **kwargs):
+      out, cache = forward(*args, **kwargs)
+      if takes_mode:
+        caches.append(cache)
+      return out, cache
+    return wrapper
+
+  seq.layers = [((recording(forward, takes_mode), backward), names, args,
+                 takes_mode)
+                for (forward, backward), names, args, takes_mode in seq.layers]
+
+  N, D = 4, model.params['W1'].shape[0]
+  num_classes = model.params['W%d' % model.num_layers].shape[1]
+  X = rng.randn(N, D)
+  model.loss(X, rng.randint(num_classes, size=N))
+  scores = model.loss(X)
+  del caches[:]
+  seq_scores = seq.loss(X)
+  return {'equiv_error': rel_error(scores, seq_scores),
+          'test_caches': sum(cache is not None for cache in caches)}
+
+
+def run_layer_checks(modules=None, num_trials=3, seed=0, grad_tol=1e-5,
+                     equiv_tol=1e-8, float32_tol=1e-3, repeats=3,
+                     verbose=True):
+  """
+  Run all checks and return a list of result dictionaries, one for each
+  (layer function, trial) and loss function, with a 'passed' key and a
+  'problems' list describing any failures.
+
+  Inputs:
+  - modules: Modules to search for forward / backward pairs; by default
+    layers, fast_layers, rnn_layers and layer_utils.
+  - num_trials: Number of random argument draws for each layer.
+  - seed: Seed for the random number generator.
+  - grad_tol: Tolerance on the relative error against numeric gradients.
+  - equiv_tol: Tolerance on the relative error between implementations of
+    the same layer.
+  - float32_tol: Tolerance on the norm error of float32 against float64.
+  - repeats: Number of timed calls; the best time is reported.
+  - verbose: Whether to print a line per result.
+  """
+  rng = np.random.RandomState(seed)
+  results = []
+
+  # Group the pairs by layer so that implementations can be compared
+  by_layer = {}
+  for layer, name, forward, backwards in find_layer_pairs(modules):
+    by_layer.setdefault(layer, []).append((name, forward, backwards))
+
+  for layer in sorted(by_layer):
+    impls = by_layer[layer]
+    if layer not in LAYER_SPECS:
+      for name, _, _ in impls:
+        results.append({'name': name, 'passed': False,
+                        'problems': ['no entry in LAYER_SPECS']})
+      continue
+    for trial in xrange(num_trials):
+      spec = LAYER_SPECS[layer](rng)
+      reference = None
+      seen = {}
+      for name, forward, backwards in impls:
+        for backward_name, backward in backwards:
+          label = name if len(backwards) == 1 else '%s/%s' % (name, backward_name)
+          if (forward, backward) in seen:
+            # aliases such as conv_forward_fast = conv_forward_strides
+            continue
+          seen[(forward, backward)] = label
+          res = check_layer(layer, forward, backward, spec,
+                            np.random.RandomState(seed + trial), repeats)
+          res.update({'name': label, 'trial': trial, 'problems': []})
+          if res['grad_error'] > grad_tol:
+            res['problems'].append('gradient error %e' % res['grad_error'])
+          if res['float32_error'] > float32_tol:
+            res['problems'].append('float32 error %e' % res['float32_error'])
+          if res['upcast']:
+            res['problems'].append('float32 outputs were upcast')
+          arrays = res.pop('outs') + res.pop('grads')
+          if reference is None:
+            reference = (label, arrays)
+            res['equiv_error'] = 0.0
+          else:
+            res['equiv_error'] = max(
+                rel_error(a, b) for a, b in zip(arrays, reference[1]))
+            if res['equiv_error'] > equiv_tol:
+              res['problems'].append('differs from %s by %e' % (
+                                     reference[0], res['equiv_error']))
+          res['passed'] = not res['problems']
+          results.append(res)
+
+  for module in [layers, rnn_layers]:
+    if module is None:
+      continue
+    for name in sorted(LOSS_SPECS):
+      if not hasattr(module, name):
+        continue
+      res = check_loss(getattr(module, name), LOSS_SPECS[name](rng))
+      res['name'] = '%s.%s' % (module.__name__.split('.')[-1], name)
+      res['problems'] = []
+      if res['grad_error'] > grad_tol:
+        res['problems'].append('gradient error %e' % res['grad_error'])
+      res['passed'] = not res['problems']
+      results.append(res)
+
+  if FullyConnectedNet is not None:
+    for kwargs in SEQUENTIAL_SPECS:
+      model = FullyConnectedNet([6, 5], input_dim=7, num_classes=3,
+                                dtype=np.float64, seed=seed, **kwargs)
+      res = check_sequential(model, rng)
+      res['name'] = 'sequential.FullyConnectedNet(%s)' % ', '.join(
+          '%s=%r' % kv for kv in sorted(kwargs.items()))
+      res['problems'] = []
+      if res['equiv_error'] > equiv_tol:
+        res['problems'].append('differs from FullyConnectedNet by %e' %
+                               res['equiv_error'])
+      if res['test_caches']:
+        res['problems'].append('%d layers built a cache at test time' %
+                               res['test_caches'])
+      res['passed'] = not res['problems']
+      results.append(res)
+
+  if verbose:
+    for res in results:
+      line = '%-55s %s' % (res['name'], 'ok' if res['passed'] else 'FAIL')
+      if 'forward_ms' in res:
+        line += '  grad %.1e  f32 %.1e  fwd %7.3f ms  bwd %7.3f ms%s' % (
+                res['grad_error'], res['float32_error'], res['forward_ms'],
+                res['backward_ms'], '  (upcast)' if res['upcast'] else '')
+      elif 'grad_error' in res:
+        line += '  grad %.1e' % res['grad_error']
+      elif 'equiv_error' in res:
+        line += '  equiv %.1e' % res['equiv_error']
+      if res['problems']:
+        line += '  ' + '; '.join(res['problems'])
+      print line
+    num_failed = sum(not res['passed'] for res in results)
+    print '%d checks, %d failed' % (len(results), num_failed)
+
+  return results
+
+
+if __name__ == '__main__':
+  results = run_layer_checks()
+  sys.exit(0 if all(res['passed'] for res in results) else 1)
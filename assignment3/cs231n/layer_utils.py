@@ -1,3 +1,4 @@
+from cs231n import dtype_policy
 from cs231n.layers import *
 from cs231n.fast_layers import *
 
@@ -109,6 +110,26 @@ def conv_bn_relu_backward(dout, cache):
   return dx, dw, db, dgamma, dbeta
 
 
+def conv_bn_relu_nhwc_forward(x, w, b, gamma, beta, conv_param, bn_param):
+  """
+  Channels-last version of conv_bn_relu_forward; x has shape (N, H, W, C)
+  and the output has shape (N, out_h, out_w, F).
+  """
+  a, conv_cache = conv_nhwc_forward(x, w, b, conv_param)
+  an, bn_cache = spatial_batchnorm_nhwc_forward(a, gamma, beta, bn_param)
+  out, relu_cache = relu_forward(an)
+  cache = (conv_cache, bn_cache, relu_cache)
+  return out, cache
+
+
+def conv_bn_relu_nhwc_backward(dout, cache):
+  conv_cache, bn_cache, relu_cache = cache
+  dan = relu_backward(dout, relu_cache)
+  da, dgamma, dbeta = spatial_batchnorm_nhwc_backward(dan, bn_cache)
+  dx, dw, db = conv_nhwc_backward(da, conv_cache)
+  return dx, dw, db, dgamma, dbeta
+
+
 def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
   """
   Convenience layer that performs a convolution, a ReLU, and a pool.
@@ -121,21 +142,133 @@ def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
   Returns a tuple of:
   - out: Output from the pooling layer
   - cache: Object to give to the backward pass
+
+  2x2 pooling with stride 2 after a convolution with an even output size, for
+  which choose_conv_method picks the 'strides' method (by autotuning if no
+  method is given), runs as the fused kernel conv_relu_pool_forward_fused,
+  which only keeps the pooling indices instead of the full-resolution
+  activations.
   """
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  out_h = (x.shape[2] + 2 * pad - HH) / stride + 1
+  out_w = (x.shape[3] + 2 * pad - WW) / stride + 1
+  fused = (pool_param['pool_height'] == pool_param['pool_width'] ==
+           pool_param['stride'] == 2 and out_h % 2 == 0 and out_w % 2 == 0)
+  if fused and choose_conv_method(x, w, b, conv_param) != 'strides':
+    fused = False
+
+  if fused:
+    out, fused_cache = conv_relu_pool_forward_fused(x, w, b, conv_param,
+                                                    pool_param)
+    return out, ('fused', fused_cache)
+
   a, conv_cache = conv_forward_fast(x, w, b, conv_param)
   s, relu_cache = relu_forward(a)
   out, pool_cache = max_pool_forward_fast(s, pool_param)
   cache = (conv_cache, relu_cache, pool_cache)
-  return out, cache
+  return out, ('layers', cache)
 
 
 def conv_relu_pool_backward(dout, cache):
   """
   Backward pass for the conv-relu-pool convenience layer
   """
+  method, cache = cache
+  if method == 'fused':
+    return conv_relu_pool_backward_fused(dout, cache)
+
   conv_cache, relu_cache, pool_cache = cache
   ds = max_pool_backward_fast(dout, pool_cache)
   da = relu_backward(ds, relu_cache)
   dx, dw, db = conv_backward_fast(da, conv_cache)
   return dx, dw, db
 
+
+def conv_relu_nhwc_forward(x, w, b, conv_param):
+  """
+  Channels-last version of conv_relu_forward; x has shape (N, H, W, C) and
+  the output has shape (N, out_h, out_w, F).
+  """
+  a, conv_cache = conv_nhwc_forward(x, w, b, conv_param)
+  out, relu_cache = relu_forward(a)
+  cache = (conv_cache, relu_cache)
+  return out, cache
+
+
+def conv_relu_nhwc_backward(dout, cache):
+  """
+  Backward pass for the channels-last conv-relu convenience layer.
+  """
+  conv_cache, relu_cache = cache
+  da = relu_backward(dout, relu_cache)
+  dx, dw, db = conv_nhwc_backward(da, conv_cache)
+  return dx, dw, db
+
+
+def conv_relu_pool_nhwc_forward(x, w, b, conv_param, pool_param):
+  """
+  Channels-last version of conv_relu_pool_forward; x has shape (N, H, W, C)
+  and the output has shape (N, out_h, out_w, F).
+
+  Since the ReLU is monotonic it commutes with max pooling, so it is applied
+  to the pooled output, which is smaller than the convolution output.
+  """
+  a, conv_cache = conv_nhwc_forward(x, w, b, conv_param)
+  s, pool_cache = max_pool_nhwc_forward(a, pool_param)
+  out, relu_cache = relu_forward(s)
+  cache = (conv_cache, pool_cache, relu_cache)
+  return out, cache
+
+
+def conv_relu_pool_nhwc_backward(dout, cache):
+  """
+  Backward pass for the channels-last conv-relu-pool convenience layer.
+  """
+  conv_cache, pool_cache, relu_cache = cache
+  ds = relu_backward(dout, relu_cache)
+  da = max_pool_nhwc_backward(ds, pool_cache)
+  dx, dw, db = conv_nhwc_backward(da, conv_cache)
+  return dx, dw, db
+
+
+
+def depthwise_separable_relu_forward(x, w_dw, b_dw, w_pw, b_pw, conv_param):
+  """
+  A convenience layer for a depthwise-separable convolution: a depthwise
+  convolution followed by a ReLU, then a pointwise (1x1) convolution followed
+  by a ReLU. It replaces a dense convolution from C to F channels at about
+  1 / F + 1 / (HH * WW) of its multiply-adds.
+
+  Inputs:
+  - x: Input to the depthwise convolutional layer, of shape (N, C, H, W)
+  - w_dw, b_dw, conv_param: Weights of shape (C, 1, HH, WW), biases and
+    parameters for the depthwise convolutional layer
+  - w_pw, b_pw: Weights of shape (F, C, 1, 1) and biases for the pointwise
+    convolutional layer
+
+  Returns a tuple of:
+  - out: Output from the second ReLU
+  - cache: Object to give to the backward pass
+  """
+  a, dw_cache = depthwise_conv_forward(x, w_dw, b_dw, conv_param)
+  s, relu_dw_cache = relu_forward(a)
+  p, pw_cache = pointwise_conv_forward(s, w_pw, b_pw)
+  out, relu_pw_cache = relu_forward(p)
+  cache = (dw_cache, relu_dw_cache, pw_cache, relu_pw_cache)
+  return out, cache
+
+
+def depthwise_separable_relu_backward(dout, cache):
+  """
+  Backward pass for the depthwise-separable convenience layer.
+  """
+  dw_cache, relu_dw_cache, pw_cache, relu_pw_cache = cache
+  dp = relu_backward(dout, relu_pw_cache)
+  ds, dw_pw, db_pw = pointwise_conv_backward(dp, pw_cache)
+  da = relu_backward(ds, relu_dw_cache)
+  dx, dw_dw, db_dw = depthwise_conv_backward(da, dw_cache)
+  return dx, dw_dw, db_dw, dw_pw, db_pw
+
+
+dtype_policy.instrument(globals())
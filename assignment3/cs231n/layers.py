@@ -1,5 +1,7 @@
 import numpy as np
 
+from cs231n import dtype_policy
+
 
 def affine_forward(x, w, b):
   """
@@ -221,12 +223,47 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
     
   Returns a tuple of:
   - out: Output data, of shape (N, C, H, W)
-  - cache: Values needed for the backward pass
+  - cache: Values needed for the backward pass; in test mode the backward
+    pass treats the running statistics as constants.
   """
+  # Statistics are reduced over the (N, H, W) axes and broadcast back per
+  # channel, so x is never transposed or copied into an (N * H * W, C) matrix.
+  mode = bn_param['mode']
+  eps = bn_param.get('eps', 1e-5)
+  momentum = bn_param.get('momentum', 0.9)
+
   N, C, H, W = x.shape
-  x_flat = x.transpose(0, 2, 3, 1).reshape(-1, C)
-  out_flat, cache = batchnorm_forward(x_flat, gamma, beta, bn_param)
-  out = out_flat.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+  running_mean = bn_param.get('running_mean', np.zeros(C, dtype=x.dtype))
+  running_var = bn_param.get('running_var', np.zeros(C, dtype=x.dtype))
+  channel_shape = (1, C, 1, 1)
+
+  if mode == 'train':
+    sample_mean = np.mean(x, axis = (0, 2, 3))
+    x_norm = x - sample_mean.reshape(channel_shape)
+    sample_var = np.mean(x_norm ** 2, axis = (0, 2, 3))
+    sample_var_sqrt_inv = 1 / np.sqrt(sample_var + eps)
+    x_norm *= sample_var_sqrt_inv.reshape(channel_shape)
+
+    out = x_norm * gamma.reshape(channel_shape)
+    out += beta.reshape(channel_shape)
+    cache = (mode, x_norm, gamma, sample_var_sqrt_inv)
+
+    running_mean = momentum * running_mean + (1 - momentum) * sample_mean
+    running_var = momentum * running_var + (1 - momentum) * sample_var
+  elif mode == 'test':
+    sample_var_sqrt_inv = 1 / np.sqrt(running_var + eps)
+    scale = gamma * sample_var_sqrt_inv
+    out = x * scale.reshape(channel_shape)
+    out += (beta - running_mean * scale).reshape(channel_shape)
+    # The statistics are constants at test time, so the backward pass (used
+    # for image gradients) only needs x and the running mean
+    cache = (mode, x, gamma, sample_var_sqrt_inv, running_mean)
+  else:
+    raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+  bn_param['running_mean'] = running_mean
+  bn_param['running_var'] = running_var
+
   return out, cache
 
 
@@ -243,13 +280,81 @@ def spatial_batchnorm_backward(dout, cache):
   - dgamma: Gradient with respect to scale parameter, of shape (C,)
   - dbeta: Gradient with respect to shift parameter, of shape (C,)
   """
-  N, C, H, W = dout.shape
-  dout_flat = dout.transpose(0, 2, 3, 1).reshape(-1, C)
-  dx_flat, dgamma, dbeta = batchnorm_backward(dout_flat, cache)
-  dx = dx_flat.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+  mode = cache[0]
+  if mode == 'train':
+    _, x_norm, gamma, sample_var_sqrt_inv = cache
+
+    N, C, H, W = x_norm.shape
+    channel_shape = (1, C, 1, 1)
+
+    # Same single pass as batchnorm_backward_alt, reduced over (N, H, W)
+    dbeta = np.sum(dout, axis = (0, 2, 3))
+
+    dgamma = np.sum(dout * x_norm, axis = (0, 2, 3))
+
+    dx = x_norm * dgamma.reshape(channel_shape)
+    dx += dbeta.reshape(channel_shape)
+    dx *= -1. / (N * H * W)
+    dx += dout
+    dx *= (gamma * sample_var_sqrt_inv).reshape(channel_shape)
+  else:
+    _, x, gamma, sample_var_sqrt_inv, running_mean = cache
+
+    C = x.shape[1]
+    channel_shape = (1, C, 1, 1)
+
+    dbeta = np.sum(dout, axis = (0, 2, 3))
+
+    dgamma = np.sum(dout * x, axis = (0, 2, 3)) - running_mean * dbeta
+    dgamma *= sample_var_sqrt_inv
+
+    dx = dout * (gamma * sample_var_sqrt_inv).reshape(channel_shape)
+
   return dx, dgamma, dbeta
 
 
+def spatial_batchnorm_nhwc_forward(x, gamma, beta, bn_param):
+  """
+  Computes the forward pass for spatial batch normalization of channels-last
+  data.
+
+  Inputs:
+  - x: Input data of shape (N, H, W, C)
+  - gamma, beta, bn_param: As for spatial_batchnorm_forward
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, H, W, C)
+  - cache: Values needed for the backward pass
+  """
+  N, H, W, C = x.shape
+  # Viewed as (N * H * W, C, 1, 1) the data has its channels on the axis that
+  # spatial_batchnorm_forward normalizes, without copying or transposing it
+  out, cache = spatial_batchnorm_forward(x.reshape(N * H * W, C, 1, 1),
+                                         gamma, beta, bn_param)
+  return out.reshape(x.shape), (x.shape, cache)
+
+
+def spatial_batchnorm_nhwc_backward(dout, cache):
+  """
+  Computes the backward pass for spatial batch normalization of channels-last
+  data.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, H, W, C)
+  - cache: Values from the forward pass
+
+  Returns a tuple of:
+  - dx: Gradient with respect to inputs, of shape (N, H, W, C)
+  - dgamma: Gradient with respect to scale parameter, of shape (C,)
+  - dbeta: Gradient with respect to shift parameter, of shape (C,)
+  """
+  shape, cache = cache
+  N, H, W, C = shape
+  dx, dgamma, dbeta = spatial_batchnorm_backward(
+      dout.reshape(N * H * W, C, 1, 1), cache)
+  return dx.reshape(shape), dgamma, dbeta
+
+
 def svm_loss(x, y):
   """
   Computes the loss and gradient using for multiclass SVM classification.
@@ -277,7 +382,46 @@ def svm_loss(x, y):
   return loss, dx
 
 
-def softmax_loss(x, y):
+def softmax_cross_entropy(x, y, weights=None, top_k=None):
+  """
+  Fused log-softmax cross-entropy over the rows of x, shared by softmax_loss
+  and temporal_softmax_loss.
+
+  The loss of row i is log(sum_j exp(x[i, j])) - x[i, y[i]], computed with the
+  log-sum-exp trick, and its gradient is softmax(x[i]) - onehot(y[i]). Both are
+  computed in a single buffer of the size of x which is returned as dx, and
+  that buffer keeps the dtype of x.
+
+  Inputs:
+  - x: Scores of shape (M, C)
+  - y: Labels of shape (M,) where 0 <= y[i] < C
+  - weights: Optional array of shape (M,) giving the weight of each row
+  - top_k: If not None, also find the rows where y[i] is among the top_k scores
+
+  Returns a tuple of:
+  - loss: Weighted sum (not mean) of the per-row losses
+  - dx: Gradient of loss with respect to x, of shape (M, C)
+  - correct: Boolean array of shape (M,) telling whether y[i] is among the
+    top_k scores of row i, or None if top_k is None
+  """
+  rows = np.arange(x.shape[0])
+  dx = x - np.max(x, axis=1, keepdims=True)
+  correct_scores = dx[rows, y]
+  correct = None
+  if top_k is not None:
+    correct = np.sum(dx > correct_scores[:, np.newaxis], axis=1) < top_k
+  np.exp(dx, out=dx)
+  sums = np.sum(dx, axis=1)
+  dx /= sums[:, np.newaxis]
+  dx[rows, y] -= 1
+  losses = np.log(sums) - correct_scores
+  if weights is not None:
+    losses = losses * weights
+    dx *= weights[:, np.newaxis]
+  return np.sum(losses), dx, correct
+
+
+def softmax_loss(x, y, class_weights=None, top_k=None):
   """
   Computes the loss and gradient for softmax classification.
 
@@ -286,17 +430,24 @@ def softmax_loss(x, y):
     for the ith input.
   - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
     0 <= y[i] < C
+  - class_weights: Optional array of shape (C,); the loss of x[i] is weighted
+    by class_weights[y[i]].
+  - top_k: If not None, also return the top-k accuracy of x.
 
   Returns a tuple of:
   - loss: Scalar giving the loss
   - dx: Gradient of the loss with respect to x
+  - accuracy: Fraction of inputs whose label is among their top_k scores; only
+    returned if top_k is not None
   """
-  probs = np.exp(x - np.max(x, axis=1, keepdims=True))
-  probs /= np.sum(probs, axis=1, keepdims=True)
   N = x.shape[0]
-  loss = -np.sum(np.log(probs[np.arange(N), y])) / N
-  dx = probs.copy()
-  dx[np.arange(N), y] -= 1
+  weights = None if class_weights is None else class_weights[y]
+  loss, dx, correct = softmax_cross_entropy(x, y, weights, top_k)
+  loss /= N
   dx /= N
-  return loss, dx
+  if top_k is None:
+    return loss, dx
+  return loss, dx, np.mean(correct)
+
 
+dtype_policy.instrument(globals())
@@ -1,5 +1,8 @@
 import numpy as np
 
+from cs231n import dtype_policy
+from cs231n.layers import softmax_cross_entropy
+
 
 """
 This file defines layer types that are commonly used for recurrent neural
@@ -106,7 +109,7 @@ def rnn_forward(x, h0, Wx, Wh, b):
   (N, T, D) = x.shape
   H = h0.shape[1]
 
-  h = np.zeros((N, T, H))
+  h = np.zeros((N, T, H), dtype=x.dtype)
   caches = []
 
   h0_t = h0
@@ -148,13 +151,13 @@ def rnn_backward(dh, cache):
   (N, T, H) = dh.shape
   (D, caches) = cache
 
-  dx = np.zeros((N, T, D))
-  dh0 = np.zeros((N, H))
-  dWx = np.zeros((D, H))
-  dWh = np.zeros((H, H))
-  db = np.zeros(H)
+  dx = np.zeros((N, T, D), dtype=dh.dtype)
+  dh0 = np.zeros((N, H), dtype=dh.dtype)
+  dWx = np.zeros((D, H), dtype=dh.dtype)
+  dWh = np.zeros((H, H), dtype=dh.dtype)
+  db = np.zeros(H, dtype=dh.dtype)
 
-  dh0_t = np.zeros(dh0.shape)
+  dh0_t = np.zeros(dh0.shape, dtype=dh.dtype)
 
   for t in reversed(range(T)):
     (h0_t, cache_t) = caches[t]
@@ -197,7 +200,7 @@ def word_embedding_forward(x, W):
   (N, T) = x.shape
   (V, D) = W.shape
 
-  out = np.zeros((N, T, D))
+  out = np.zeros((N, T, D), dtype=W.dtype)
 
   # for n in range(N):
   #   for t in range(T):
@@ -239,7 +242,7 @@ def word_embedding_backward(dout, cache):
   (N, T) = x.shape
   (V, D) = W.shape
 
-  dW = np.zeros((V, D))
+  dW = np.zeros((V, D), dtype=dout.dtype)
 
   # for n in range(N):
   #   for t in range(T):
@@ -401,11 +404,11 @@ def lstm_forward(x, h0, Wx, Wh, b):
   (N, T, D) = x.shape
   H = h0.shape[1]
 
-  h = np.zeros((N, T, H))
+  h = np.zeros((N, T, H), dtype=x.dtype)
   caches = []
 
   h0_t = h0
-  c0_t = np.zeros((N, H))
+  c0_t = np.zeros((N, H), dtype=x.dtype)
 
   for t in range(T):
     (h0_t, c0_t, cache_t) = lstm_step_forward(x[:, t, :], h0_t, c0_t, Wx, Wh, b)
@@ -445,14 +448,14 @@ def lstm_backward(dh, cache):
   (N, T, H) = dh.shape
   (D, caches) = cache
 
-  dx = np.zeros((N, T, D))
-  dh0 = np.zeros((N, H))
-  dWx = np.zeros((D, 4*H))
-  dWh = np.zeros((H, 4*H))
-  db = np.zeros(4*H)
+  dx = np.zeros((N, T, D), dtype=dh.dtype)
+  dh0 = np.zeros((N, H), dtype=dh.dtype)
+  dWx = np.zeros((D, 4*H), dtype=dh.dtype)
+  dWh = np.zeros((H, 4*H), dtype=dh.dtype)
+  db = np.zeros(4*H, dtype=dh.dtype)
 
-  dh0_t = np.zeros((N, H))
-  dc0_t = np.zeros((N, H))
+  dh0_t = np.zeros((N, H), dtype=dh.dtype)
+  dc0_t = np.zeros((N, H), dtype=dh.dtype)
 
   for t in reversed(range(T)):
     (h0_t, c0_t, cache_t) = caches[t]
@@ -519,7 +522,8 @@ def temporal_affine_backward(dout, cache):
   return dx, dw, db
 
 
-def temporal_softmax_loss(x, y, mask, verbose=False):
+def temporal_softmax_loss(x, y, mask, verbose=False, class_weights=None,
+                          top_k=None):
   """
   A temporal version of softmax loss for use in RNNs. We assume that we are
   making predictions over a vocabulary of size V for each timestep of a
@@ -540,10 +544,15 @@ def temporal_softmax_loss(x, y, mask, verbose=False):
        0 <= y[i, t] < V
   - mask: Boolean array of shape (N, T) where mask[i, t] tells whether or not
     the scores at x[i, t] should contribute to the loss.
+  - class_weights: Optional array of shape (V,); the loss at x[i, t] is
+    weighted by class_weights[y[i, t]].
+  - top_k: If not None, also return the top-k accuracy over unmasked elements.
 
   Returns a tuple of:
   - loss: Scalar giving loss
   - dx: Gradient of loss with respect to scores x.
+  - accuracy: Fraction of unmasked elements whose ground truth is among their
+    top_k scores; only returned if top_k is not None
   """
 
   N, T, V = x.shape
@@ -551,18 +560,22 @@ def temporal_softmax_loss(x, y, mask, verbose=False):
   x_flat = x.reshape(N * T, V)
   y_flat = y.reshape(N * T)
   mask_flat = mask.reshape(N * T)
-  
-  probs = np.exp(x_flat - np.max(x_flat, axis=1, keepdims=True))
-  probs /= np.sum(probs, axis=1, keepdims=True)
-  loss = -np.sum(mask_flat * np.log(probs[np.arange(N * T), y_flat])) / N
-  dx_flat = probs.copy()
-  dx_flat[np.arange(N * T), y_flat] -= 1
+
+  weights = mask_flat
+  if class_weights is not None:
+    weights = class_weights[y_flat] * mask_flat
+
+  loss, dx_flat, correct = softmax_cross_entropy(x_flat, y_flat, weights, top_k)
+  loss /= N
   dx_flat /= N
-  dx_flat *= mask_flat[:, None]
   
   if verbose: print 'dx_flat: ', dx_flat.shape
   
   dx = dx_flat.reshape(N, T, V)
-  
-  return loss, dx
 
+  if top_k is None:
+    return loss, dx
+  return loss, dx, np.mean(correct[mask_flat.astype(bool)])
+
+
+dtype_policy.instrument(globals())
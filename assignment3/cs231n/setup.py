@@ -1,11 +1,19 @@
+import sys
+
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Build import cythonize
 import numpy
 
+# OpenMP runs the prange loops of im2col_cython.pyx in parallel. Apple's clang
+# does not support -fopenmp, so there the loops run on a single thread.
+openmp_flags = [] if sys.platform == 'darwin' else ['-fopenmp']
+
 extensions = [
   Extension('im2col_cython', ['im2col_cython.pyx'],
-            include_dirs = [numpy.get_include()]
+            include_dirs = [numpy.get_include()],
+            extra_compile_args = openmp_flags,
+            extra_link_args = openmp_flags,
   ),
 ]
 
@@ -0,0 +1,245 @@
+"""
+Generators for synthetic datasets that are written to disk in exactly the
+layouts produced by the scripts in cs231n/datasets, so that load_CIFAR10,
+load_tiny_imagenet, load_coco_data and PretrainedCNN.load_weights can be run
+(and benchmarked) on machines without network access.
+
+The default sizes match the real datasets; pass smaller sizes for quick tests.
+All generators are deterministic for a given seed. Images are drawn around a
+random per-class template so that models trained on them can do better than
+chance.
+"""
+import cPickle as pickle
+import json
+import os
+
+import numpy as np
+import h5py
+from scipy.misc import imsave
+
+from cs231n.classifiers.pretrained_cnn import PretrainedCNN
+
+
+def _class_images(rng, templates, labels, noise=40.0):
+  """
+  Draw uint8 images of shape (N, H, W, 3) around the templates of the given
+  labels.
+  """
+  imgs = templates[labels] + noise * rng.randn(len(labels), *templates.shape[1:])
+  return np.clip(imgs, 0, 255).astype(np.uint8)
+
+
+def write_cifar10(root='cs231n/datasets/cifar-10-batches-py',
+                  num_per_batch=10000, num_test=10000, num_classes=10,
+                  seed=0):
+  """
+  Write a synthetic CIFAR-10 in the python pickle format read by load_CIFAR10:
+  five pickled training batches data_batch_1 ... data_batch_5, a test_batch
+  and batches.meta.
+
+  Inputs:
+  - root: Directory to write the batches to; created if necessary.
+  - num_per_batch: Number of images in each of the five training batches.
+  - num_test: Number of images in the test batch.
+  - num_classes: Number of distinct labels.
+  - seed: Seed for the random number generator.
+  """
+  rng = np.random.RandomState(seed)
+  if not os.path.isdir(root):
+    os.makedirs(root)
+  templates = 255 * rng.rand(num_classes, 32, 32, 3)
+
+  def write_batch(filename, batch_label, num):
+    labels = rng.randint(num_classes, size=num)
+    imgs = _class_images(rng, templates, labels)
+    batch = {
+      'batch_label': batch_label,
+      'data': imgs.transpose(0, 3, 1, 2).reshape(num, -1),
+      'labels': labels.tolist(),
+      'filenames': ['synthetic_%d.png' % i for i in xrange(num)],
+    }
+    with open(os.path.join(root, filename), 'wb') as f:
+      pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+
+  for b in range(1, 6):
+    write_batch('data_batch_%d' % b, 'training batch %d of 5' % b,
+                num_per_batch)
+  write_batch('test_batch', 'testing batch 1 of 1', num_test)
+
+  meta = {
+    'label_names': ['class_%d' % i for i in xrange(num_classes)],
+    'num_cases_per_batch': num_per_batch,
+    'num_vis': 32 * 32 * 3,
+  }
+  with open(os.path.join(root, 'batches.meta'), 'wb') as f:
+    pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+
+
+def write_tiny_imagenet(path='cs231n/datasets/tiny-imagenet-100-A',
+                        num_classes=100, num_train_per_class=500,
+                        num_val_per_class=50, num_test_per_class=50,
+                        test_labels=False, seed=0):
+  """
+  Write a synthetic TinyImageNet in the directory structure read by
+  load_tiny_imagenet: wnids.txt, words.txt, train/<wnid>/<wnid>_boxes.txt with
+  images in train/<wnid>/images, val/val_annotations.txt with images in
+  val/images, and test/images.
+
+  Inputs:
+  - path: Directory to write the dataset to; created if necessary.
+  - num_classes: Number of synsets.
+  - num_train_per_class: Number of training images for each synset.
+  - num_val_per_class: Number of validation images for each synset.
+  - num_test_per_class: Number of test images for each synset.
+  - test_labels: If True, also write test/test_annotations.txt.
+  - seed: Seed for the random number generator.
+  """
+  rng = np.random.RandomState(seed)
+  wnids = ['n%08d' % (i + 1) for i in xrange(num_classes)]
+  templates = 255 * rng.rand(num_classes, 64, 64, 3)
+
+  def makedirs(*parts):
+    d = os.path.join(path, *parts)
+    if not os.path.isdir(d):
+      os.makedirs(d)
+    return d
+
+  def box():
+    x0, y0 = rng.randint(32, size=2)
+    x1, y1 = x0 + rng.randint(16, 32), y0 + rng.randint(16, 32)
+    return '%d\t%d\t%d\t%d' % (x0, y0, x1, y1)
+
+  makedirs()
+  with open(os.path.join(path, 'wnids.txt'), 'w') as f:
+    for wnid in wnids:
+      f.write('%s\n' % wnid)
+  with open(os.path.join(path, 'words.txt'), 'w') as f:
+    for i, wnid in enumerate(wnids):
+      f.write('%s\tsynthetic class %d, class %d\n' % (wnid, i, i))
+
+  for i, wnid in enumerate(wnids):
+    image_dir = makedirs('train', wnid, 'images')
+    imgs = _class_images(rng, templates, [i] * num_train_per_class)
+    with open(os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid), 'w') as f:
+      for j, img in enumerate(imgs):
+        img_file = '%s_%d.JPEG' % (wnid, j)
+        imsave(os.path.join(image_dir, img_file), img)
+        f.write('%s\t%s\n' % (img_file, box()))
+
+  def write_split(split, num_per_class):
+    image_dir = makedirs(split, 'images')
+    labels = rng.permutation(np.repeat(np.arange(num_classes), num_per_class))
+    annotations = []
+    for j, (label, img) in enumerate(zip(labels, _class_images(rng, templates, labels))):
+      img_file = '%s_%d.JPEG' % (split, j)
+      imsave(os.path.join(image_dir, img_file), img)
+      annotations.append('%s\t%s\t%s\n' % (img_file, wnids[label], box()))
+    return annotations
+
+  val_annotations = write_split('val', num_val_per_class)
+  with open(os.path.join(path, 'val', 'val_annotations.txt'), 'w') as f:
+    f.writelines(val_annotations)
+  test_annotations = write_split('test', num_test_per_class)
+  if test_labels:
+    with open(os.path.join(path, 'test', 'test_annotations.txt'), 'w') as f:
+      f.writelines(test_annotations)
+
+
+def write_coco_captioning(base_dir='cs231n/datasets/coco_captioning',
+                          num_train_images=82783, num_val_images=40504,
+                          captions_per_image=5, vocab_size=1004,
+                          max_length=17, pca_dim=512, fc7_dim=4096,
+                          write_fc7=False, seed=0):
+  """
+  Write a synthetic captioning dataset in the layout read by load_coco_data:
+  coco2014_captions.h5, coco2014_vocab.json, the train2014/val2014 feature
+  files and the train2014_urls.txt / val2014_urls.txt URL lists.
+
+  Inputs:
+  - base_dir: Directory to write the dataset to; created if necessary.
+  - num_train_images, num_val_images: Number of images in each split.
+  - captions_per_image: Number of captions for each image.
+  - vocab_size: Size of the vocabulary including the special tokens <NULL>,
+    <START>, <END> and <UNK>.
+  - max_length: Length T of each caption array, including <START> and <END>.
+  - pca_dim: Dimension of the PCA-reduced features (pca_features=True).
+  - fc7_dim: Dimension of the full features (pca_features=False).
+  - write_fc7: Whether to also write the (large) full feature files.
+  - seed: Seed for the random number generator.
+  """
+  rng = np.random.RandomState(seed)
+  if not os.path.isdir(base_dir):
+    os.makedirs(base_dir)
+
+  idx_to_word = ['<NULL>', '<START>', '<END>', '<UNK>']
+  idx_to_word += ['word%d' % i for i in xrange(vocab_size - len(idx_to_word))]
+  word_to_idx = {w: i for i, w in enumerate(idx_to_word)}
+  with open(os.path.join(base_dir, 'coco2014_vocab.json'), 'w') as f:
+    json.dump({'idx_to_word': idx_to_word, 'word_to_idx': word_to_idx}, f)
+
+  def captions(num_images):
+    num = num_images * captions_per_image
+    caps = np.zeros((num, max_length), dtype=np.int32)
+    lengths = rng.randint(1, max_length - 1, size=num)
+    caps[:, 0] = word_to_idx['<START>']
+    for i, n in enumerate(lengths):
+      caps[i, 1:n + 1] = rng.randint(3, vocab_size, size=n)
+      caps[i, n + 1] = word_to_idx['<END>']
+    image_idxs = np.repeat(np.arange(num_images, dtype=np.int32),
+                           captions_per_image)
+    return caps, image_idxs
+
+  with h5py.File(os.path.join(base_dir, 'coco2014_captions.h5'), 'w') as f:
+    for split, num_images in [('train', num_train_images),
+                              ('val', num_val_images)]:
+      caps, image_idxs = captions(num_images)
+      f.create_dataset('%s_captions' % split, data=caps)
+      f.create_dataset('%s_image_idxs' % split, data=image_idxs)
+
+  for split, num_images in [('train', num_train_images),
+                            ('val', num_val_images)]:
+    name = '%s2014_vgg16_fc7' % split
+    dims = [('%s_pca.h5' % name, pca_dim)]
+    if write_fc7:
+      dims.append(('%s.h5' % name, fc7_dim))
+    for feat_file, dim in dims:
+      with h5py.File(os.path.join(base_dir, feat_file), 'w') as f:
+        feats = rng.randn(num_images, dim).astype(np.float32)
+        f.create_dataset('features', data=feats)
+
+    with open(os.path.join(base_dir, '%s2014_urls.txt' % split), 'w') as f:
+      for i in xrange(num_images):
+        f.write('http://localhost/%s2014/COCO_%s2014_%012d.jpg\n'
+                % (split, split, i))
+
+
+def write_pretrained_model(h5_file='cs231n/datasets/pretrained_model.h5',
+                           num_classes=100, input_size=64, seed=0):
+  """
+  Write synthetic PretrainedCNN weights in the HDF5 layout read by
+  PretrainedCNN.load_weights: one dataset per parameter plus running_mean%d and
+  running_var%d for each batch normalization layer.
+
+  Inputs:
+  - h5_file: Path of the HDF5 file to write.
+  - num_classes, input_size: Passed to PretrainedCNN to determine shapes.
+  - seed: Seed for the random number generator.
+  """
+  rng = np.random.RandomState(seed)
+  model = PretrainedCNN(num_classes=num_classes, input_size=input_size)
+  with h5py.File(h5_file, 'w') as f:
+    for k, v in sorted(model.params.iteritems()):
+      if k.startswith('W'):
+        fan_in = np.prod(v.shape[1:]) if v.ndim == 4 else v.shape[0]
+        w = np.sqrt(2.0 / fan_in) * rng.randn(*v.shape)
+      elif k.startswith('gamma'):
+        w = 1.0 + 0.1 * rng.randn(*v.shape)
+      else:
+        w = 0.1 * rng.randn(*v.shape)
+      f.create_dataset(k, data=w.astype(np.float32))
+    for i in xrange(len(model.bn_params)):
+      dim = model.params['gamma%d' % (i + 1)].shape
+      f.create_dataset('running_mean%d' % (i + 1),
+                       data=(0.1 * rng.randn(*dim)).astype(np.float32))
+      f.create_dataset('running_var%d' % (i + 1),
+                       data=(1.0 + 0.1 * rng.rand(*dim)).astype(np.float32))
@@ -0,0 +1,165 @@
+import numpy as np
+
+
+class Tape(object):
+  """
+  A record of the layers run in a forward pass, for running their backward
+  passes in reverse order.
+
+  Each call of run evaluates one forward function and appends its backward
+  function and cache to the tape, under the names of its output and of the
+  values it takes gradients for. backward then pops the entries from the end
+  and passes each one the gradient of its output. The tape holds the only
+  reference to a cache and to an intermediate gradient, so both are released
+  as soon as the backward pass of their entry has consumed them instead of
+  living until the loss function returns.
+
+  The tape counts the bytes of the arrays that are held by its caches and
+  pending gradients. Views of the same array are counted once, and arrays such
+  as the model parameters that live beyond the pass can be excluded. The
+  largest count is kept in peak_bytes; it does not include the temporaries
+  that a layer function allocates while it runs.
+
+  Example usage:
+
+  tape = Tape(exclude=model.params.values())
+  h = tape.run(affine_relu_forward, affine_relu_backward,
+               'h', ('X', 'W1', 'b1'), X, W1, b1)
+  scores = tape.run(affine_forward, affine_backward,
+                    'scores', ('h', 'W2', 'b2'), h, W2, b2)
+  loss, dscores = softmax_loss(scores, y)
+  grads = tape.backward({'scores': dscores})
+  # grads holds the gradients of 'X', 'W1', 'b1', 'W2' and 'b2'
+  """
+
+  def __init__(self, exclude=()):
+    """
+    Inputs:
+    - exclude: Arrays whose bytes are not counted in live_bytes, for example
+      the model parameters.
+    """
+    self.entries = []
+    self.live_bytes = 0
+    self.peak_bytes = 0
+    self._exclude = set(id(_base(a)) for a in exclude)
+    self._refs = {}
+    self._grad_keys = {}
+
+
+  def run(self, forward, backward, output, inputs, *args):
+    """
+    Run a forward function and record it on the tape.
+
+    Inputs:
+    - forward: Forward function returning a tuple (out, cache).
+    - backward: Matching backward function taking (dout, cache).
+    - output: Name of the output value.
+    - inputs: Names of the values for the gradients that backward returns,
+      in order; None for a gradient that is not needed.
+    - args: Arguments of forward.
+
+    Returns:
+    - out: The output of forward.
+    """
+    out, cache = forward(*args)
+    self.entries.append((backward, cache, output, inputs, self._retain(cache)))
+    return out
+
+
+  def backward(self, douts):
+    """
+    Run the backward passes of all entries in reverse order, emptying the tape.
+
+    Inputs:
+    - douts: Dictionary mapping the names of output values to the gradients
+      of the loss with respect to them. The gradients are accumulated in this
+      dictionary, which is returned as grads; the caller should not keep
+      other references to the gradients in it, so that they can be released.
+
+    Returns:
+    - grads: Dictionary mapping the name of every value that is an input but
+      not the output of an entry, such as the parameters and the data, to its
+      gradient. Gradients of values that are used more than once are summed.
+      Entries whose output has no gradient are skipped.
+    """
+    grads = douts
+    for name in grads:
+      self._grad_keys[name] = self._retain(grads[name])
+    while self.entries:
+      backward, cache, output, inputs, keys = self.entries.pop()
+      if output in grads:
+        dout = grads.pop(output)
+        dout_keys = self._grad_keys.pop(output)
+        dinputs = backward(dout, cache)
+        if not isinstance(dinputs, tuple):
+          dinputs = (dinputs,)
+        for name, dinput in zip(inputs, dinputs):
+          if name is not None and dinput is not None:
+            self._add_grad(grads, name, dinput)
+        del dout, dinputs
+        self._release(dout_keys)
+      del cache
+      self._release(keys)
+    return grads
+
+
+  def _add_grad(self, grads, name, grad):
+    if name in grads:
+      grad = grads[name] + grad
+      self._release(self._grad_keys[name])
+    grads[name] = grad
+    self._grad_keys[name] = self._retain(grad)
+
+
+  def _retain(self, value):
+    """
+    Count the arrays in value as live and return the keys to release them.
+    """
+    keys = []
+    for a in _arrays(value):
+      key = id(_base(a))
+      if key in self._exclude:
+        continue
+      ref = self._refs.get(key)
+      if ref is None:
+        self._refs[key] = ref = [0, 0]
+      ref[0] += 1
+      if a.nbytes > ref[1]:
+        self.live_bytes += a.nbytes - ref[1]
+        ref[1] = a.nbytes
+      keys.append(key)
+    self.peak_bytes = max(self.peak_bytes, self.live_bytes)
+    return keys
+
+
+  def _release(self, keys):
+    for key in keys:
+      ref = self._refs[key]
+      ref[0] -= 1
+      if ref[0] == 0:
+        self.live_bytes -= ref[1]
+        del self._refs[key]
+
+
+def _base(a):
+  """ Return the array that owns the memory of a view. """
+  while isinstance(a.base, np.ndarray):
+    a = a.base
+  return a
+
+
+def _arrays(value):
+  """
+  Yield all arrays in value, searching tuples, lists and dictionaries such as
+  caches.
+  """
+  if isinstance(value, np.ndarray):
+    yield value
+  elif isinstance(value, (tuple, list)):
+    for v in value:
+      for a in _arrays(v):
+        yield a
+  elif isinstance(value, dict):
+    for v in value.itervalues():
+      for a in _arrays(v):
+        yield a